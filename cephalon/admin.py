@@ -3,7 +3,7 @@ from django.http import HttpResponseRedirect
 from django_json_widget.widgets import JSONEditorWidget
 
 from django.db import models
-from cephalon.models import APIKey, Project, ProjectFile, Pyre, WebsocketNode, Topic, APIKeyRemote, AnalysisGroup
+from cephalon.models import APIKey, Project, ProjectFile, FileBlob, Pyre, WebsocketNode, Topic, APIKeyRemote, AnalysisGroup
 from django import forms
 from django.shortcuts import render
 from django.urls import path
@@ -54,7 +54,8 @@ class ProjectFileAdmin(admin.ModelAdmin):
             obj.save_altered()
         if 'load_file_content' in form.changed_data:
             if form.cleaned_data['load_file_content']:
-                obj.load_file()
+                if obj.ingest_status != "queued":
+                    obj.enqueue_ingest()
             else:
                 obj.remove_file_content()
         super().save_model(request, obj, form, change)
@@ -75,6 +76,13 @@ class ProjectFileAdmin(admin.ModelAdmin):
             queryset = queryset.filter(file_category="other")
         queryset, use_distinct = super().get_search_results(request, queryset, search_term)
         return queryset, use_distinct
+
+@admin.register(FileBlob)
+class FileBlobAdmin(admin.ModelAdmin):
+    search_fields = ("hash",)
+    list_display = ("hash", "hash_algorithm", "file", "size", "ref_count")
+    readonly_fields = ("hash", "hash_algorithm", "file", "size", "ref_count")
+
 @admin.register(Pyre)
 class PyreAdmin(admin.ModelAdmin):
     list_display = ("name",)
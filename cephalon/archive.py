@@ -0,0 +1,195 @@
+import json
+import tarfile
+import time
+import uuid
+import zlib
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+
+from cephalon.models import Project, ProjectFile, AnalysisGroup
+from cephalon.utils import HashingFile, HASH_ALGORITHMS
+
+ARCHIVE_FORMAT = 1
+MANIFEST_NAME = "project.json"
+ANALYSIS_GROUP_FILE_FIELDS = ["searched_file", "differential_analysis_file", "sample_annotation_file",
+                              "comparison_matrix_file", "unprocessed_file"]
+
+
+def get_tar_header(name: str, size: int) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def get_tar_padding(size: int) -> bytes:
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def get_project_manifest(project: Project) -> dict:
+    files = list(project.files.all())
+    groups = []
+    for group in project.analysis_groups.prefetch_related("other_files"):
+        entry = {field: getattr(group, f"{field}_id") for field in ANALYSIS_GROUP_FILE_FIELDS}
+        entry["other_files"] = [file.id for file in group.other_files.all()]
+        groups.append(entry)
+    return {
+        "format": ARCHIVE_FORMAT,
+        "project": {
+            "name": project.name,
+            "description": project.description,
+            "metadata": project.metadata,
+            "global_id": project.global_id,
+            "encrypted": project.encrypted,
+        },
+        "files": [{
+            "id": file.id,
+            "name": file.name,
+            "description": file.description,
+            "hash": file.hash,
+            "hash_algorithm": file.hash_algorithm,
+            "metadata": file.metadata,
+            "file_type": file.file_type,
+            "file_category": file.file_category,
+            "path": file.path,
+            "load_file_content": file.load_file_content,
+            "member": f"files/{file.id}/{file.name}" if file.file else None,
+        } for file in files],
+        "analysis_groups": groups,
+    }
+
+
+def iter_project_archive(project: Project):
+    """
+    Yield a project as one gzip compressed tar stream. The first member is a manifest with the project, the metadata
+    of its files and its analysis groups, followed by the raw files. Members are written directly so that only one
+    read buffer of a file is held in memory at a time.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    manifest = get_project_manifest(project)
+    data = json.dumps(manifest).encode()
+    yield compressor.compress(get_tar_header(MANIFEST_NAME, len(data)) + data + get_tar_padding(len(data)))
+
+    files = {file.id: file for file in project.files.all()}
+    for entry in manifest["files"]:
+        if not entry["member"]:
+            continue
+        file = files[entry["id"]]
+        with file.open_data() as f:
+            size = file.get_data_size()
+            yield compressor.compress(get_tar_header(entry["member"], size))
+            written = 0
+            for chunk in iter(lambda: f.read(settings.FILE_READ_BUFFER_SIZE), b""):
+                chunk = chunk[:size - written]
+                written += len(chunk)
+                output = compressor.compress(chunk)
+                if output:
+                    yield output
+                if written == size:
+                    break
+            if written != size:
+                raise IOError(f"{file.file.name} changed while it was exported")
+            yield compressor.compress(get_tar_padding(size))
+    yield compressor.compress(b"\0" * tarfile.BLOCKSIZE * 2)
+    yield compressor.flush()
+
+
+def import_project_archive(stream, user=None) -> Project:
+    """
+    Create a project from a stream produced by iter_project_archive. The archive is read member by member from the
+    stream, which for a request is the body the server has already spooled to a temporary file, and every file is
+    hashed while it is written to storage and checked against the manifest. Each file is committed on its own so the
+    project is not locked for the whole import, when the archive is incomplete or a file does not match its hash the
+    project and the files stored so far are deleted again.
+    """
+    project = None
+    stored = []
+    ingest = []
+    try:
+        with tarfile.open(fileobj=stream, mode="r|gz") as tar:
+            member = tar.next()
+            if member is None or member.name != MANIFEST_NAME:
+                raise ValueError("archive does not start with a project manifest")
+            manifest = json.load(tar.extractfile(member))
+            if manifest.get("format") != ARCHIVE_FORMAT:
+                raise ValueError("unsupported archive format")
+            if any(entry["hash_algorithm"] not in HASH_ALGORITHMS for entry in manifest["files"]):
+                raise ValueError("unsupported hash algorithm")
+            project_data = manifest["project"]
+            if project_data.get("global_id") and Project.objects.filter(global_id=project_data["global_id"]).exists():
+                raise ValueError("project already exists")
+            project = Project.objects.create(
+                name=project_data["name"],
+                description=project_data["description"],
+                metadata=project_data["metadata"],
+                global_id=project_data.get("global_id") or str(uuid.uuid4()),
+                encrypted=project_data.get("encrypted", False),
+                user=user,
+            )
+            entries = {entry["member"]: entry for entry in manifest["files"] if entry["member"]}
+            file_ids = {}
+            for entry in manifest["files"]:
+                if not entry["member"]:
+                    file_ids[entry["id"]] = ProjectFile.objects.create(
+                        project=project, **get_file_fields(entry)).id
+
+            while (member := tar.next()) is not None:
+                entry = entries.pop(member.name, None)
+                if entry is None or not member.isfile():
+                    raise ValueError(f"unexpected archive member {member.name}")
+                hashing_file = HashingFile(File(tar.extractfile(member), name=entry["name"]),
+                                           entry["hash_algorithm"])
+                with transaction.atomic():
+                    file = ProjectFile(project=project, file=hashing_file, **get_file_fields(entry))
+                    file.save()
+                    stored = [file.file.name]
+                    if hashing_file.hexdigest() != entry["hash"]:
+                        raise ValueError(f"hash mismatch for {entry['name']}")
+                    file.store_in_blob()
+                    file.save()
+                # once committed the stored file belongs to a blob and is released with the project
+                stored = []
+                file_ids[entry["id"]] = file.id
+                if entry["load_file_content"]:
+                    ingest.append(file)
+            if entries:
+                raise ValueError("archive is missing files")
+
+            with transaction.atomic():
+                for entry in manifest["analysis_groups"]:
+                    group = AnalysisGroup.objects.create(project=project, **{
+                        f"{field}_id": file_ids.get(entry[field]) for field in ANALYSIS_GROUP_FILE_FIELDS
+                    })
+                    group.other_files.set([file_ids[file_id] for file_id in entry["other_files"]
+                                           if file_id in file_ids])
+    except (tarfile.TarError, EOFError, zlib.error, KeyError) as e:
+        discard_import(project, stored)
+        raise ValueError(f"invalid archive: {e}")
+    except Exception:
+        discard_import(project, stored)
+        raise
+    for file in ingest:
+        file.enqueue_ingest()
+    # the merkle hash of the project was updated in the database as its files were added
+    project.refresh_from_db()
+    return project
+
+
+def get_file_fields(entry: dict) -> dict:
+    return {field: entry[field] for field in ["name", "description", "hash", "hash_algorithm", "metadata", "file_type",
+                                              "file_category", "path"]}
+
+
+def remove_stored_files(names: list[str]):
+    # files that turned out to be duplicates of an existing blob were already removed by store_in_blob
+    storage = ProjectFile._meta.get_field("file").storage
+    for name in names:
+        storage.delete(name)
+
+
+def discard_import(project: Project, stored: list[str]):
+    remove_stored_files(stored)
+    if project:
+        project.delete()
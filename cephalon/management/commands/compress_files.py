@@ -0,0 +1,40 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from cephalon.models import ProjectFile, COMPRESSIBLE_FILE_TYPES
+from cephalon.utils import compress_file, get_storage_format
+
+
+class Command(BaseCommand):
+    """
+    A command to compress the stored files of text file types that are still kept as they were uploaded. Every stored
+    file is compressed once even when several project files or a blob share it, encrypted files are skipped.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, nargs='+', help='Ids of the projects whose files to compress')
+        parser.add_argument('--dry-run', action='store_true', help='Only list the files that would be compressed')
+
+    def handle(self, *args, **options):
+        files = ProjectFile.objects.filter(file_type__in=COMPRESSIBLE_FILE_TYPES).exclude(file="").exclude(file=None)
+        if options['project']:
+            files = files.filter(project_id__in=options['project'])
+        names = sorted(set(files.values_list("file", flat=True)))
+        storage = ProjectFile._meta.get_field("file").storage
+        compressed = before = after = 0
+        for name in names:
+            path = storage.path(name)
+            if not os.path.exists(path) or get_storage_format(path) != "plain":
+                continue
+            size = os.path.getsize(path)
+            if options['dry_run']:
+                self.stdout.write(f"{name} {size} bytes")
+                continue
+            compress_file(path)
+            compressed += 1
+            before += size
+            after += os.path.getsize(path)
+        if not options['dry_run']:
+            self.stdout.write(f"compressed {compressed} files from {before / 1024 / 1024:.1f} MB to "
+                              f"{after / 1024 / 1024:.1f} MB")
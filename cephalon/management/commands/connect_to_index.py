@@ -85,42 +85,61 @@ class Command(BaseCommand):
                             #     }))
                     elif channel_type=="file_request":
                         if message["targetID"] == options["server_id"]:
-                            print(self.api_key.allow_download)
-                            if self.api_key.allow_download == True:
-                                old_file = await ProjectFile.objects.aget(id=message["data"]["id"])
-                                #remote = RemoteCorpusX(f"{self.protocol}://{self.hostname}:{self.port}", self.decoded_api_key)
-                                file = current.upload_project_file.delay(current, old_file, message["sessionID"], message["clientID"], message["pyreName"], options["server_id"])
-                                print(file)
-                                #file = await remote.upload_chunked_file(old_file)
-                                # await websocket.send(json.dumps({
-                                #     "message": "File uploaded",
-                                #     "requestType": "file-upload",
-                                #     "senderID": options["server_id"],
-                                #     "targetID": "host",
-                                #     "channelType": channel_type,
-                                #     "sessionID": message["sessionID"],
-                                #     "data": [FileSchema.from_orm(old_file).dict(), file],
-                                #     "clientID": message["clientID"]
-                                # }))
-                            else:
-                                with httpx.Client(headers={"X-API-Key": self.decoded_api_key}) as client:
-                                    res = client.post(
-                                        f"{self.api_key.remote_pair.protocol}://{self.api_key.remote_pair.hostname}:{self.api_key.remote_pair.port}/api/notify/message/{message['sessionID']}/{message['clientID']}",
-                                        data={
-                                            "message": "File request not allowed. Please contact the node administrator for more information",
-                                            "requestType": "file-request-not-allowed",
-                                            "senderID": options["server_id"],
-                                            "targetID": message["clientID"],
-                                            "channelType": channel_type,
-                                            "sessionID": message["sessionID"],
-                                            "data": settings.ADMIN_CONTACT_EMAIL,
-                                            "clientID": message["clientID"],
-                                            "pyreName": message["pyreName"]
-                                        })
+                            await self.handle_file_request(current, message, options)
 
             except websockets.ConnectionClosed:
                 print("Connection closed")
                 continue
+
+    async def handle_file_request(self, current: CurrentCorpusX, message: dict, options: dict):
+        """
+        a method to answer a file request from the index server either with the whole file or, when the request is
+        shared between several nodes, with the ranges of the transfer that this node claims
+        """
+        print(self.api_key.allow_download)
+        if self.api_key.allow_download == True:
+            #remote = RemoteCorpusX(f"{self.protocol}://{self.hostname}:{self.port}", self.decoded_api_key)
+            transfer = message["data"].get("transfer")
+            if transfer:
+                # the requested id belongs to the node the user picked, every node looks for the same content instead
+                # and a node without it has nothing to send
+                old_file = await ProjectFile.objects.filter(
+                    hash=message["data"]["hash"],
+                    hash_algorithm=message["data"].get("hash_algorithm") or settings.FILE_HASH_ALGORITHM
+                ).afirst()
+                if old_file:
+                    current.send_project_file_ranges.delay(current, old_file, transfer["upload_id"], options["server_id"])
+            else:
+                old_file = await ProjectFile.objects.aget(id=message["data"]["id"])
+                file = current.upload_project_file.delay(current, old_file, message["sessionID"], message["clientID"], message["pyreName"], options["server_id"])
+                print(file)
+            #file = await remote.upload_chunked_file(old_file)
+            # await websocket.send(json.dumps({
+            #     "message": "File uploaded",
+            #     "requestType": "file-upload",
+            #     "senderID": options["server_id"],
+            #     "targetID": "host",
+            #     "channelType": "file_request",
+            #     "sessionID": message["sessionID"],
+            #     "data": [FileSchema.from_orm(old_file).dict(), file],
+            #     "clientID": message["clientID"]
+            # }))
+        else:
+            with httpx.Client(headers={"X-API-Key": self.decoded_api_key}) as client:
+                res = client.post(
+                    f"{self.api_key.remote_pair.protocol}://{self.api_key.remote_pair.hostname}:{self.api_key.remote_pair.port}/api/notify/message/{message['sessionID']}/{message['clientID']}",
+                    data={
+                        "message": "File request not allowed. Please contact the node administrator for more information",
+                        "requestType": "file-request-not-allowed",
+                        "senderID": options["server_id"],
+                        "targetID": message["clientID"],
+                        "channelType": "file_request",
+                        "sessionID": message["sessionID"],
+                        "data": settings.ADMIN_CONTACT_EMAIL,
+                        "clientID": message["clientID"],
+                        "pyreName": message["pyreName"]
+                    })
+
     async def connect(self, options):
         await asyncio.gather(self.connect_to_server(options, channel_type="initial"), self.connect_to_server(options, channel_type="search"), self.connect_to_server(options, channel_type="file_request"))
 
@@ -0,0 +1,148 @@
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from cephalon.models import Project, ProjectFile
+from cephalon.utils import hash_file, invalidate_cache_scopes
+
+FILE_TYPES = {
+    ".csv": "csv",
+    ".tsv": "tsv",
+    ".txt": "txt",
+    ".tab": "txt",
+    ".json": "json",
+}
+
+# words in the file name or its folders that point to a file category, checked in order
+CATEGORY_KEYWORDS = [
+    ("differential_analysis", ("differential", "diff_analysis", "limma", "deseq")),
+    ("sample_annotation", ("annotation", "sample_info", "metadata")),
+    ("comparison_matrix", ("comparison", "contrast")),
+    ("searched", ("searched", "search_output", "report", "proteingroups", "evidence", "peptides")),
+    ("unprocessed", ("raw", "unprocessed")),
+]
+
+
+def infer_file_type(name: str) -> str:
+    return FILE_TYPES.get(os.path.splitext(name)[1].lower(), "other")
+
+
+def infer_file_category(relative_path: str, default: str = "other") -> str:
+    lowered = relative_path.lower()
+    for category, keywords in CATEGORY_KEYWORDS:
+        if any(keyword in lowered for keyword in keywords):
+            return category
+    return default
+
+
+class Command(BaseCommand):
+    """
+    A command to register every file under a local directory as files of a project. The file type and category are
+    inferred from the name and folders of each file and the folders become the path of the file. Files are hardlinked,
+    moved or referenced in place under MEDIA_ROOT instead of going through the upload api, hashed in parallel and
+    created in bulk.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', type=str, help='Directory to import')
+        parser.add_argument('--project', type=int, help='Id of the project to add the files to')
+        parser.add_argument('--create-project', type=str, help='Name of a new project to add the files to')
+        parser.add_argument('--mode', type=str, choices=['link', 'move', 'reference'], default='link',
+                            help='Hardlink or move files into MEDIA_ROOT, or reference files already under it')
+        parser.add_argument('--category', type=str, default='other',
+                            help='Category of files whose category cannot be inferred')
+        parser.add_argument('--index', action='store_true', help='Queue the content of text files for indexing')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of hashing threads')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of files created per query')
+
+    def handle(self, *args, **options):
+        directory = os.path.abspath(options['directory'])
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+        media_root = os.path.abspath(settings.MEDIA_ROOT)
+        if options['mode'] == 'reference' and not directory.startswith(media_root + os.sep):
+            raise CommandError(f"only files under {media_root} can be referenced in place")
+        if options['project']:
+            project = Project.objects.get(id=options['project'])
+        elif options['create_project']:
+            project = Project.objects.create(name=options['create_project'], description=f"Imported from {directory}",
+                                             global_id=str(uuid.uuid4()))
+        else:
+            raise CommandError("either --project or --create-project is required")
+        if options['mode'] == 'reference' and project.encrypted:
+            raise CommandError("files of an encrypted project cannot be referenced in place")
+
+        existing = {(tuple(path or []), name) for path, name in project.files.values_list("path", "name")}
+        found = []
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if name.startswith("."):
+                    continue
+                relative_path = os.path.relpath(os.path.join(root, name), directory)
+                folders = tuple(os.path.dirname(relative_path).split(os.sep)) if os.path.dirname(relative_path) else ()
+                if (folders, name) not in existing:
+                    found.append((relative_path, folders, name))
+        self.stdout.write(f"found {len(found)} new files in {directory}")
+        if not found:
+            return
+
+        algorithm = settings.FILE_HASH_ALGORITHM
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            hashes = list(executor.map(lambda item: hash_file(os.path.join(directory, item[0]), algorithm), found))
+        self.stdout.write(f"hashed {len(hashes)} files")
+
+        import_root = os.path.join("cephalon", "files", "imports", f"{project.id}-{uuid.uuid4().hex[:8]}")
+        files = []
+        for (relative_path, folders, name), file_hash in zip(found, hashes):
+            source = os.path.join(directory, relative_path)
+            if options['mode'] == 'reference':
+                stored_name = os.path.relpath(source, media_root)
+            else:
+                stored_name = os.path.join(import_root, relative_path)
+                target = os.path.join(media_root, stored_name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if options['mode'] == 'link':
+                    os.link(source, target)
+                else:
+                    shutil.move(source, target)
+            files.append(ProjectFile(
+                name=name,
+                file=stored_name,
+                hash=file_hash,
+                hash_algorithm=algorithm,
+                file_type=infer_file_type(name),
+                file_category=infer_file_category(relative_path, options['category']),
+                path=list(folders),
+                project=project,
+            ))
+        created = ProjectFile.objects.bulk_create(files, batch_size=options['batch_size'])
+        # bulk_create skips store_in_blob as well, files that have to be kept encrypted or compressed are moved into
+        # the content addressed store here
+        stored = [file for file in created if options['mode'] != 'reference' and
+                  (file.is_encrypted_at_rest() or file.is_compressed_at_rest())]
+        for file in stored:
+            file.store_in_blob()
+        ProjectFile.objects.bulk_update(stored, ["blob", "file", "hash", "hash_algorithm"],
+                                        batch_size=options['batch_size'])
+
+        # bulk_create skips the save signals that keep the project hash and caches up to date
+        with transaction.atomic():
+            project = Project.objects.select_for_update().get(id=project.id)
+            project.hash = project.rebuild_hash_tree()
+            Project.objects.filter(id=project.id).update(hash=project.hash)
+        invalidate_cache_scopes("projects", f"project:{project.id}", f"project:{project.id}:files")
+        self.stdout.write(f"created {len(created)} files in project {project.id}")
+
+        if options['index']:
+            queued = 0
+            for file in created:
+                if file.file_type in ("csv", "tsv", "txt"):
+                    file.enqueue_ingest()
+                    queued += 1
+            self.stdout.write(f"queued {queued} files for indexing")
@@ -0,0 +1,108 @@
+import os
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from cephalon.models import ProjectFile
+
+
+def close_connections():
+    # connections inherited from the parent process cannot be shared, every worker opens its own
+    connections.close_all()
+
+
+def reindex_file(file_id: int) -> tuple[int, int, str]:
+    """
+    Index the content of one file and return its id, its size and the error if indexing failed
+    """
+    try:
+        file = ProjectFile.objects.get(id=file_id)
+        file.ingest()
+        return file_id, file.get_data_size(), ""
+    except Exception as e:
+        return file_id, 0, f"{type(e).__name__}: {e}"
+
+
+class Command(BaseCommand):
+    """
+    A command to index the content of many files at once with a pool of worker processes, every worker holds one
+    database connection. Finished files are appended to a checkpoint file so an interrupted run can be resumed.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project', type=int, nargs='+', help='Ids of the projects to index')
+        parser.add_argument('--topic', type=str, nargs='+', help='Names of the topics whose projects to index')
+        parser.add_argument('--category', type=str, nargs='+', help='File categories to index')
+        parser.add_argument('--hash', type=str, nargs='+', help='Hashes of the files to index')
+        parser.add_argument('--backfill', action='store_true',
+                            help='Also index files that do not have load_file_content set yet')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes, 1 indexes in this process')
+        parser.add_argument('--checkpoint', type=str, help='File recording finished files to resume from')
+
+    def get_queryset(self, options):
+        files = ProjectFile.objects.exclude(file="").exclude(file=None)
+        if not options['backfill']:
+            files = files.filter(load_file_content=True)
+        if options['project']:
+            files = files.filter(project_id__in=options['project'])
+        if options['topic']:
+            files = files.filter(project__topic__name__in=options['topic'])
+        if options['category']:
+            files = files.filter(file_category__in=options['category'])
+        if options['hash']:
+            files = files.filter(hash__in=options['hash'])
+        return files.distinct().order_by("id")
+
+    def handle(self, *args, **options):
+        done = set()
+        if options['checkpoint'] and os.path.exists(options['checkpoint']):
+            with open(options['checkpoint'], "rt") as f:
+                done = {int(line) for line in f if line.strip()}
+        file_ids = [file_id for file_id in self.get_queryset(options).values_list("id", flat=True)
+                    if file_id not in done]
+        self.stdout.write(f"{len(file_ids)} files to index, {len(done)} already done")
+        if not file_ids:
+            return
+
+        checkpoint = open(options['checkpoint'], "at") if options['checkpoint'] else None
+        started = time.monotonic()
+        indexed = failed = total_size = 0
+        pool = None
+        try:
+            if options['workers'] > 1:
+                close_connections()
+                pool = Pool(min(options['workers'], len(file_ids)), initializer=close_connections)
+                results = pool.imap_unordered(reindex_file, file_ids)
+            else:
+                results = map(reindex_file, file_ids)
+            for file_id, size, error in results:
+                if error:
+                    failed += 1
+                    self.stderr.write(f"file {file_id} failed: {error}")
+                    continue
+                indexed += 1
+                total_size += size
+                if checkpoint:
+                    checkpoint.write(f"{file_id}\n")
+                    checkpoint.flush()
+                if indexed % 100 == 0:
+                    self.write_stats(indexed, failed, total_size, started)
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            if pool:
+                pool.terminate()
+            if checkpoint:
+                checkpoint.close()
+        self.write_stats(indexed, failed, total_size, started)
+
+    def write_stats(self, indexed: int, failed: int, total_size: int, started: float):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(
+            f"indexed {indexed} files ({failed} failed), {total_size / 1024 / 1024:.1f} MB in {elapsed:.1f}s, "
+            f"{indexed / elapsed:.2f} files/s, {total_size / 1024 / 1024 / elapsed:.2f} MB/s"
+        )
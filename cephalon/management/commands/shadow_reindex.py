@@ -0,0 +1,214 @@
+import re
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from cephalon.models import ProjectFileContent, ProjectFile, FileBlob
+from cephalon.utils import iter_content_segments, get_segment_text, open_stored_file
+
+LIVE_TABLE = ProjectFileContent._meta.db_table
+SHADOW_TABLE = f"{LIVE_TABLE}_shadow"
+OLD_TABLE = f"{LIVE_TABLE}_old"
+COLUMNS = "data, project_file_id, blob_id, created_at, updated_at, chunk_hash, search_vector"
+
+
+def table_exists(cursor, table: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [table])
+    return cursor.fetchone()[0]
+
+
+def get_constraints(cursor, table: str, types: str) -> list[tuple[str, str]]:
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass "
+        "AND contype = ANY(%s) ORDER BY conname", [table, list(types)]
+    )
+    return cursor.fetchall()
+
+
+def get_indexes(cursor, table: str) -> list[tuple[str, str]]:
+    """
+    Return the name and definition of the indexes of a table that do not back a constraint
+    """
+    cursor.execute(
+        "SELECT i.indexname, i.indexdef FROM pg_indexes i WHERE i.tablename = %s AND NOT EXISTS "
+        "(SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname AND c.conrelid = %s::regclass) "
+        "ORDER BY i.indexname", [table, table]
+    )
+    return cursor.fetchall()
+
+
+def get_owner_signatures(cursor, table: str) -> dict:
+    cursor.execute(
+        f"SELECT project_file_id, blob_id, count(*), max(id) FROM {table} GROUP BY project_file_id, blob_id"
+    )
+    return {(row[0], row[1]): row[2:] for row in cursor.fetchall()}
+
+
+def with_suffix(name: str, suffix: str) -> str:
+    return f"{name[:63 - len(suffix)]}{suffix}"
+
+
+def without_suffix(name: str, suffix: str) -> str:
+    return name[:-len(suffix)] if name.endswith(suffix) else name
+
+
+class Command(BaseCommand):
+    """
+    A command to rebuild the file content index in a shadow table and swap it in. Searches keep using the current
+    index while the shadow table is filled in throttled batches with the current segment size settings and the
+    database default_text_search_config. Content written during the build is caught up under a write lock right
+    before the swap, the replaced table is kept so the swap can be rolled back.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Number of files indexed per batch')
+        parser.add_argument('--sleep', type=float, default=0.1, help='Seconds to wait between batches')
+        parser.add_argument('--rollback', action='store_true', help='Swap the previous index back in')
+        parser.add_argument('--drop-old', action='store_true', help='Drop the index kept from the last swap')
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            if options['drop_old']:
+                cursor.execute(f"DROP TABLE IF EXISTS {OLD_TABLE}")
+                self.stdout.write(f"dropped {OLD_TABLE}")
+            elif options['rollback']:
+                self.rollback(cursor)
+            else:
+                self.rebuild(cursor, options['batch_size'], options['sleep'])
+
+    def rebuild(self, cursor, batch_size: int, sleep: float):
+        if table_exists(cursor, OLD_TABLE):
+            raise CommandError(f"{OLD_TABLE} is kept from an earlier swap, run with --drop-old or --rollback first")
+        cursor.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE}")
+        cursor.execute(f"CREATE TABLE {SHADOW_TABLE} (LIKE {LIVE_TABLE} INCLUDING DEFAULTS INCLUDING IDENTITY)")
+        signatures = get_owner_signatures(cursor, LIVE_TABLE)
+        owners = sorted(signatures, key=lambda owner: (owner[0] or 0, owner[1] or 0))
+
+        started = time.monotonic()
+        rows = 0
+        for i in range(0, len(owners), batch_size):
+            with transaction.atomic():
+                for owner in owners[i:i + batch_size]:
+                    rows += self.index_owner(cursor, SHADOW_TABLE, owner)
+            done = min(i + batch_size, len(owners))
+            elapsed = time.monotonic() - started
+            self.stdout.write(f"indexed {done}/{len(owners)} files, {rows} segments, {rows / elapsed:.1f} segments/s")
+            if sleep and done < len(owners):
+                time.sleep(sleep)
+
+        self.stdout.write("creating indexes")
+        for name, definition in get_constraints(cursor, LIVE_TABLE, "pu"):
+            cursor.execute(f"ALTER TABLE {SHADOW_TABLE} ADD CONSTRAINT {with_suffix(name, '_shadow')} {definition}")
+        for name, definition in get_indexes(cursor, LIVE_TABLE):
+            cursor.execute(self.retarget_index(definition, name, with_suffix(name, "_shadow"), SHADOW_TABLE))
+
+        with transaction.atomic():
+            cursor.execute(f"LOCK TABLE {LIVE_TABLE} IN EXCLUSIVE MODE")
+            # files indexed, reindexed or removed while the shadow table was built
+            current = get_owner_signatures(cursor, LIVE_TABLE)
+            changed = [owner for owner in set(current) | set(signatures) if current.get(owner) != signatures.get(owner)]
+            for owner in changed:
+                self.clear_owner(cursor, SHADOW_TABLE, owner)
+                if owner in current:
+                    self.index_owner(cursor, SHADOW_TABLE, owner)
+            self.stdout.write(f"caught up {len(changed)} changed files")
+            self.swap(cursor, SHADOW_TABLE, "_shadow", OLD_TABLE, "_old")
+        self.stdout.write(f"swapped in the new index, the previous one is kept as {OLD_TABLE}")
+
+    def rollback(self, cursor):
+        if not table_exists(cursor, OLD_TABLE):
+            raise CommandError(f"{OLD_TABLE} does not exist, there is nothing to roll back")
+        cursor.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE}")
+        with transaction.atomic():
+            cursor.execute(f"LOCK TABLE {LIVE_TABLE} IN EXCLUSIVE MODE")
+            # files indexed after the swap are not in the previous index yet
+            cursor.execute(f"SELECT max(id) FROM {OLD_TABLE}")
+            last_id = cursor.fetchone()[0] or 0
+            cursor.execute(
+                f"SELECT DISTINCT project_file_id, blob_id FROM {LIVE_TABLE} WHERE id > %s", [last_id]
+            )
+            for owner in cursor.fetchall():
+                self.clear_owner(cursor, OLD_TABLE, owner)
+                self.index_owner(cursor, OLD_TABLE, owner)
+            self.swap(cursor, OLD_TABLE, "_old", SHADOW_TABLE, "_shadow")
+        self.stdout.write(f"rolled back to the previous index, the replaced one is kept as {SHADOW_TABLE}")
+
+    def swap(self, cursor, replacement: str, replacement_suffix: str, retired: str, retired_suffix: str):
+        """
+        Swap the replacement table in for the content table inside the current transaction. The names of indexes and
+        constraints move with the table, foreign keys are only kept on the live table as deleting a file does not
+        cascade into the retired one.
+        """
+        # pending deferred foreign key checks would block altering the tables
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        cursor.execute(f"LOCK TABLE {replacement} IN ACCESS EXCLUSIVE MODE")
+        for column, model in (("project_file_id", ProjectFile), ("blob_id", FileBlob)):
+            cursor.execute(
+                f"DELETE FROM {replacement} r WHERE r.{column} IS NOT NULL AND NOT EXISTS "
+                f"(SELECT 1 FROM {model._meta.db_table} o WHERE o.id = r.{column})"
+            )
+        for name, definition in get_constraints(cursor, LIVE_TABLE, "f"):
+            cursor.execute(f"ALTER TABLE {LIVE_TABLE} DROP CONSTRAINT {name}")
+            cursor.execute(f"ALTER TABLE {replacement} ADD CONSTRAINT {name} {definition}")
+        for name, _ in get_constraints(cursor, LIVE_TABLE, "pu"):
+            cursor.execute(f"ALTER TABLE {LIVE_TABLE} RENAME CONSTRAINT {name} TO {with_suffix(name, retired_suffix)}")
+        for name, _ in get_indexes(cursor, LIVE_TABLE):
+            cursor.execute(f"ALTER INDEX {name} RENAME TO {with_suffix(name, retired_suffix)}")
+        for name, _ in get_constraints(cursor, replacement, "pu"):
+            cursor.execute(
+                f"ALTER TABLE {replacement} RENAME CONSTRAINT {name} TO {without_suffix(name, replacement_suffix)}"
+            )
+        for name, _ in get_indexes(cursor, replacement):
+            cursor.execute(f"ALTER INDEX {name} RENAME TO {without_suffix(name, replacement_suffix)}")
+        # ids handed out after the swap stay above every id of the retired table
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST((SELECT COALESCE(max(id), 1) FROM {LIVE_TABLE}), "
+            f"(SELECT COALESCE(max(id), 1) FROM {replacement})))", [replacement]
+        )
+        cursor.execute(f"ALTER TABLE {LIVE_TABLE} RENAME TO {retired}")
+        cursor.execute(f"ALTER TABLE {replacement} RENAME TO {LIVE_TABLE}")
+
+    def retarget_index(self, definition: str, name: str, new_name: str, table: str) -> str:
+        definition = definition.replace(f"INDEX {name} ON", f"INDEX {new_name} ON", 1)
+        return re.sub(rf" ON (ONLY )?(\S+\.)?{LIVE_TABLE} ", f" ON {table} ", definition, count=1)
+
+    def clear_owner(self, cursor, table: str, owner: tuple):
+        cursor.execute(
+            f"DELETE FROM {table} WHERE project_file_id IS NOT DISTINCT FROM %s AND blob_id IS NOT DISTINCT FROM %s",
+            list(owner)
+        )
+
+    def index_owner(self, cursor, table: str, owner: tuple) -> int:
+        """
+        Index the file of a content owner into the given table and return the number of segments written
+        """
+        project_file_id, blob_id = owner
+        if blob_id:
+            source = FileBlob.objects.filter(id=blob_id).first()
+        else:
+            source = ProjectFile.objects.filter(id=project_file_id).first()
+        if not source or not source.file:
+            return 0
+        try:
+            f = open_stored_file(source.file.path)
+        except FileNotFoundError:
+            self.stderr.write(f"missing file for {source}, skipped")
+            return 0
+        count = 0
+        rows = []
+        with f:
+            for chunk_hash, segment in iter_content_segments(f):
+                data = get_segment_text(segment)
+                rows.append([data, project_file_id, blob_id, chunk_hash, data])
+                if len(rows) >= 100:
+                    count += self.insert_segments(cursor, table, rows)
+                    rows = []
+        return count + self.insert_segments(cursor, table, rows)
+
+    def insert_segments(self, cursor, table: str, rows: list) -> int:
+        if rows:
+            cursor.executemany(
+                f"INSERT INTO {table} ({COLUMNS}) VALUES (%s, %s, %s, now(), now(), %s, to_tsvector(%s))", rows
+            )
+        return len(rows)
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0033_analysisgroup_project'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='received_chunks',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0034_chunkedupload_received_chunks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='encoding',
+            field=models.CharField(choices=[('identity', 'identity'), ('gzip', 'gzip'), ('zstd', 'zstd')], default='identity', max_length=8),
+        ),
+    ]
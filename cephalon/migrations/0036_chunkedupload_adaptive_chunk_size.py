@@ -0,0 +1,28 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0035_chunkedupload_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='block_size',
+            field=models.BigIntegerField(default=1048576),
+        ),
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='chunk_errors',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='throughput',
+            field=models.FloatField(default=0),
+        ),
+    ]
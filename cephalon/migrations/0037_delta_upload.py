@@ -0,0 +1,29 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0036_chunkedupload_adaptive_chunk_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='base_file',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='delta_uploads', to='cephalon.projectfile'),
+        ),
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='block_manifest',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='projectfile',
+            name='block_manifest',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
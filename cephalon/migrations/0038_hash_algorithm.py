@@ -0,0 +1,28 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0037_delta_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='hash_algorithm',
+            field=models.CharField(choices=[('sha1', 'sha1'), ('blake2b', 'blake2b')], default='sha1', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='projectfile',
+            name='hash_algorithm',
+            field=models.CharField(choices=[('sha1', 'sha1'), ('blake2b', 'blake2b')], default='sha1', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='searchresult',
+            name='hash_algorithm',
+            field=models.CharField(choices=[('sha1', 'sha1'), ('blake2b', 'blake2b')], default='sha1', max_length=10),
+        ),
+    ]
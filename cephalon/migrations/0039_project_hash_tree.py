@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0038_hash_algorithm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='hash_tree',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0039_project_hash_tree'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.TextField()),
+                ('hash_algorithm', models.CharField(default='sha1', max_length=10)),
+                ('file', models.FileField(blank=True, null=True, upload_to='cephalon/blobs/')),
+                ('size', models.BigIntegerField(default=0)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='fileblob',
+            constraint=models.UniqueConstraint(fields=('hash_algorithm', 'hash'), name='unique_blob_hash'),
+        ),
+        migrations.AddField(
+            model_name='projectfile',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='project_files', to='cephalon.fileblob'),
+        ),
+        migrations.AddField(
+            model_name='projectfilecontent',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='content', to='cephalon.fileblob'),
+        ),
+    ]
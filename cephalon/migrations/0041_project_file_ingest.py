@@ -0,0 +1,28 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0040_file_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectfile',
+            name='ingest_job_id',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='projectfile',
+            name='ingest_progress',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='projectfile',
+            name='ingest_status',
+            field=models.CharField(choices=[('idle', 'idle'), ('queued', 'queued'), ('running', 'running'), ('complete', 'complete'), ('failed', 'failed')], default='idle', max_length=8),
+        ),
+    ]
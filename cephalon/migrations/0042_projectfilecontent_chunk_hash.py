@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0041_project_file_ingest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectfilecontent',
+            name='chunk_hash',
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0042_projectfilecontent_chunk_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='projectfile',
+            name='ingest_checkpoint',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0043_projectfile_ingest_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apikeyremote',
+            name='last_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='apikeyremote',
+            name='sync',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='apikeyremote',
+            name='sync_max_rate',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
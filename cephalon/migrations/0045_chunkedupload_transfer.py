@@ -0,0 +1,18 @@
+# Generated by Django 5.0.1 on 2026-10-19 14:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0044_apikeyremote_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='transfer',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.1 on 2026-10-19 15:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cephalon', '0045_chunkedupload_transfer'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='project',
+            name='hash_tree',
+        ),
+        migrations.CreateModel(
+            name='ProjectHashNode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.IntegerField()),
+                ('index', models.IntegerField()),
+                ('hash', models.TextField()),
+                ('file_id', models.BigIntegerField(blank=True, null=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hash_nodes', to='cephalon.project')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['project', 'level', 'index'], name='cephalon_pr_project_e6c75e_idx'), models.Index(fields=['project', 'file_id'], name='cephalon_pr_project_80a810_idx')],
+            },
+        ),
+    ]
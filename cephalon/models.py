@@ -1,22 +1,39 @@
+import bisect
+import copy
+from collections import defaultdict, Counter
+import gzip
+import io
 import os
 import re
+import shutil
+import time
 import uuid
-from io import BytesIO
 
 import httpx
 from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
+from django.core.files.base import ContentFile
+from django.db import models, transaction
+from django.db.models.signals import post_save, post_delete, post_init, m2m_changed
 from django.dispatch import receiver
 from django.contrib.postgres.search import SearchVectorField, SearchVector
 from django.contrib.postgres.indexes import GinIndex
-from cephalon.utils import create_signed_token, decode_signed_token, create_api_key, verify_api_key
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+from cephalon.utils import create_signed_token, decode_signed_token, create_api_key, verify_api_key, \
+    Sha512ApiKeyHasher, TTLCache, invalidate_cache_scopes, get_block_manifest, get_hasher, hash_file, \
+    update_hasher_from_file, iter_content_segments, get_segment_text, merkle_leaf, build_merkle_levels, get_merkle_root, \
+    get_merkle_bucket, merkle_parent, build_bucketed_merkle_tree, \
+    open_stored_file, encrypt_file, compress_file
 from django.conf import settings
+from cephalon.transfer import ChunkedUploadSender
 import hashlib
 import re
 
+api_key_cache = TTLCache(maxsize=settings.API_KEY_CACHE_SIZE, ttl=settings.API_KEY_CACHE_TTL)
+upload_hash_cache = TTLCache(maxsize=256, ttl=3600)
+
 # Create your models here.
 class Project(models.Model):
     """
@@ -45,16 +62,94 @@ class Project(models.Model):
         return f"{self.name} {self.created_at}"
 
     def calculate_project_hash(self):
-        hasher = hashlib.sha1()
-        for file in self.files.all():
-            with open(file.file.path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hasher.update(chunk)
-        return hasher.hexdigest()
+        """
+        a method to compute the root of the merkle tree of the project from the stored hashes of its files, no file
+        content is read
+        """
+        leaves = [merkle_leaf(file_hash) for file_hash in self.files.values_list("hash", flat=True)]
+        return get_hash_tree_root(build_bucketed_merkle_tree(leaves, PROJECT_HASH_TREE_DEPTH))
 
     def update_project_hash(self):
-        self.hash = self.calculate_project_hash()
-        self.save()
+        with transaction.atomic():
+            self.hash = self.rebuild_hash_tree()
+            self.save()
+
+    def rebuild_hash_tree(self):
+        """
+        a method to replace the stored merkle tree of the project with one built from the hashes of its files and
+        return its root. The row has to be locked by the caller.
+        """
+        files = [(file_id, merkle_leaf(file_hash)) for file_id, file_hash in self.files.values_list("id", "hash")]
+        nodes = build_bucketed_merkle_tree([leaf for _, leaf in files], PROJECT_HASH_TREE_DEPTH)
+        self.hash_nodes.all().delete()
+        ProjectHashNode.objects.bulk_create(
+            [ProjectHashNode(project=self, level=0, index=get_merkle_bucket(leaf, PROJECT_HASH_TREE_DEPTH),
+                             file_id=file_id, hash=leaf) for file_id, leaf in files] +
+            [ProjectHashNode(project=self, level=level, index=index, hash=node_hash)
+             for (level, index), node_hash in nodes.items()]
+        )
+        return get_hash_tree_root(nodes)
+
+    def set_file_hash(self, file_id: int, file_hash: str = None, remove: bool = False):
+        """
+        a method to update the stored merkle tree after one file of the project changed. Only the leaf of the file, the
+        buckets it left or joined and their paths up to the root are read and written, a project without a stored tree
+        gets one built from all its files. The row has to be locked by the caller.
+        """
+        if not self.hash_nodes.exists():
+            self.hash = self.rebuild_hash_tree()
+            return
+        leaves = self.hash_nodes.filter(level=0, file_id=file_id)
+        buckets = set(leaves.values_list("index", flat=True))
+        leaves.delete()
+        if not remove:
+            leaf = merkle_leaf(file_hash)
+            bucket = get_merkle_bucket(leaf, PROJECT_HASH_TREE_DEPTH)
+            ProjectHashNode.objects.create(project=self, level=0, index=bucket, file_id=file_id, hash=leaf)
+            buckets.add(bucket)
+        for bucket in buckets:
+            self.update_hash_tree_path(bucket)
+        root = self.hash_nodes.filter(level=PROJECT_HASH_TREE_DEPTH + 1).values_list("hash", flat=True).first()
+        self.hash = root or get_merkle_root([])
+
+    def update_hash_tree_path(self, bucket: int):
+        """
+        a method to recompute the node of a bucket from its leaves and the nodes on the path from it to the root from
+        their stored siblings
+        """
+        leaves = sorted(self.hash_nodes.filter(level=0, index=bucket).values_list("hash", flat=True))
+        node = get_merkle_root(build_merkle_levels(leaves)) if leaves else ""
+        path = [(level, bucket >> (level - 1)) for level in range(1, PROJECT_HASH_TREE_DEPTH + 2)]
+        siblings = models.Q()
+        for level, index in path[:-1]:
+            siblings |= models.Q(level=level, index=index ^ 1)
+        siblings = {(level, index): node_hash for level, index, node_hash in
+                    self.hash_nodes.filter(siblings).values_list("level", "index", "hash")}
+        nodes = []
+        for level, index in path:
+            if node:
+                nodes.append(ProjectHashNode(project=self, level=level, index=index, hash=node))
+            sibling = siblings.get((level, index ^ 1), "")
+            node = merkle_parent(sibling, node) if index % 2 else merkle_parent(node, sibling)
+        on_path = models.Q()
+        for level, index in path:
+            on_path |= models.Q(level=level, index=index)
+        self.hash_nodes.filter(on_path).delete()
+        ProjectHashNode.objects.bulk_create(nodes)
+
+    @classmethod
+    def update_file_hash(cls, project_id: int, file_id: int, file_hash: str = None, remove: bool = False):
+        """
+        a method to apply a change of one file to the stored merkle tree of a project without triggering the save
+        signals of the project
+        """
+        with transaction.atomic():
+            project = cls.objects.select_for_update().filter(id=project_id).first()
+            if not project:
+                return
+            project.set_file_hash(file_id, file_hash, remove)
+            cls.objects.filter(id=project_id).update(hash=project.hash)
+        invalidate_cache_scopes("projects", f"project:{project_id}")
 
     def get_topics(self):
         """
@@ -64,6 +159,108 @@ class Project(models.Model):
         return topics
 
 
+PROJECT_HASH_TREE_DEPTH = 8
+
+
+def get_hash_tree_root(nodes: dict[tuple[int, int], str]) -> str:
+    return nodes.get((PROJECT_HASH_TREE_DEPTH + 1, 0)) or get_merkle_root([])
+
+
+class ProjectHashNode(models.Model):
+    """
+    A model to store one node of the merkle tree of a project. Level 0 holds the leaf of every file of the project with
+    the bucket its leaf falls into as index, level 1 the root of the leaves of each bucket and the levels above a binary
+    tree of fixed shape over the buckets up to the root. Empty nodes are not stored.
+    """
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="hash_nodes")
+    level = models.IntegerField()
+    index = models.IntegerField()
+    hash = models.TextField()
+    file_id = models.BigIntegerField(blank=True, null=True)
+
+    class Meta:
+        ordering = ["id"]
+        app_label = "cephalon"
+        indexes = [
+            models.Index(fields=["project", "level", "index"]),
+            models.Index(fields=["project", "file_id"]),
+        ]
+
+    def __str__(self):
+        return f"{self.project_id} {self.level}:{self.index} {self.hash}"
+
+    def __repr__(self):
+        return f"{self.project_id} {self.level}:{self.index} {self.hash}"
+
+
+class FileBlob(models.Model):
+    """
+    A model to store one physical copy of a file content addressed by its hash. Project files with the same content
+    point to the same blob and share its file and its stored content rows, the blob is removed with its last reference.
+    """
+    hash = models.TextField()
+    hash_algorithm = models.CharField(max_length=10, default="sha1")
+    file = models.FileField(upload_to="cephalon/blobs/", blank=True, null=True)
+    size = models.BigIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+        app_label = "cephalon"
+        constraints = [
+            models.UniqueConstraint(fields=["hash_algorithm", "hash"], name="unique_blob_hash")
+        ]
+
+    def __str__(self):
+        return f"{self.hash_algorithm}:{self.hash}"
+
+    def __repr__(self):
+        return f"{self.hash_algorithm}:{self.hash}"
+
+    @classmethod
+    def acquire(cls, hash: str, hash_algorithm: str, size: int, place_file, encrypt: bool = False,
+                compress: bool = False):
+        """
+        a method to take a reference on the blob of a content. When no blob exists yet place_file is called with the
+        new blob to put the already verified content into its file field. With compress and encrypt a new blob file is
+        kept compressed and the blob file is kept encrypted at rest, which every reader going through open_stored_file
+        handles for the other references as well.
+        """
+        with transaction.atomic():
+            blob, created = cls.objects.select_for_update().get_or_create(
+                hash=hash, hash_algorithm=hash_algorithm, defaults={"size": size}
+            )
+            if created or not blob.file:
+                place_file(blob)
+                if compress:
+                    compress_file(blob.file.path)
+            if encrypt:
+                encrypt_file(blob.file.path)
+            blob.ref_count += 1
+            blob.save()
+        return blob
+
+    @classmethod
+    def release(cls, blob_id: int):
+        """
+        a method to drop a reference on a blob and delete its file and content rows once nothing refers to it
+        """
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(id=blob_id).first()
+            if not blob:
+                return
+            blob.ref_count -= 1
+            if blob.ref_count > 0:
+                blob.save(update_fields=["ref_count"])
+                return
+            blob.delete()
+        blob.file.delete(save=False)
+
+
+COMPRESSIBLE_FILE_TYPES = ("csv", "tsv", "txt", "json")
+
+
 class ProjectFile(models.Model):
     """
     A model to store file data
@@ -95,6 +292,24 @@ class ProjectFile(models.Model):
     file = models.FileField(upload_to="cephalon/files/", blank=True, null=True)
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name="files", blank=True, null=True)
     load_file_content = models.BooleanField(default=False)
+    block_manifest = models.JSONField(blank=True, null=True)
+    hash_algorithm_choices = [
+        ("sha1", "sha1"),
+        ("blake2b", "blake2b"),
+    ]
+    hash_algorithm = models.CharField(max_length=10, choices=hash_algorithm_choices, default="sha1")
+    blob = models.ForeignKey(FileBlob, on_delete=models.PROTECT, related_name="project_files", blank=True, null=True)
+    ingest_status_choices = [
+        ("idle", "idle"),
+        ("queued", "queued"),
+        ("running", "running"),
+        ("complete", "complete"),
+        ("failed", "failed"),
+    ]
+    ingest_status = models.CharField(max_length=8, choices=ingest_status_choices, default="idle")
+    ingest_progress = models.IntegerField(default=0)
+    ingest_job_id = models.TextField(blank=True, null=True)
+    ingest_checkpoint = models.JSONField(blank=True, null=True)
 
     class Meta:
         ordering = ["id"]
@@ -107,52 +322,274 @@ class ProjectFile(models.Model):
         return f"{self.name} {self.created_at}"
 
     def delete(self, using=None, keep_parents=False):
-        self.file.delete()
+        # a shared blob file is released by the post_delete signal instead
+        if not self.blob_id:
+            self.file.delete()
         super().delete(using=using, keep_parents=keep_parents)
 
+    def attach_blob(self, blob: FileBlob):
+        """
+        a method to point the file at a blob it holds a reference on, the reference on the previous blob is dropped
+        """
+        previous_blob_id = self.blob_id
+        self.blob = blob
+        self.file.name = blob.file.name
+        self.hash = blob.hash
+        self.hash_algorithm = blob.hash_algorithm
+        if previous_blob_id and previous_blob_id != blob.id:
+            transaction.on_commit(lambda: FileBlob.release(previous_blob_id))
+        elif previous_blob_id == blob.id:
+            FileBlob.release(blob.id)
+
+    def store_in_blob(self):
+        """
+        a method to move the verified file of this project file into the content addressed store. When the content is
+        already stored the duplicate file is removed and the existing blob is shared.
+        """
+        name = self.file.name
+        blob = FileBlob.acquire(self.hash, self.hash_algorithm, self.get_data_size(),
+                                lambda b: setattr(b, "file", name), self.is_encrypted_at_rest(),
+                                self.is_compressed_at_rest())
+        if blob.file.name != name:
+            self.file.storage.delete(name)
+        self.attach_blob(blob)
+
     def save(self, *args, **kwargs):
         # calculate sha1 hash of file
         return super().save(*args, **kwargs)
 
+    def is_encrypted_at_rest(self) -> bool:
+        return bool(self.project_id and self.project.encrypted)
+
+    def is_compressed_at_rest(self) -> bool:
+        return settings.FILE_STORAGE_COMPRESSION and self.file_type in COMPRESSIBLE_FILE_TYPES
+
+    def open_data(self, mode: str = "rb"):
+        """
+        a method to open the content of the file for reading, a file kept encrypted or compressed at rest is decrypted
+        and decompressed as it is read
+        """
+        f = open_stored_file(self.file.path)
+        return io.TextIOWrapper(f, encoding="utf-8") if "t" in mode else f
+
+    def get_data_size(self) -> int:
+        """
+        a method to get the size of the content of the file, which differs from the size of the stored file when it is
+        encrypted or compressed
+        """
+        if self.blob_id:
+            return self.blob.size
+        with open_stored_file(self.file.path) as f:
+            return f.seek(0, io.SEEK_END)
+
     def save_altered(self, *args, **kwargs):
-        # calculate sha1 hash of file
+        # a file replaced directly no longer is the content of its blob
+        if self.blob_id and self.file.name != self.blob.file.name:
+            blob_id = self.blob_id
+            self.blob = None
+            transaction.on_commit(lambda: FileBlob.release(blob_id))
+        # calculate hash of the content of the file, which may already be kept encrypted or compressed
         if self.file:
-            hasher = hashlib.sha1()
-            with open(self.file.path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hasher.update(chunk)
+            hasher = get_hasher(self.hash_algorithm)
+            with self.open_data() as f:
+                for data in iter(lambda: f.read(settings.FILE_READ_BUFFER_SIZE), b""):
+                    hasher.update(data)
             hash = hasher.hexdigest()
-            if hash != self.hash:
-                self.hash = hash
-                if self.load_file_content:
-                    self.load_file()
+            changed = hash != self.hash
+            self.hash = hash
+            # a replaced file that has to be kept encrypted or compressed goes into the content addressed store like an
+            # uploaded one, a plain file keeps its own segments for an incremental reindex
+            if not self.blob_id and (self.is_encrypted_at_rest() or self.is_compressed_at_rest()):
+                self.store_in_blob()
+            if changed and self.load_file_content:
+                super().save(*args, **kwargs)
+                return self.enqueue_ingest()
 
         return super().save(*args, **kwargs)
 
-    def load_file(self):
-        with open(self.file.path, "rt") as f:
-            content = f.read()
-            content = re.split(r"[\s\n\t]", content)
-            # segment file content into chunks ensure that the segment won't cut off a word by 200*200 words
-            for i in range(0, len(content), 200 * 200):
-                if i + 200 * 200 > len(content):
-                    ProjectFileContent.objects.create(project_file=self, data=" ".join(content[i:]))
+    def get_block_manifest(self) -> list[list]:
+        """
+        a method to get the content defined blocks of the file, the manifest is stored with the hash it was made for
+        and only recomputed after the file changed
+        """
+        if not self.block_manifest or self.block_manifest.get("hash") != self.hash:
+            self.block_manifest = {"hash": self.hash, "blocks": get_block_manifest(self.file.path)}
+            ProjectFile.objects.filter(id=self.id).update(block_manifest=self.block_manifest)
+        return self.block_manifest["blocks"]
+
+    def load_file(self, progress=None, deadline: float = None) -> bool:
+        """
+        a method to index the file content as content defined segments. Segments already stored with the same chunk
+        hash are kept, so after an edit only the segments around the change are inserted and deleted. New segments are
+        committed in batches together with a checkpoint of the byte offset reached and of the segments still missing,
+        once the deadline from time.monotonic() has passed the method returns False and the next call seeks to the
+        offset of the checkpoint without reading the file before it. The last batch and the removal of stale segments
+        share one transaction.
+        """
+        # content of a blob is stored once and shared by every project file pointing at it
+        owner = {"blob": self.blob} if self.blob_id else {"project_file": self}
+        if self.blob_id and not self.ingest_checkpoint and self.blob.content.exists() and not \
+                self.blob.project_files.exclude(id=self.id).filter(ingest_status__in=["queued", "running"]).exists():
+            if self.content.exists():
+                self.content.all().delete()
+            return True
+
+        # a checkpoint only holds for the version of the file it was made for
+        checkpoint = self.ingest_checkpoint if (self.ingest_checkpoint or {}).get("hash") == self.hash else {}
+        offset = checkpoint.get("offset", 0)
+        if "stale" in checkpoint:
+            missing = None if checkpoint["missing"] is None else Counter(checkpoint["missing"])
+            stale = checkpoint["stale"]
+        else:
+            missing, stale = self.get_missing_segments(owner)
+            # the comparison read the whole file, a job out of time leaves the rest to the next job
+            if missing is not None:
+                self.set_ingest_checkpoint(self.get_load_checkpoint(offset, missing, stale))
+                if deadline is not None and time.monotonic() > deadline:
+                    return False
+        size = self.get_data_size() or 1
+        rows = []
+        with self.open_data() as f:
+            # segment boundaries only depend on the content after the previous boundary
+            f.seek(offset)
+            for chunk_hash, segment in iter_content_segments(f):
+                # the file position can be past the segment when it was cut at the maximum size
+                offset += len(segment)
+                if missing is None:
+                    rows.append(ProjectFileContent(**owner, chunk_hash=chunk_hash, data=get_segment_text(segment)))
+                elif missing[chunk_hash]:
+                    missing[chunk_hash] -= 1
+                    rows.append(ProjectFileContent(**owner, chunk_hash=chunk_hash, data=get_segment_text(segment)))
+                if len(rows) >= 100:
+                    with transaction.atomic():
+                        ProjectFileContent.create_segments(rows)
+                        self.set_ingest_checkpoint(self.get_load_checkpoint(offset, missing, stale))
+                    rows = []
+                    if deadline is not None and time.monotonic() > deadline:
+                        return False
+                if progress:
+                    progress(offset * 100 // size)
+
+        with transaction.atomic():
+            ProjectFileContent.create_segments(rows)
+            if stale:
+                ProjectFileContent.objects.filter(id__in=stale).delete()
+            if self.blob_id:
+                self.content.all().delete()
+            self.set_ingest_checkpoint(None)
+        return True
+
+    def get_missing_segments(self, owner: dict) -> tuple[Counter | None, list[int]]:
+        """
+        a method to compare the segments of the file with the stored ones and return how often each segment hash has
+        to be inserted and the ids of the stored rows no segment uses anymore. Without any stored row every segment is
+        missing and None is returned instead of reading the file.
+        """
+        stored = defaultdict(list)
+        for content_id, chunk_hash in ProjectFileContent.objects.filter(**owner).values_list("id", "chunk_hash"):
+            stored[chunk_hash].append(content_id)
+        if not stored:
+            return None, []
+        # every segment of the new version reuses one stored row with the same hash, the other rows are stale
+        missing = Counter()
+        with self.open_data() as f:
+            for chunk_hash, _ in iter_content_segments(f):
+                if stored.get(chunk_hash):
+                    stored[chunk_hash].pop()
                 else:
-                    ProjectFileContent.objects.create(project_file=self, data=" ".join(content[i:i + 200 * 200]))
+                    missing[chunk_hash] += 1
+        return missing, [content_id for ids in stored.values() for content_id in ids]
+
+    def get_load_checkpoint(self, offset: int, missing: Counter | None, stale: list[int]) -> dict:
+        return {"hash": self.hash, "offset": offset, "stale": stale,
+                "missing": None if missing is None else {h: n for h, n in missing.items() if n > 0}}
+
+    def set_ingest_checkpoint(self, checkpoint: dict | None):
+        self.ingest_checkpoint = checkpoint
+        ProjectFile.objects.filter(id=self.id).update(ingest_checkpoint=checkpoint)
+
+    def enqueue_ingest(self, session_id: str = None, client_id: str = None):
+        """
+        a method to load the file content into the database on the ingest queue instead of the current request. The
+        job id and status are stored on the file, with INGEST_IN_BACKGROUND turned off the content is loaded right away.
+        """
+        from cephalon.tasks import ingest_project_file
+        self.ingest_job_id = str(uuid.uuid4())
+        self.ingest_status = "queued"
+        # a resumed ingestion keeps the progress it reached
+        if not self.ingest_checkpoint:
+            self.ingest_progress = 0
+        ProjectFile.objects.filter(id=self.id).update(
+            ingest_job_id=self.ingest_job_id, ingest_status=self.ingest_status, ingest_progress=self.ingest_progress
+        )
+        if settings.INGEST_IN_BACKGROUND:
+            job_id = self.ingest_job_id
+            transaction.on_commit(lambda: ingest_project_file.delay(self.id, session_id, client_id, job_id=job_id))
+        else:
+            ingest_project_file(self.id, session_id, client_id)
+            self.refresh_from_db(fields=["ingest_status", "ingest_progress", "load_file_content"])
+
+    def ingest(self, progress=None, deadline: float = None) -> bool:
+        """
+        a method to load the file content while keeping the ingest status and progress of the file up to date, returns
+        False when the deadline passed before the whole file was loaded
+        """
+        def update_progress(percent: int):
+            if percent != self.ingest_progress:
+                self.ingest_progress = percent
+                ProjectFile.objects.filter(id=self.id).update(ingest_progress=percent)
+                if progress:
+                    progress(self)
+
+        self.ingest_status = "running"
+        ProjectFile.objects.filter(id=self.id).update(ingest_status="running")
+        try:
+            if not self.load_file(update_progress, deadline):
+                return False
+        except Exception:
+            self.ingest_status = "failed"
+            ProjectFile.objects.filter(id=self.id).update(ingest_status="failed")
+            if progress:
+                progress(self)
+            raise
+        self.ingest_status = "complete"
+        self.ingest_progress = 100
+        self.load_file_content = True
+        ProjectFile.objects.filter(id=self.id).update(ingest_status="complete", ingest_progress=100,
+                                                      load_file_content=True)
+        invalidate_cache_scopes(f"project:{self.project_id}:files")
+        if progress:
+            progress(self)
+        return True
 
     def remove_file_content(self):
+        # shared blob content stays for the other references and goes with the blob
         self.content.all().delete()
 
-    @database_sync_to_async
-    def check_file_permission(self, api_key=None):
+    def has_file_permission(self, api_key=None):
         if api_key.access_all:
             return True
-        else:
-            project_access = api_key.access_topics.all().values_list("projects", flat=True)
-            if self.project.id in project_access:
-                return True
-            else:
-                return False
+        return Topic.projects.through.objects.filter(
+            project_id=self.project_id, topic__apikey=api_key
+        ).exists()
+
+    @database_sync_to_async
+    def check_file_permission(self, api_key=None):
+        return self.has_file_permission(api_key)
+
+    @classmethod
+    def get_permitted_file_ids(cls, api_key, file_ids: list[int]) -> set[int]:
+        """
+        a method to check a list of file ids against the topics of an api key in a single query and return the ids that the key is allowed to access
+        """
+        files = cls.objects.filter(id__in=file_ids)
+        if not api_key.access_all:
+            files = files.filter(models.Exists(
+                Topic.projects.through.objects.filter(
+                    project_id=models.OuterRef("project_id"), topic__apikey=api_key
+                )
+            ))
+        return set(files.values_list("id", flat=True))
 
     async def send_to_remote(self, api_key):
         """
@@ -165,32 +602,25 @@ class ProjectFile(models.Model):
             return None
 
 
+    async def send_ranges_to_remote(self, api_key, upload_id: str, node_id: str):
+        """
+        a method to send the ranges of this file claimed by this node in a transfer shared with other nodes
+        """
+        if not await sync_to_async(self.has_file_permission)(api_key):
+            return None
+        decoded_api_key = api_key.decrypt_remote_api_key()
+        host = f"{api_key.remote_pair.protocol}://{api_key.remote_pair.hostname}:{api_key.remote_pair.port}"
+        size = await sync_to_async(self.get_data_size)()
+        async with ChunkedUploadSender(host, decoded_api_key) as sender:
+            return await sender.upload_ranges(self.file.path, upload_id, node_id, size, self.hash)
+
     async def upload_chunked_file(self, api_key):
         decoded_api_key = api_key.decrypt_remote_api_key()
         host = f"{api_key.remote_pair.protocol}://{api_key.remote_pair.hostname}:{api_key.remote_pair.port}"
-        async with httpx.AsyncClient(headers={"X-API-Key": decoded_api_key}) as client:
-            d = await client.post(f"{host}/api/files/chunked", data={
-                            "filename": self.name,
-                            "size": self.file.size,
-                            "data_hash": self.hash,
-                            "file_category": self.file_category
-                        })
-            upload_id = d.json()["upload_id"]
-            with self.file.open("rb") as f:
-                offset = 0
-                while True:
-                    chunk = f.read(d.json()["chunk_size"])
-                    if not chunk:
-                        break
-                    chunk_file = BytesIO(chunk)
-                    progress = await client.post(f"{host}/api/files/chunked/{upload_id}",
-                                                 data={"offset": offset}, files={"chunk": chunk_file})
-                    if progress.json()["status"] == "complete":
-                        break
-                    else:
-                        offset = progress.json()["offset"]
-                result = await client.post(f"{host}/api/files/chunked/{upload_id}/complete", json={"create_file": True})
-                return result.json()
+        size = await database_sync_to_async(self.get_data_size)()
+        async with ChunkedUploadSender(host, decoded_api_key) as sender:
+            return await sender.upload(self.file.path, self.name, size, self.hash, self.file_category,
+                                       complete_json={"create_file": True}, hash_algorithm=self.hash_algorithm)
 
     def get_search_items_from_headline(self):
         if getattr(self, "headline", None):
@@ -232,9 +662,11 @@ class ProjectFileContent(models.Model):
     """
     data = models.TextField(blank=True, null=True)
     project_file = models.ForeignKey(ProjectFile, on_delete=models.CASCADE, related_name="content", blank=True, null=True)
+    blob = models.ForeignKey(FileBlob, on_delete=models.CASCADE, related_name="content", blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     search_vector = SearchVectorField(null=True)
+    chunk_hash = models.CharField(max_length=40, blank=True, null=True)
 
     class Meta:
         ordering = ["id"]
@@ -244,10 +676,20 @@ class ProjectFileContent(models.Model):
         ]
 
     def __str__(self):
-        return f"Content of {self.project_file.name} {self.created_at}"
+        return f"Content of {self.project_file.name if self.project_file else self.blob} {self.created_at}"
 
     def __repr__(self):
-        return f"Content of {self.project_file.name} {self.created_at}"
+        return f"Content of {self.project_file.name if self.project_file else self.blob} {self.created_at}"
+
+    @staticmethod
+    def create_segments(rows: list["ProjectFileContent"]):
+        """
+        a method to insert content rows in bulk and fill their search vector, bulk_create skips the post_save signal
+        """
+        if not rows:
+            return
+        created = ProjectFileContent.objects.bulk_create(rows)
+        ProjectFileContent.objects.filter(id__in=[row.id for row in created]).update(search_vector=SearchVector("data"))
 
 
 
@@ -323,6 +765,26 @@ class APIKey(models.Model):
     def verify_key(self, key: str) -> bool:
         return verify_api_key(key, self.key)
 
+    @classmethod
+    def get_by_key(cls, key: str):
+        """
+        a method to look up the api key matching a raw key. Lookups are served from an in-process cache keyed by the
+        key digest so repeated requests from the same node do not hit the database. Every caller gets its own copy of
+        the cached snapshot.
+        """
+        hashed_key = make_password(key, hasher=Sha512ApiKeyHasher())
+        api_key = api_key_cache.get(hashed_key)
+        if api_key is None:
+            try:
+                api_key = cls.objects.get(key=hashed_key)
+            except cls.DoesNotExist:
+                return None
+            ttl = settings.API_KEY_CACHE_TTL
+            if api_key.expiry:
+                ttl = min(ttl, (api_key.expiry - timezone.now()).total_seconds())
+            api_key_cache.set(hashed_key, api_key, ttl=ttl)
+        return copy.copy(api_key)
+
     def create_api_key(self):
         key = create_api_key()
         self.key = key[0]
@@ -364,7 +826,9 @@ class APIKeyRemote(models.Model):
     hostname = models.TextField(blank=True, null=True)
     protocol = models.TextField(blank=True, null=True)
     port = models.IntegerField(blank=True, null=True)
-
+    sync = models.BooleanField(default=False)
+    sync_max_rate = models.BigIntegerField(blank=True, null=True)
+    last_synced_at = models.DateTimeField(blank=True, null=True)
 
     class Meta:
         ordering = ["id"]
@@ -380,7 +844,8 @@ class APIKeyRemote(models.Model):
 
 class ChunkedUpload(models.Model):
     """
-    A model to store chunked file uploads set default chunk size to 1megabyte
+    A model to store chunked file uploads. Received data is tracked in blocks of block_size, 1 megabyte by default,
+    while chunk_size is the amount of data the sender is asked to put in each request and is adjusted as chunks arrive
     """
     upload_id = models.UUIDField(unique=True, db_index=True, default=uuid.uuid4)
     filename = models.TextField(blank=True, null=True)
@@ -398,6 +863,20 @@ class ChunkedUpload(models.Model):
         ("complete", "complete"),
     ]
     status = models.CharField(max_length=11, choices=status_choices, default="pending")
+    received_chunks = models.BinaryField(blank=True, null=True)
+    encoding_choices = [
+        ("identity", "identity"),
+        ("gzip", "gzip"),
+        ("zstd", "zstd"),
+    ]
+    encoding = models.CharField(max_length=8, choices=encoding_choices, default="identity")
+    block_size = models.BigIntegerField(default=1024 * 1024)
+    throughput = models.FloatField(default=0)
+    chunk_errors = models.IntegerField(default=0)
+    block_manifest = models.JSONField(blank=True, null=True)
+    hash_algorithm = models.CharField(max_length=10, choices=ProjectFile.hash_algorithm_choices, default="sha1")
+    base_file = models.ForeignKey(ProjectFile, on_delete=models.SET_NULL, related_name="delta_uploads", blank=True, null=True)
+    transfer = models.JSONField(blank=True, null=True)
 
     class Meta:
         ordering = ["id"]
@@ -413,6 +892,260 @@ class ChunkedUpload(models.Model):
         self.file.delete()
         super().delete(using=using, keep_parents=keep_parents)
 
+    def get_hasher(self, offset: int):
+        """
+        a method to get the running hash of the first offset bytes of the staged file. The hash state is kept in
+        process memory between chunks and only the part this process has not hashed yet is read back from disk.
+        """
+        state = upload_hash_cache.get(str(self.upload_id))
+        if state and state[0] == offset:
+            return state[1]
+        if state and state[0] < offset:
+            start, hasher = state
+        else:
+            start, hasher = 0, get_hasher(self.hash_algorithm)
+        return update_hasher_from_file(hasher, self.file.path, start, offset - start)
+
+    def write_chunk(self, chunk, offset: int):
+        """
+        a method to stream an uploaded chunk to the staged file at the given offset while updating the running hash
+        """
+        hasher = self.get_hasher(offset)
+        with open(self.file.path, "r+b") as f:
+            f.seek(offset)
+            for data in chunk.chunks():
+                f.write(data)
+                hasher.update(data)
+            self.offset = f.tell()
+            f.truncate()
+        upload_hash_cache.set(str(self.upload_id), (self.offset, hasher))
+        return hasher
+
+    @property
+    def block_count(self) -> int:
+        return -(-self.total_size // self.block_size)
+
+    def get_block_bounds(self, index: int) -> tuple[int, int]:
+        start = index * self.block_size
+        return start, min(start + self.block_size, self.total_size)
+
+    def is_block_received(self, index: int) -> bool:
+        bitmap = bytes(self.received_chunks or b"")
+        return index // 8 < len(bitmap) and bool(bitmap[index // 8] & (1 << (index % 8)))
+
+    def get_missing_blocks(self) -> list[int]:
+        return [i for i in range(self.block_count) if not self.is_block_received(i)]
+
+    def get_chunk_checksum(self, chunk, algorithm: str = None) -> str:
+        """
+        a method to hash an uploaded chunk before anything of it is written so that a corrupted chunk never reaches
+        the staged file
+        """
+        hasher = get_hasher(algorithm or self.hash_algorithm)
+        for data in chunk.chunks():
+            hasher.update(data)
+        return hasher.hexdigest()
+
+    def write_indexed_chunk(self, chunk, index: int):
+        """
+        a method to write a verified chunk starting at the block of the given index in the preallocated staged file.
+        The row has to be locked by the caller and the upload must not be complete, as the staged file of a complete
+        upload is hard linked into the stored blob.
+        """
+        self.write_chunk_at(chunk, self.get_block_bounds(index)[0])
+
+    def write_chunk_at(self, chunk, start: int):
+        with open(self.file.path, "r+b") as f:
+            if os.fstat(f.fileno()).st_size < self.total_size:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(f.fileno(), 0, self.total_size)
+                else:
+                    f.truncate(self.total_size)
+            f.seek(start)
+            for data in chunk.chunks():
+                f.write(data)
+
+    def mark_blocks_received(self, index: int, end: int):
+        """
+        a method to record the blocks from index up to the end offset of a verified chunk in the bitmap of received
+        blocks. The row has to be locked by the caller. The offset is moved to the end of the received prefix of the
+        file and the running hash follows it when this process holds the hash of the previous prefix.
+        """
+        bitmap = bytearray(self.received_chunks or bytes(-(-self.block_count // 8)))
+        for i in range(index, -(-end // self.block_size)):
+            bitmap[i // 8] |= 1 << (i % 8)
+        self.received_chunks = bytes(bitmap)
+        previous_offset = self.offset
+        contiguous = previous_offset // self.block_size
+        while contiguous < self.block_count and self.is_block_received(contiguous):
+            contiguous += 1
+        self.offset = self.get_block_bounds(contiguous - 1)[1] if contiguous else 0
+        state = upload_hash_cache.get(str(self.upload_id))
+        if self.offset > previous_offset and (previous_offset == 0 or (state and state[0] == previous_offset)):
+            upload_hash_cache.set(str(self.upload_id), (self.offset, self.get_hasher(self.offset)))
+
+    def reset_received_blocks(self):
+        """
+        a method to forget every received block after the assembled file did not match its hash so that the sender
+        sends the whole file again instead of finding nothing missing. The row has to be locked by the caller.
+        """
+        self.received_chunks = None
+        self.offset = 0
+        self.status = "in_progress"
+        upload_hash_cache.pop(str(self.upload_id))
+
+    def adjust_chunk_size(self, received: int, elapsed: float):
+        """
+        a method to fold the throughput of the last chunk into a moving average and resize the chunks asked from the
+        sender so that one chunk takes about CHUNKED_UPLOAD_TARGET_SECONDS to arrive. The size is kept a multiple of
+        the block size, grows at most twofold per chunk and stays below CHUNKED_UPLOAD_MAX_CHUNK_SIZE.
+        """
+        sample = received / max(elapsed, 0.001)
+        self.throughput = sample if not self.throughput else 0.3 * sample + 0.7 * self.throughput
+        target = min(self.throughput * settings.CHUNKED_UPLOAD_TARGET_SECONDS, self.chunk_size * 2,
+                     settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE)
+        self.chunk_size = max(int(target) // self.block_size, 1) * self.block_size
+
+    def record_chunk_error(self):
+        """
+        a method to halve the chunk size after a chunk arrived corrupted so that less data is resent on a bad link
+        """
+        self.chunk_errors += 1
+        self.chunk_size = max(self.chunk_size // self.block_size // 2, 1) * self.block_size
+
+    def get_delta_block_bounds(self, index: int) -> tuple[int, int]:
+        start = sum(size for _, size in self.block_manifest[:index])
+        return start, start + self.block_manifest[index][1]
+
+    def get_missing_delta_blocks(self) -> list[int]:
+        """
+        a method to list the blocks of a delta upload that are neither in the base file nor received yet
+        """
+        known = {block_hash for block_hash, _ in self.base_file.get_block_manifest()} if self.base_file else set()
+        return [i for i, (block_hash, _) in enumerate(self.block_manifest)
+                if block_hash not in known and not self.is_block_received(i)]
+
+    def mark_delta_block_received(self, index: int):
+        bitmap = bytearray(self.received_chunks or bytes(-(-len(self.block_manifest) // 8)))
+        bitmap[index // 8] |= 1 << (index % 8)
+        self.received_chunks = bytes(bitmap)
+
+    def assemble_delta(self) -> str:
+        """
+        a method to rebuild the new file of a delta upload in the staged file by copying the blocks it shares with the
+        base file next to the received blocks and return the hash of the result, computed while the file is written
+        """
+        known = {}
+        position = 0
+        for block_hash, size in (self.base_file.get_block_manifest() if self.base_file else []):
+            known.setdefault(block_hash, position)
+            position += size
+        hasher = get_hasher(self.hash_algorithm)
+        with open(self.file.path, "r+b") as f, (open_stored_file(self.base_file.file.path) if known else open(os.devnull, "rb")) as base:
+            f.truncate(self.total_size)
+            position = 0
+            for index, (block_hash, size) in enumerate(self.block_manifest):
+                f.seek(position)
+                if self.is_block_received(index):
+                    data = f.read(size)
+                else:
+                    base.seek(known[block_hash])
+                    data = base.read(size)
+                    f.write(data)
+                hasher.update(data)
+                position += size
+        self.offset = self.total_size
+        return hasher.hexdigest()
+
+    def link_file_to(self, instance, field_name: str = "file"):
+        """
+        a method to place the staged file into the file field of another model instance by hard linking it instead of
+        copying its content. A copy is only made when the storage locations are on different devices.
+        """
+        field_file = getattr(instance, field_name)
+        storage = field_file.storage
+        while True:
+            name = storage.get_available_name(field_file.field.generate_filename(instance, self.filename))
+            path = storage.path(name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.link(self.file.path, path)
+            except FileExistsError:
+                continue
+            except OSError:
+                shutil.copyfile(self.file.path, path)
+            break
+        setattr(instance, field_name, name)
+        return name
+
+    @classmethod
+    def create_transfer(cls, file: dict, session_id: str, client_id: str, pyre_name: str):
+        """
+        a method to create an upload for a file requested by a session that every node holding a file with the same
+        hash can send ranges of. The size is set by the first node that claims a range.
+        """
+        name = file.get("name") or file["hash"]
+        return cls.objects.create(
+            filename=name,
+            hash=file["hash"],
+            hash_algorithm=file.get("hash_algorithm") or settings.FILE_HASH_ALGORITHM,
+            file_category=file.get("file_category"),
+            file=ContentFile(b"", name=name),
+            transfer={"session_id": str(session_id), "client_id": client_id, "pyre_name": pyre_name, "file": file,
+                      "claims": {}},
+        )
+
+    def claim_range(self, claimer: str) -> tuple[int, int] | None:
+        """
+        a method to hand the next range of missing blocks of a shared transfer to one of the nodes sending it and
+        return the index of its first block and the number of blocks. A claimer only asks after it finished or gave up
+        on its last range, so its own claims are free again, as are claims older than CHUNKED_UPLOAD_CLAIM_TIMEOUT.
+        Once every missing block is claimed the oldest range of another claimer is handed out again so that one slow
+        node cannot hold up the end of the transfer. The row has to be locked by the caller.
+        """
+        now = time.time()
+        missing = self.get_missing_blocks()
+        missing_set = set(missing)
+        claims = {index: claim for index, claim in self.transfer.get("claims", {}).items() if int(index) in missing_set}
+        self.transfer["claims"] = claims
+
+        def is_free(index: int) -> bool:
+            claim = claims.get(str(index))
+            return not claim or claim[0] == claimer or now - claim[1] > settings.CHUNKED_UPLOAD_CLAIM_TIMEOUT
+
+        first = next((index for index in missing if is_free(index)), None)
+        extendable = is_free
+        if first is None:
+            others = [int(index) for index, claim in claims.items() if claim[0] != claimer]
+            if not others:
+                return None
+            first = min(others, key=lambda index: claims[str(index)][1])
+            owner = claims[str(first)][0]
+            extendable = lambda index: claims.get(str(index), [None])[0] == owner
+
+        count = 1
+        per_range = max(self.chunk_size // self.block_size, 1)
+        while count < per_range and first + count in missing_set and extendable(first + count):
+            count += 1
+        for index in range(first, first + count):
+            claims[str(index)] = [claimer, now]
+        return first, count
+
+    def complete_transfer(self):
+        """
+        a method to turn a completed shared transfer into a file and make it available to the session that asked for it
+        """
+        file = ProjectFile(name=self.filename, file_category=self.file_category)
+        file.attach_blob(FileBlob.acquire(self.hash, self.hash_algorithm, self.total_size, self.link_file_to,
+                                          compress=file.is_compressed_at_rest()))
+        file.save()
+        session = WebsocketSession.objects.filter(session_id=self.transfer["session_id"]).first()
+        if session:
+            session.files.add(file)
+        self.transfer["file_id"] = file.id
+        self.transfer["claims"] = {}
+        return file
+
 class Topic(models.Model):
     """
     A model to store the topic or category of a project. One project can be in multiple topics and one topic can have multiple projects. Project can be also used to set permissions for user or api access through topics.
@@ -512,6 +1245,24 @@ class WebsocketSession(models.Model):
     def __repr__(self):
         return f"{self.session_id} {self.user} {self.created_at} {self.closed}"
 
+    @classmethod
+    def has_file(cls, session_id: str, file_id: int) -> bool:
+        """
+        a method to check whether a file has been made available to a session
+        """
+        return cls.files.through.objects.filter(
+            websocketsession__session_id=session_id, projectfile_id=file_id
+        ).exists()
+
+    @classmethod
+    def get_permitted_file_ids(cls, session_id: str, file_ids: list[int]) -> set[int]:
+        """
+        a method to check a list of file ids against a session in a single query and return the ids available to it
+        """
+        return set(cls.files.through.objects.filter(
+            websocketsession__session_id=session_id, projectfile_id__in=file_ids
+        ).values_list("projectfile_id", flat=True))
+
 
 class SearchResult(models.Model):
     """
@@ -535,6 +1286,7 @@ class SearchResult(models.Model):
     ]
     search_status = models.CharField(max_length=11, choices=search_status_choices, default="pending")
     file_hash = models.TextField(blank=True, null=True)
+    hash_algorithm = models.CharField(max_length=10, choices=ProjectFile.hash_algorithm_choices, default="sha1")
 
     class Meta:
         ordering = ["id"]
@@ -547,26 +1299,27 @@ class SearchResult(models.Model):
         return f"{self.session} {self.created_at} {self.search_status}"
 
     def delete(self, using=None, keep_parents=False):
+        if self.file and os.path.exists(f"{self.file.path}.gz"):
+            os.remove(f"{self.file.path}.gz")
         self.file.delete()
         super().delete(using=using, keep_parents=keep_parents)
 
+    def write_compressed_copy(self):
+        """
+        a method to write a gzip copy of the result file next to it so that nginx can serve it with gzip_static
+        """
+        with open(self.file.path, "rb") as src, gzip.open(f"{self.file.path}.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst, settings.FILE_READ_BUFFER_SIZE)
+
     def verify_file(self):
-        hasher = hashlib.sha1()
-        with self.file.open("rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hasher.update(chunk)
-        hash = hasher.hexdigest()
+        hash = hash_file(self.file.path, self.hash_algorithm)
         if hash == self.file_hash:
             return True
         else:
             return False
 
     def update_hash(self):
-        hasher = hashlib.sha1()
-        with self.file.open("rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hasher.update(chunk)
-        self.file_hash = hasher.hexdigest()
+        self.file_hash = hash_file(self.file.path, self.hash_algorithm)
         self.save()
 
     async def send_to_remote(self, api_key, pyre_name: str, session_id: str, client_id: str, node_id: str):
@@ -581,32 +1334,11 @@ class SearchResult(models.Model):
     async def upload_chunked_file(self, api_key, search_result_id):
         decoded_api_key = api_key.decrypt_remote_api_key()
         host = f"{api_key.remote_pair.protocol}://{api_key.remote_pair.hostname}:{api_key.remote_pair.port}"
-        data = {
-                "filename": os.path.split(self.file.name)[-1],
-                "size": self.file.size,
-                "data_hash": self.file_hash,
-                "file_category": "json"
-            }
-
-        async with httpx.AsyncClient(headers={"X-API-Key": decoded_api_key}) as client:
-            d = await client.post(f"{host}/api/files/chunked", data=data)
-
-            upload_id = d.json()["upload_id"]
-            with self.file.open("rb") as f:
-                offset = 0
-                while True:
-                    chunk = f.read(d.json()["chunk_size"])
-                    if not chunk:
-                        break
-                    chunk_file = BytesIO(chunk)
-                    progress = await client.post(f"{host}/api/files/chunked/{upload_id}",
-                                                 data={"offset": offset}, files={"chunk": chunk_file})
-                    if progress.json()["status"] == "complete":
-                        break
-                    else:
-                        offset = progress.json()["offset"]
-                result = await client.post(f"{host}/api/files/chunked/{upload_id}/complete/search_result/{search_result_id}")
-                return result.json()
+        async with ChunkedUploadSender(host, decoded_api_key) as sender:
+            return await sender.upload(self.file.path, os.path.split(self.file.name)[-1], self.file.size,
+                                       self.file_hash, "json",
+                                       complete_path=f"complete/search_result/{search_result_id}",
+                                       hash_algorithm=self.hash_algorithm)
 
     async def create_remote_result(self, api_key, pyre_name: str, session_id: str, client_id: str, node_id: str):
         """
@@ -639,7 +1371,7 @@ class AnalysisGroup(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
 
     def get_differential_analysis_line(self, line_numbers: list[int]):
-        with self.differential_analysis_file.file.open("rt") as f:
+        with self.differential_analysis_file.open_data("rt") as f:
             line = f.readline()
             delimiter = self.differential_analysis_file.get_delimiter()
             headers = line.rstrip().split(delimiter)
@@ -651,7 +1383,7 @@ class AnalysisGroup(models.Model):
                         yield i+1, dict(zip(headers, data))
 
     def get_searched_line(self, line_numbers: list[int]):
-        with self.searched_file.file.open("rt") as f:
+        with self.searched_file.open_data("rt") as f:
             line = f.readline()
             delimiter = self.searched_file.get_delimiter()
             headers = line.rstrip().split(delimiter)
@@ -663,7 +1395,7 @@ class AnalysisGroup(models.Model):
                         yield i+1, dict(zip(headers, data))
 
     def get_comparison_matrix(self):
-        with self.comparison_matrix_file.file.open("rt") as f:
+        with self.comparison_matrix_file.open_data("rt") as f:
             line = f.readline()
             delimiter = self.searched_file.get_delimiter()
             headers = line.rstrip().split(delimiter)
@@ -674,7 +1406,7 @@ class AnalysisGroup(models.Model):
                     yield dict(zip(headers, data))
 
     def get_sample_annotations(self):
-        with self.sample_annotation_file.file.open("rt") as f:
+        with self.sample_annotation_file.open_data("rt") as f:
             line = f.readline()
             delimiter = self.searched_file.get_delimiter()
             headers = line.rstrip().split(delimiter)
@@ -697,6 +1429,72 @@ def add_public_topic(sender, instance=None, created=False, **kwargs):
         instance.access_topics.add(Topic.objects.get(name="public"))
         instance.save()
 
+@receiver(post_save, sender=APIKey)
+@receiver(post_delete, sender=APIKey)
+def invalidate_api_key_cache(sender, instance=None, **kwargs):
+    api_key_cache.discard_where(lambda api_key: api_key.pk == instance.pk)
+
+@receiver(post_save, sender=Project)
+@receiver(post_delete, sender=Project)
+def invalidate_project_cache(sender, instance=None, **kwargs):
+    invalidate_cache_scopes("projects", f"project:{instance.pk}", f"project:{instance.pk}:files")
+
+@receiver(post_init, sender=ProjectFile)
+def remember_project_file_project(sender, instance=None, **kwargs):
+    instance._loaded_project_id = instance.__dict__.get("project_id")
+    instance._loaded_hash = instance.__dict__.get("hash")
+
+@receiver(post_save, sender=ProjectFile)
+def update_project_hash_tree(sender, instance=None, created=False, **kwargs):
+    if instance._loaded_project_id and instance._loaded_project_id != instance.project_id:
+        Project.update_file_hash(instance._loaded_project_id, instance.pk, remove=True)
+    if instance.project_id and (created or instance.project_id != instance._loaded_project_id
+                                or instance.hash != instance._loaded_hash):
+        Project.update_file_hash(instance.project_id, instance.pk, instance.hash)
+    instance._loaded_hash = instance.hash
+
+@receiver(post_delete, sender=ProjectFile)
+def release_project_file_blob(sender, instance=None, **kwargs):
+    if instance.blob_id:
+        blob_id = instance.blob_id
+        transaction.on_commit(lambda: FileBlob.release(blob_id))
+
+@receiver(post_delete, sender=ProjectFile)
+def remove_from_project_hash_tree(sender, instance=None, **kwargs):
+    if instance._loaded_project_id:
+        Project.update_file_hash(instance._loaded_project_id, instance.pk, remove=True)
+
+@receiver(post_save, sender=ProjectFile)
+@receiver(post_delete, sender=ProjectFile)
+def invalidate_project_file_cache(sender, instance=None, **kwargs):
+    project_ids = {instance.project_id, instance._loaded_project_id} - {None}
+    if project_ids:
+        invalidate_cache_scopes(*[f"project:{project_id}:files" for project_id in project_ids])
+    instance._loaded_project_id = instance.project_id
+
+@receiver(post_save, sender=Pyre)
+@receiver(post_delete, sender=Pyre)
+def invalidate_pyre_cache(sender, instance=None, **kwargs):
+    invalidate_cache_scopes("pyres")
+
+@receiver(m2m_changed, sender=Topic.projects.through)
+def invalidate_topic_project_cache(sender, instance=None, action=None, pk_set=None, **kwargs):
+    if isinstance(instance, Project):
+        project_ids = [instance.pk] if action in ("post_add", "post_remove", "post_clear") else []
+    elif action in ("post_add", "post_remove"):
+        project_ids = pk_set
+    elif action == "pre_clear":
+        project_ids = list(instance.projects.values_list("id", flat=True))
+    else:
+        project_ids = []
+    if project_ids:
+        invalidate_cache_scopes(*[f"project:{project_id}" for project_id in project_ids])
+
+@receiver(m2m_changed, sender=Pyre.topics.through)
+def invalidate_pyre_topic_cache(sender, instance=None, action=None, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        invalidate_cache_scopes("pyres")
+
 @receiver(post_save, sender=Pyre)
 def add_public_topic_to_pyre(sender, instance=None, created=False, **kwargs):
     if created:
@@ -707,4 +1505,12 @@ def add_public_topic_to_pyre(sender, instance=None, created=False, **kwargs):
 def update_search_vector(sender, instance=None, created=False, **kwargs):
     if created:
         instance.search_vector = SearchVector("data")
-        instance.save()
\ No newline at end of file
+        instance.save()
+
+@receiver(post_save, sender=SearchResult)
+def compress_search_result(sender, instance, **kwargs):
+    """
+    Keep a precompressed copy of every stored search result file for download
+    """
+    if instance.file and os.path.exists(instance.file.path) and not os.path.exists(f"{instance.file.path}.gz"):
+        instance.write_compressed_copy()
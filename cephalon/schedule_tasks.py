@@ -1,6 +1,8 @@
+from django.conf import settings
 from scheduler import job
 
 from cephalon.models import ProjectFile, Project, SearchResult
+from cephalon.sync import sync_remote_instances
 
 
 @job
@@ -11,3 +13,7 @@ def remove_file_not_associated_with_any_project():
 def remove_temporary_project():
     Project.objects.filter(temporary=True).delete()
 
+@job("default", timeout=settings.SYNC_JOB_TIMEOUT)
+def sync_with_paired_instances():
+    sync_remote_instances()
+
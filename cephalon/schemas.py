@@ -1,6 +1,6 @@
 import json
 import uuid
-from typing import Optional
+from typing import Optional, Union
 
 from django.db.models import Q
 from ninja import Schema, UploadedFile, Form, FilterSchema
@@ -19,6 +19,18 @@ class ProjectSchema(Schema):
     global_id: str
     headline: Optional[str] = None
 
+class ProjectSummarySchema(Schema):
+    id: int
+    name: str
+    description: str
+    hash: str
+    global_id: str
+
+class ProjectPageSchema(Schema):
+    items: list[Union[ProjectSchema, ProjectSummarySchema]]
+    count: Optional[int] = None
+    next_cursor: Optional[str] = None
+
 class ProjectPostSchema(Schema):
     name: str
     description: str
@@ -31,6 +43,7 @@ class FileSchema(Schema):
     name: str
     description: Optional[str] = None
     hash: str
+    hash_algorithm: Optional[str] = None
     metadata: Optional[dict] = None
     file_type: str
     file: str
@@ -38,6 +51,33 @@ class FileSchema(Schema):
     path: Optional[list[str]] = []
     headline: Optional[str] = None
     project_id: Optional[int] = None
+    ingest_status: Optional[str] = None
+    ingest_progress: Optional[int] = None
+    ingest_job_id: Optional[str] = None
+
+class FileSummarySchema(Schema):
+    id: int
+    name: str
+    description: Optional[str] = None
+    hash: str
+    file_type: str
+    file: str
+    file_category: str
+    path: Optional[list[str]] = []
+    project_id: Optional[int] = None
+
+class FilePageSchema(Schema):
+    items: list[Union[FileSchema, FileSummarySchema]]
+    count: Optional[int] = None
+    next_cursor: Optional[str] = None
+
+class FileSearchPageSchema(Schema):
+    items: list[FileSchema]
+    next_cursor: Optional[str] = None
+
+class ProjectSearchPageSchema(Schema):
+    items: list[ProjectSchema]
+    next_cursor: Optional[str] = None
 
 class FilePostSchema(Schema):
     description: str
@@ -46,6 +86,7 @@ class FilePostSchema(Schema):
     file_type: str
     file_category: str
     load_file_content: Optional[bool] = False
+    hash_algorithm: Optional[str] = "sha1"
 
 class ChunkedUploadSchema(Schema):
     filename: str
@@ -55,6 +96,48 @@ class ChunkedUploadSchema(Schema):
     chunk_size: int
     status: str
     file_id: Optional[int] = None
+    encoding: str = "identity"
+    block_size: int
+    hash_algorithm: str = "sha1"
+
+class ChunkedUploadStatusSchema(ChunkedUploadSchema):
+    missing_chunks: list[int]
+
+    @staticmethod
+    def resolve_missing_chunks(obj):
+        return obj.get_missing_blocks()
+
+class ChunkedRangeSchema(Schema):
+    upload_id: uuid.UUID
+    filename: str
+    status: str
+    index: Optional[int] = None
+    count: int = 0
+    block_size: int
+    chunk_size: int
+    total_size: int
+    encoding: str = "identity"
+    hash_algorithm: str = "sha1"
+    file_id: Optional[int] = None
+
+class ChunkedRangeClaimSchema(Schema):
+    node_id: str
+    size: int
+    data_hash: str
+
+class DeltaUploadInitSchema(Schema):
+    size: int
+    data_hash: str
+    blocks: list[tuple[str, int]]
+    accept_encoding: Optional[str] = None
+    hash_algorithm: Optional[str] = "sha1"
+
+class DeltaUploadSchema(ChunkedUploadSchema):
+    missing_blocks: list[int]
+
+    @staticmethod
+    def resolve_missing_blocks(obj):
+        return obj.get_missing_delta_blocks()
 
 class HashErrorSchema(Schema):
     error: str
@@ -64,6 +147,8 @@ class ChunkedUploadInitSchema(Schema):
     file_category: str
     size: int
     data_hash: str
+    accept_encoding: Optional[str] = None
+    hash_algorithm: Optional[str] = "sha1"
 
 class ChunkedUploadCompleteSchema(Schema):
     file_id: Optional[int] = None
@@ -72,6 +157,19 @@ class ChunkedUploadCompleteSchema(Schema):
     load_file_content: Optional[bool] = False
     project_id: Optional[int] = None
     path: Optional[tuple[str, ...]] = []
+    session_id: Optional[str] = None
+    client_id: Optional[str] = None
+    description: Optional[str] = None
+    metadata: Optional[dict] = None
+    file_type: Optional[str] = None
+
+class SyncManifestSchema(Schema):
+    projects: dict[str, Optional[str]]
+
+class SyncProjectSchema(Schema):
+    id: Optional[int] = None
+    hash: Optional[str] = None
+    files: Optional[list[str]] = None
 
 class SearchResultSchema(Schema):
     id: int
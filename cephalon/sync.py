@@ -0,0 +1,122 @@
+import httpx
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from cephalon.models import APIKey, Project, Topic
+from cephalon.transfer import ChunkedUploadSender, RateLimiter
+from cephalon.utils import in_time_window
+from corpusx.consumers import RemoteCorpusX
+
+
+def get_accessible_projects(api_key: APIKey):
+    """
+    Get the projects an api key can access directly or through one of its topics
+    """
+    projects = Project.objects.all()
+    if api_key.access_all:
+        return projects
+    return projects.filter(
+        Exists(APIKey.project.through.objects.filter(project_id=OuterRef("id"), apikey=api_key)) |
+        Exists(Topic.projects.through.objects.filter(project_id=OuterRef("id"), topic__apikey=api_key))
+    )
+
+
+def get_project_manifest_diff(projects: dict[str, str], api_key: APIKey) -> dict:
+    """
+    Compare the project hashes a remote instance sent by global id with the projects stored here that the api key of
+    the remote can access. Missing projects and projects the key cannot access have no id, projects with a different
+    hash come with the hashes of their files so the remote can work out which files to send.
+    """
+    result = {global_id: {"id": None, "hash": None, "files": None} for global_id in projects}
+    for project in get_accessible_projects(api_key).filter(global_id__in=list(projects)).order_by("id"):
+        entry = {"id": project.id, "hash": project.hash, "files": None}
+        if project.hash != projects[project.global_id]:
+            entry["files"] = list(project.files.exclude(hash=None).values_list("hash", flat=True).distinct())
+        result[project.global_id] = entry
+    return result
+
+
+def sync_with_remote(api_key: APIKey, window: str = None, max_rate: int = None) -> dict:
+    """
+    Push the projects an api key has access to, to the instance it is paired with. Only projects and files whose
+    hashes the remote does not have are sent, the transfer rate is capped and no new transfer starts once the time
+    window has closed. Nothing is removed on the remote.
+    """
+    remote = api_key.remote_pair
+    host = f"{remote.protocol}://{remote.hostname}:{remote.port}"
+    key = api_key.decrypt_remote_api_key()
+    if api_key.access_all:
+        project_ids = Project.objects.filter(temporary=False).values_list("id", flat=True)
+    else:
+        project_ids = [project.id for project in api_key.get_associated_projects()]
+    projects = list(Project.objects.filter(id__in=project_ids, temporary=False).exclude(global_id=None)
+                    .prefetch_related("files").order_by("id"))
+    window = settings.SYNC_WINDOW if window is None else window
+    max_rate = max_rate or remote.sync_max_rate or settings.SYNC_MAX_RATE
+    limiter = RateLimiter(max_rate) if max_rate else None
+    return async_to_sync(push_projects)(host, key, projects, window, limiter)
+
+
+async def push_projects(host: str, key: str, projects: list[Project], window: str, limiter: RateLimiter = None,
+                        transport: httpx.AsyncBaseTransport = None) -> dict:
+    stats = {"projects": 0, "files": 0, "bytes": 0, "stopped": False}
+    async with httpx.AsyncClient(headers={"X-API-Key": key}, timeout=httpx.Timeout(60.0),
+                                 transport=transport) as client:
+        response = await client.post(f"{host}/api/sync/manifest",
+                                     json={"projects": {project.global_id: project.hash for project in projects}})
+        response.raise_for_status()
+        manifest = response.json()
+
+    corpus = RemoteCorpusX(host, key)
+    async with ChunkedUploadSender(host, key, transport=transport, limiter=limiter) as sender:
+        for project in projects:
+            state = manifest.get(project.global_id)
+            if not state or (state["id"] and state["hash"] == project.hash):
+                continue
+            if not in_time_window(window):
+                stats["stopped"] = True
+                break
+            if state["id"] is None:
+                await corpus.upload_project_archive(project, limiter)
+                stats["projects"] += 1
+                stats["bytes"] += sum([await sync_to_async(file.get_data_size)()
+                                       for file in project.files.all() if file.file])
+                continue
+            remote_hashes = set(state["files"] or [])
+            for file in project.files.all():
+                if not file.file or file.hash in remote_hashes:
+                    continue
+                if not in_time_window(window):
+                    stats["stopped"] = True
+                    return stats
+                size = await sync_to_async(file.get_data_size)()
+                await sender.upload(file.file.path, file.name, size, file.hash, file.file_category,
+                                    complete_json={"create_file": True, "project_id": state["id"],
+                                                   "path": file.path or [], "delete": True,
+                                                   "load_file_content": file.load_file_content,
+                                                   "description": file.description, "metadata": file.metadata,
+                                                   "file_type": file.file_type},
+                                    hash_algorithm=file.hash_algorithm)
+                remote_hashes.add(file.hash)
+                stats["files"] += 1
+                stats["bytes"] += size
+    return stats
+
+
+def sync_remote_instances(window: str = None) -> list[dict]:
+    """
+    Sync every paired instance that has sync turned on, one remote after the other
+    """
+    results = []
+    if not in_time_window(settings.SYNC_WINDOW if window is None else window):
+        return results
+    for api_key in APIKey.objects.filter(remote_pair__sync=True, expired=False).select_related("remote_pair"):
+        stats = sync_with_remote(api_key, window)
+        api_key.remote_pair.last_synced_at = timezone.now()
+        api_key.remote_pair.save(update_fields=["last_synced_at"])
+        results.append(stats)
+        if stats["stopped"]:
+            break
+    return results
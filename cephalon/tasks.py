@@ -0,0 +1,53 @@
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django_rq import job
+
+from cephalon.models import ProjectFile
+
+
+def send_ingest_progress(file: ProjectFile, session_id: str, client_id: str = None, pyre_name: str = "public"):
+    """
+    a method to push the ingest status and progress of a file to the result channel of a session
+    """
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(session_id + "_result", {
+        'type': 'communication_message',
+        'message': {
+            'message': f"ingest {file.ingest_status} {file.ingest_progress}%",
+            'requestType': "ingest-progress",
+            'senderID': "host",
+            'targetID': client_id,
+            'channelType': "file",
+            'data': {
+                "file_id": file.id,
+                "job_id": file.ingest_job_id,
+                "status": file.ingest_status,
+                "progress": file.ingest_progress,
+            },
+            'sessionID': session_id,
+            'clientID': client_id,
+            'pyreName': pyre_name,
+        }
+    })
+
+
+@job("ingest")
+def ingest_project_file(file_id: int, session_id: str = None, client_id: str = None):
+    file = ProjectFile.objects.get(id=file_id)
+    last_sent = [0.0]
+
+    def progress(f: ProjectFile):
+        # running updates are sent at most once per second, the final status is always sent
+        now = time.monotonic()
+        if f.ingest_status == "running" and now - last_sent[0] < 1:
+            return
+        last_sent[0] = now
+        send_ingest_progress(f, session_id, client_id)
+
+    # the job stops after its time budget and queues the rest of the file as a new job, well within the queue timeout
+    deadline = time.monotonic() + settings.INGEST_JOB_SECONDS if settings.INGEST_IN_BACKGROUND else None
+    if not file.ingest(progress if session_id else None, deadline):
+        file.enqueue_ingest(session_id, client_id)
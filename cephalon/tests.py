@@ -1,13 +1,33 @@
+import asyncio
+import datetime
+import functools
 import json
+import os
+import tempfile
+from io import StringIO, BytesIO
+from unittest import mock
+
 import httpx
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
 from django.core.files.base import ContentFile
-from django.test import TestCase, Client
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import TestCase, Client, override_settings
 from django.test.client import MULTIPART_CONTENT, encode_multipart, BOUNDARY
 from django.contrib.auth.models import User
 
 import hashlib
 
-from cephalon.models import APIKey, Pyre, WebsocketSession, WebsocketNode, Topic
+from cephalon.management.commands.connect_to_index import Command
+from cephalon.tasks import ingest_project_file
+from cephalon.sync import push_projects
+from cephalon.transfer import ChunkedUploadSender
+from cephalon.utils import compress_data, hash_file, in_time_window, encrypt_stream, open_stored_file, \
+    get_storage_format, search_file, compress_stream, build_bucketed_merkle_tree, merkle_leaf, encode_cursor
+from cephalon.models import APIKey, ChunkedUpload, Pyre, WebsocketSession, WebsocketNode, Topic, api_key_cache, Project, \
+    ProjectFile, ProjectFileContent, FileBlob, AnalysisGroup
+from corpusx.consumers import CurrentCorpusX
 
 
 # Create your tests here.
@@ -87,6 +107,19 @@ class FileModelTestCase(TestCase):
         assert e.json()["file_type"] == "tsv"
         assert e.json()["id"] != None
 
+    def test_file_model_upload_blake2b(self):
+        filecontent = b"gene\tvalue\n" * 1000
+        hash = hashlib.blake2b(filecontent).hexdigest()
+        e = self.client.post(
+            f'/api/projects/{self.d.json()["id"]}/files',
+            {"description": "test", "hash": hash, "hash_algorithm": "blake2b", "metadata": json.dumps({}), "file_type": "tsv", "file": ContentFile(filecontent, name="test.tsv"), "file_category": "other"},
+            content_type=MULTIPART_CONTENT,
+        )
+        assert e.status_code == 200
+        file = ProjectFile.objects.get(id=e.json()["id"])
+        assert file.hash_algorithm == "blake2b"
+        assert hash_file(file.file.path, "blake2b") == hash
+
     def add_test_project(self):
         user = add_test_user()
         self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
@@ -117,7 +150,7 @@ class ChunkedUploadTestCase(TestCase):
         file.seek(0)
         hash = hasher.hexdigest()
         # initiate chunked upload
-        d = self.client.post(f'/api/files/chunked', {"file_category": "other", "filename": "test.tsv", "size": len(filecontent), "data_hash": hash}, content_type="application/json")
+        d = self.client.post(f'/api/files/chunked', {"file_category": "other", "filename": "test.tsv", "size": len(filecontent), "data_hash": hash})
         assert d.status_code == 200
         assert d.json()["filename"] == "test.tsv"
         assert d.json()["total_size"] == len(filecontent)
@@ -143,6 +176,1126 @@ class ChunkedUploadTestCase(TestCase):
                 offset = e.json()["offset"]
 
 
+class APIKeyCacheTestCase(TestCase):
+    def setUp(self):
+        api_key_cache.clear()
+        add_public_topic()
+
+    def test_cached_api_key_lookup(self):
+        key, api_key = add_test_api_key()
+        assert APIKey.get_by_key(key).id == api_key.id
+        with self.assertNumQueries(0):
+            cached = APIKey.get_by_key(key)
+        assert cached.id == api_key.id
+        assert cached is not APIKey.get_by_key(key)
+
+    def test_api_key_cache_invalidation(self):
+        key, api_key = add_test_api_key()
+        assert APIKey.get_by_key(key).allow_download == False
+        api_key.allow_download = True
+        api_key.save()
+        assert APIKey.get_by_key(key).allow_download == True
+        api_key.delete()
+        assert APIKey.get_by_key(key) is None
+
+
+class FilePermissionTestCase(TestCase):
+    def setUp(self):
+        self.public = add_public_topic()
+        self.key, self.api_key = add_test_api_key()
+        self.public_project = Project.objects.create(name="public")
+        self.private_project = Project.objects.create(name="private")
+        self.public.projects.add(self.public_project)
+        self.public_file = ProjectFile.objects.create(name="public.tsv", project=self.public_project)
+        self.private_file = ProjectFile.objects.create(name="private.tsv", project=self.private_project)
+
+    def test_check_file_permission(self):
+        with self.assertNumQueries(1):
+            assert self.public_file.has_file_permission(self.api_key) == True
+        assert self.private_file.has_file_permission(self.api_key) == False
+        self.api_key.access_all = True
+        assert self.private_file.has_file_permission(self.api_key) == True
+
+    def test_bulk_file_permission(self):
+        file_ids = [self.public_file.id, self.private_file.id]
+        with self.assertNumQueries(1):
+            permitted = ProjectFile.get_permitted_file_ids(self.api_key, file_ids)
+        assert permitted == {self.public_file.id}
+
+    def test_session_file_permission(self):
+        session = add_test_websocket_session()
+        session.files.add(self.public_file)
+        assert WebsocketSession.has_file(session.session_id, self.public_file.id) == True
+        assert WebsocketSession.has_file(session.session_id, self.private_file.id) == False
+        permitted = WebsocketSession.get_permitted_file_ids(session.session_id, [self.public_file.id, self.private_file.id])
+        assert permitted == {self.public_file.id}
+        d = self.client.get(f"/api/files/{self.private_file.id}/session/{session.session_id}/download")
+        assert d.status_code == 403
+
+
+class ProjectHashTreeTestCase(TestCase):
+    def test_project_hash_follows_file_hashes(self):
+        project = Project.objects.create(name="test", description="test", hash="test", global_id="test")
+        other = Project.objects.create(name="other", description="other", hash="other", global_id="other")
+        files = [ProjectFile.objects.create(name=f"{i}.tsv", hash=f"{i:040x}", project=project) for i in range(7)]
+
+        def assert_consistent(p):
+            p.refresh_from_db()
+            assert p.hash == p.calculate_project_hash()
+            assert sorted(p.hash_nodes.filter(level=0).values_list("file_id", flat=True)) == \
+                   list(p.files.order_by("id").values_list("id", flat=True))
+            nodes = {(node.level, node.index): node.hash for node in p.hash_nodes.filter(level__gt=0)}
+            assert nodes == build_bucketed_merkle_tree([merkle_leaf(h) for h in p.files.values_list("hash", flat=True)], 8)
+
+        assert_consistent(project)
+        root = project.hash
+        files[3].hash = "changed"
+        files[3].save()
+        assert_consistent(project)
+        assert project.hash != root
+        files[0].project = other
+        files[0].save()
+        assert_consistent(project)
+        assert_consistent(other)
+        files[5].delete()
+        assert_consistent(project)
+        files[0].project = project
+        files[0].save()
+        assert_consistent(project)
+        other.refresh_from_db()
+        assert not other.hash_nodes.exists()
+        assert other.hash == hashlib.sha1(b"").hexdigest()
+
+
+class ListingTestCase(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(name="test", description="test", hash="test", global_id="test", metadata={"test": "test"})
+        Project.objects.create(name="other", description="other", hash="other", global_id="other", metadata={})
+        self.files = [
+            ProjectFile.objects.create(name="test.tsv", project=self.project, hash="test", metadata={"test": "test"},
+                                       file=ContentFile(b"test", name="test.tsv"))
+            for _ in range(3)
+        ]
+
+    def test_list_project_files_pages(self):
+        d = self.client.get(f"/api/projects/{self.project.id}/files", {"limit": 2})
+        assert d.status_code == 200
+        assert [i["id"] for i in d.json()["items"]] == [f.id for f in self.files[:2]]
+        assert d.json()["items"][0]["metadata"] == {"test": "test"}
+        assert d.json()["count"] == 3
+        with self.assertNumQueries(2):
+            e = self.client.get(f"/api/projects/{self.project.id}/files", {"limit": 2, "cursor": d.json()["next_cursor"], "metadata": False, "count": False})
+        assert [i["id"] for i in e.json()["items"]] == [self.files[2].id]
+        assert "metadata" not in e.json()["items"][0]
+        assert e.json()["count"] == None
+        assert e.json()["next_cursor"] == None
+
+    def test_list_projects_pages(self):
+        d = self.client.get("/api/projects", {"limit": 1, "metadata": False})
+        assert d.status_code == 200
+        assert [i["id"] for i in d.json()["items"]] == [self.project.id]
+        assert "metadata" not in d.json()["items"][0]
+        assert d.json()["count"] == 2
+        e = self.client.get("/api/projects", {"limit": 1, "cursor": d.json()["next_cursor"]})
+        assert e.json()["items"][0]["name"] == "other"
+        assert e.json()["next_cursor"] == None
+        assert self.client.get("/api/projects", {"cursor": "e30="}).json() == {"error": "invalid cursor"}
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class ResponseCacheTestCase(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(name="test", description="test", hash="test", global_id="test")
+        self.file = ProjectFile.objects.create(name="test.tsv", project=self.project, hash="test",
+                                               file=ContentFile(b"test", name="test.tsv"))
+
+    def test_get_project_cached(self):
+        d = self.client.get(f"/api/projects/{self.project.id}")
+        assert d.status_code == 200
+        etag = d["ETag"]
+        with self.assertNumQueries(0):
+            e = self.client.get(f"/api/projects/{self.project.id}")
+        assert e.json() == d.json()
+        assert e["ETag"] == etag
+        f = self.client.get(f"/api/projects/{self.project.id}", headers={"If-None-Match": etag})
+        assert f.status_code == 304
+        self.project.name = "changed"
+        self.project.save()
+        g = self.client.get(f"/api/projects/{self.project.id}", headers={"If-None-Match": etag})
+        assert g.status_code == 200
+        assert g.json()["name"] == "changed"
+
+    def test_list_project_files_invalidated(self):
+        d = self.client.get(f"/api/projects/{self.project.id}/files")
+        assert len(d.json()["items"]) == 1
+        other = Project.objects.create(name="other", description="other", hash="other", global_id="other")
+        self.file.project = other
+        self.file.save()
+        e = self.client.get(f"/api/projects/{self.project.id}/files")
+        assert len(e.json()["items"]) == 0
+
+    def test_get_pyres_requires_auth(self):
+        user = add_test_user()
+        client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+        add_public_topic()
+        add_test_pyre()
+        assert client.get("/api/pyres").json() == ["test"]
+        assert self.client.get("/api/pyres").status_code == 401
+
+
+@override_settings(INGEST_IN_BACKGROUND=False)
+class FileBlobTestCase(TestCase):
+    def setUp(self):
+        user = add_test_user()
+        self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+
+    def upload(self, filecontent, project):
+        d = self.client.post('/api/files/chunked', {"file_category": "searched", "filename": "test.tsv", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest()})
+        upload_id = d.json()["upload_id"]
+        self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(filecontent).hexdigest(), "chunk": ContentFile(filecontent, name="test.tsv")})
+        f = self.client.post(f'/api/files/chunked/{upload_id}/complete', {"create_file": True, "project_id": project.id, "load_file_content": True, "delete": True}, content_type="application/json")
+        return ProjectFile.objects.get(id=f.json()["id"])
+
+    def test_shared_blob(self):
+        filecontent = b"kinase\tphosphatase\n" * 10
+        projects = [Project.objects.create(name=f"test{i}", description="test", hash="test", global_id="test") for i in range(2)]
+        first, second = [self.upload(filecontent, project) for project in projects]
+        assert first.blob_id == second.blob_id
+        assert first.file.name == second.file.name
+        blob = first.blob
+        blob.refresh_from_db()
+        assert blob.ref_count == 2
+        assert blob.content.count() == 1
+        assert ProjectFileContent.objects.filter(project_file__in=[first, second]).count() == 0
+        d = self.client.get("/api/search/file/kinase")
+        assert sorted(i["id"] for i in d.json()["items"]) == [first.id, second.id]
+
+        path = first.file.path
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        blob.refresh_from_db()
+        assert blob.ref_count == 1
+        assert os.path.exists(path)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        assert not FileBlob.objects.filter(id=blob.id).exists()
+        assert not ProjectFileContent.objects.filter(blob_id=blob.id).exists()
+        assert not os.path.exists(path)
+
+
+@override_settings(INGEST_IN_BACKGROUND=False)
+class IncrementalReindexTestCase(TestCase):
+    def test_reindex_changed_segments(self):
+        rows = [f"protein{i}\tkinase{i}\t{i * 0.5}\n".encode() for i in range(40000)]
+        project = Project.objects.create(name="test", description="test", hash="test", global_id="test")
+        file = ProjectFile.objects.create(name="test.tsv", project=project, hash="test", load_file_content=True,
+                                          file=ContentFile(b"".join(rows), name="test.tsv"))
+        file.load_file()
+        before = dict(file.content.values_list("id", "chunk_hash"))
+        assert len(before) > 3
+        rows[20000] = b"protein20000\tphosphatase\t0\n"
+        with open(file.file.path, "wb") as f:
+            f.write(b"".join(rows))
+        file.save_altered()
+        after = dict(file.content.values_list("id", "chunk_hash"))
+        assert len(after) == len(before)
+        assert len(set(before) - set(after)) == 1
+        assert file.content.filter(search_vector="phosphatase").count() == 1
+        assert not file.content.filter(search_vector="kinase20000").exists()
+        file.load_file()
+        assert dict(file.content.values_list("id", "chunk_hash")) == after
+
+
+@override_settings(CONTENT_SEGMENT_MIN_SIZE=1024, CONTENT_SEGMENT_MAX_SIZE=2048, INGEST_JOB_SECONDS=0)
+class CheckpointedIngestTestCase(TestCase):
+    def test_ingest_resumes_from_checkpoint(self):
+        rows = b"".join(f"protein{i}\tkinase{i}\n".encode() for i in range(60000))
+        project = Project.objects.create(name="test", description="test", hash="test", global_id="test")
+        file = ProjectFile.objects.create(name="test.tsv", project=project, hash=hashlib.sha1(rows).hexdigest(),
+                                          file=ContentFile(rows, name="test.tsv"))
+        with mock.patch("cephalon.tasks.ingest_project_file.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                ingest_project_file(file.id)
+        file.refresh_from_db()
+        assert file.ingest_status == "queued"
+        assert delay.call_args.kwargs["job_id"] == file.ingest_job_id
+        offsets = [file.ingest_checkpoint["offset"]]
+        assert file.content.count() == 100
+
+        while not file.load_file(deadline=0):
+            offsets.append(file.ingest_checkpoint["offset"])
+        assert offsets == sorted(offsets) and len(offsets) > 2
+        assert file.ingest_checkpoint is None
+        file.refresh_from_db()
+        assert file.ingest_checkpoint is None
+        segments = file.content.count()
+        assert file.content.filter(search_vector="kinase59999").count() == 1
+        # with stored segments the comparison pass is kept in the checkpoint and a resumed job does not repeat it
+        assert not file.load_file(deadline=0)
+        assert file.ingest_checkpoint["offset"] == 0 and file.ingest_checkpoint["missing"] == {}
+        with mock.patch.object(ProjectFile, "get_missing_segments", side_effect=AssertionError):
+            while not file.load_file(deadline=0):
+                pass
+        assert file.content.count() == segments
+        file.remove_file_content()
+        file.load_file()
+        assert file.content.count() == segments
+
+
+@override_settings(INGEST_IN_BACKGROUND=False)
+class ImportDirectoryTestCase(TestCase):
+    def test_import_directory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "experiment1", "differential"))
+            with open(os.path.join(tmpdir, "experiment1", "differential", "result.tsv"), "wb") as f:
+                f.write(b"kinase\t0.5\n")
+            with open(os.path.join(tmpdir, "experiment1", "proteinGroups.txt"), "wb") as f:
+                f.write(b"phosphatase\t1\n")
+            with open(os.path.join(tmpdir, "notes.pdf"), "wb") as f:
+                f.write(b"%PDF")
+            out = StringIO()
+            call_command("import_directory", tmpdir, create_project="archive", mode="move", index=True, workers=2, stdout=out)
+            project = Project.objects.get(name="archive")
+            files = {file.name: file for file in project.files.all()}
+            assert set(files) == {"result.tsv", "proteinGroups.txt", "notes.pdf"}
+            assert files["result.tsv"].path == ["experiment1", "differential"]
+            assert files["result.tsv"].file_category == "differential_analysis"
+            assert files["proteinGroups.txt"].file_category == "searched"
+            assert files["proteinGroups.txt"].file_type == "txt"
+            assert files["notes.pdf"].file_type == "other"
+            assert files["notes.pdf"].file_category == "other"
+            assert files["result.tsv"].hash == hashlib.sha1(b"kinase\t0.5\n").hexdigest()
+            assert not os.path.exists(os.path.join(tmpdir, "notes.pdf"))
+            assert files["notes.pdf"].file.read() == b"%PDF"
+            assert project.hash == project.calculate_project_hash()
+            assert files["result.tsv"].content.filter(search_vector="kinase").exists()
+            assert "queued 2 files for indexing" in out.getvalue()
+
+            call_command("import_directory", tmpdir, project=project.id, mode="move", stdout=out)
+            assert "found 0 new files" in out.getvalue()
+
+    def test_import_directory_into_encrypted_project(self):
+        project = Project.objects.create(name="encrypted", description="", global_id="encrypted", encrypted=True)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "result.tsv"), "wb") as f:
+                f.write(b"kinase\t0.5\n")
+            with self.assertRaises(CommandError):
+                call_command("import_directory", tmpdir, project=project.id, mode="reference", stdout=StringIO())
+            call_command("import_directory", tmpdir, project=project.id, mode="link", stdout=StringIO())
+            with open(os.path.join(tmpdir, "result.tsv"), "rb") as f:
+                assert f.read() == b"kinase\t0.5\n"
+        file = project.files.get()
+        assert file.blob_id
+        assert get_storage_format(file.file.path) == "encrypted"
+        with file.open_data() as data:
+            assert data.read() == b"kinase\t0.5\n"
+
+
+@override_settings(INGEST_IN_BACKGROUND=False)
+class ProjectArchiveTestCase(TestCase):
+    def setUp(self):
+        user = add_test_user()
+        self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+
+    def test_export_and_import_project(self):
+        project = Project.objects.create(name="test", description="test", hash="test", global_id="archive", metadata={"a": 1})
+        contents = [b"kinase\t0.5\n" * 1000, os.urandom(300000)]
+        files = [ProjectFile.objects.create(name=f"test{i}.tsv", project=project, hash=hashlib.sha1(data).hexdigest(),
+                                            load_file_content=i == 0, path=["experiment"],
+                                            file=ContentFile(data, name=f"test{i}.tsv")) for i, data in enumerate(contents)]
+        group = AnalysisGroup.objects.create(project=project, searched_file=files[0])
+        group.other_files.add(files[1])
+
+        response = self.client.get(f"/api/projects/{project.id}/export")
+        assert response.status_code == 200
+        archive = b"".join(response.streaming_content)
+        assert len(archive) < len(contents[0]) + len(contents[1])
+        d = self.client.post("/api/projects/import", archive, content_type="application/gzip")
+        assert d.status_code == 400
+        assert d.json()["error"] == "project already exists"
+
+        Project.objects.filter(id=project.id).update(global_id="original")
+        d = self.client.post("/api/projects/import", archive[:len(archive) // 2], content_type="application/gzip")
+        assert d.status_code == 400
+        assert not Project.objects.filter(global_id="archive").exists()
+        assert ProjectFile.objects.count() == len(files)
+
+        d = self.client.post("/api/projects/import", archive, content_type="application/gzip")
+        assert d.status_code == 200
+        imported = Project.objects.get(id=d.json()["id"])
+        assert imported.global_id == "archive"
+        assert imported.metadata == {"a": 1}
+        imported_files = list(imported.files.order_by("id"))
+        assert [file.file.read() for file in imported_files] == contents
+        assert [file.path for file in imported_files] == [["experiment"], ["experiment"]]
+        assert imported_files[0].blob.content.filter(search_vector="kinase").exists()
+        imported_group = imported.analysis_groups.get()
+        assert imported_group.searched_file_id == imported_files[0].id
+        assert list(imported_group.other_files.all()) == [imported_files[1]]
+
+
+class ShadowReindexTestCase(TestCase):
+    def test_shadow_reindex_swap_and_rollback(self):
+        project = Project.objects.create(name="test", description="test", hash="test", global_id="test")
+        rows = b"".join(f"protein{i}\tkinase{i}\n".encode() for i in range(20000))
+        files = [ProjectFile.objects.create(name=f"test{i}.tsv", project=project, hash=f"test{i}", load_file_content=True,
+                                            file=ContentFile(rows, name="test.tsv")) for i in range(3)]
+        for file in files:
+            file.load_file()
+        count = ProjectFileContent.objects.count()
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(cursor, ProjectFileContent._meta.db_table)
+        out = StringIO()
+        with override_settings(CONTENT_SEGMENT_MIN_SIZE=4 * 1024, CONTENT_SEGMENT_MAX_SIZE=8 * 1024):
+            call_command("shadow_reindex", sleep=0, batch_size=2, stdout=out)
+        assert "indexed 3/3 files" in out.getvalue()
+        assert ProjectFileContent.objects.count() > count
+        assert ProjectFileContent.objects.filter(project_file=files[0], search_vector="kinase19999").count() == 1
+        with connection.cursor() as cursor:
+            assert sorted(connection.introspection.get_constraints(cursor, ProjectFileContent._meta.db_table)) == sorted(indexes)
+        files[0].delete()
+        assert not ProjectFileContent.objects.filter(project_file_id=files[0].id).exists()
+
+        call_command("shadow_reindex", rollback=True, stdout=out)
+        assert ProjectFileContent.objects.count() == count * 2 // 3
+        assert ProjectFileContent.objects.filter(search_vector="kinase19999").count() == 2
+        with self.assertRaises(CommandError):
+            call_command("shadow_reindex", rollback=True, stdout=out)
+        call_command("shadow_reindex", drop_old=True, stdout=out)
+
+
+class ReindexCorpusTestCase(TestCase):
+    def test_reindex_corpus_resumes_from_checkpoint(self):
+        project = Project.objects.create(name="test", description="test", hash="test", global_id="test")
+        files = [ProjectFile.objects.create(name=f"test{i}.tsv", project=project, hash=f"test{i}", file_category=category,
+                                            file=ContentFile(f"kinase{i}\tphosphatase\n".encode(), name="test.tsv"))
+                 for i, category in enumerate(["searched", "searched", "other"])]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            checkpoint = os.path.join(tmpdir, "checkpoint")
+            out = StringIO()
+            call_command("reindex_corpus", category=["searched"], backfill=True, workers=1, checkpoint=checkpoint, stdout=out)
+            assert "2 files to index" in out.getvalue()
+            assert "indexed 2 files (0 failed)" in out.getvalue()
+            for file in files:
+                file.refresh_from_db()
+            assert [file.load_file_content for file in files] == [True, True, False]
+            assert files[1].content.filter(search_vector="kinase1").exists()
+            call_command("reindex_corpus", category=["searched"], workers=1, checkpoint=checkpoint, stdout=out)
+            assert "0 files to index, 2 already done" in out.getvalue()
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class IngestTestCase(TestCase):
+    def setUp(self):
+        user = add_test_user()
+        self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+
+    def test_ingest_in_background(self):
+        filecontent = b"kinase\tphosphatase\n" * 10
+        d = self.client.post('/api/files/chunked', {"file_category": "searched", "filename": "test.tsv", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest()})
+        upload_id = d.json()["upload_id"]
+        self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(filecontent).hexdigest(), "chunk": ContentFile(filecontent, name="test.tsv")})
+        with mock.patch("cephalon.tasks.ingest_project_file.delay") as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                f = self.client.post(f'/api/files/chunked/{upload_id}/complete', {"create_file": True, "load_file_content": True, "session_id": "session", "client_id": "client"}, content_type="application/json")
+        assert f.json()["ingest_status"] == "queued"
+        file_id = f.json()["id"]
+        delay.assert_called_once_with(file_id, "session", "client", job_id=f.json()["ingest_job_id"])
+        file = ProjectFile.objects.get(id=file_id)
+        assert not file.load_file_content
+        assert file.blob.content.count() == 0
+
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)("session_result", channel_name)
+        ingest_project_file(file_id, "session", "client")
+        file.refresh_from_db()
+        assert file.ingest_status == "complete"
+        assert file.ingest_progress == 100
+        assert file.load_file_content
+        assert file.blob.content.count() == 1
+        messages = [async_to_sync(channel_layer.receive)(channel_name) for _ in range(2)]
+        assert messages[0]["message"]["requestType"] == "ingest-progress"
+        assert messages[-1]["message"]["data"] == {"file_id": file_id, "job_id": file.ingest_job_id, "status": "complete", "progress": 100}
+
+
+@override_settings(INGEST_IN_BACKGROUND=False)
+class EncryptedStorageTestCase(TestCase):
+    def setUp(self):
+        user = add_test_user()
+        self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+
+    def test_segmented_encryption(self):
+        content = os.urandom(10000)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.bin")
+            with open(path, "wb") as f:
+                encrypt_stream(BytesIO(content), f, segment_size=1000)
+            assert get_storage_format(path) == "encrypted"
+            with open_stored_file(path) as f:
+                assert f.read() == content
+                f.seek(4321)
+                assert f.read(1234) == content[4321:5555]
+
+            with open(path, "rb") as f:
+                encrypted = f.read()
+            for altered in [encrypted[:-1016], encrypted[:200] + bytes([encrypted[200] ^ 1]) + encrypted[201:]]:
+                with open(path, "wb") as f:
+                    f.write(altered)
+                with self.assertRaises(ValueError):
+                    with open_stored_file(path) as f:
+                        f.read()
+
+    def test_encrypted_project_file(self):
+        project = Project.objects.create(name="test", description="test", global_id="test", encrypted=True)
+        filecontent = b"".join(f"GENE{i}\tkinase{i % 7}\n".encode() for i in range(20000))
+        d = self.client.post('/api/files/chunked', {"file_category": "searched", "filename": "test.tsv", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest()})
+        upload_id = d.json()["upload_id"]
+        self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(filecontent).hexdigest(), "chunk": ContentFile(filecontent, name="test.tsv")})
+        f = self.client.post(f'/api/files/chunked/{upload_id}/complete', {"create_file": True, "project_id": project.id, "load_file_content": True}, content_type="application/json")
+        file = ProjectFile.objects.get(id=f.json()["id"])
+
+        assert get_storage_format(file.file.path) == "encrypted"
+        with open(file.file.path, "rb") as stored:
+            assert b"GENE1\t" not in stored.read()
+        with file.open_data() as data:
+            assert data.read() == filecontent
+        assert file.get_data_size() == len(filecontent)
+        assert file.blob.content.filter(search_vector="GENE19999").exists()
+        rows = {result["row"] for result in search_file(file.file.path, ["GENE1234"])}
+        assert rows == {1235}
+        response = self.client.get(f"/api/files/{file.id}/download")
+        assert b"".join(response.streaming_content) == filecontent
+
+    def test_replaced_file_encrypted(self):
+        project = Project.objects.create(name="test", description="test", global_id="test", encrypted=True)
+        filecontent = b"GENE1\tkinase\n"
+        file = ProjectFile.objects.create(name="test.tsv", project=project, hash="outdated",
+                                          file=ContentFile(filecontent, name="test.tsv"))
+        # the admin saves a replaced file through save_altered
+        file.save_altered()
+        assert file.hash == hashlib.sha1(filecontent).hexdigest()
+        assert get_storage_format(file.file.path) == "encrypted"
+        # the content is hashed and not the encrypted bytes on disk
+        file.save_altered()
+        assert file.hash == hashlib.sha1(filecontent).hexdigest()
+        with file.open_data() as data:
+            assert data.read() == filecontent
+
+
+@override_settings(INGEST_IN_BACKGROUND=False, FILE_STORAGE_COMPRESSION=True)
+class CompressedStorageTestCase(TestCase):
+    def setUp(self):
+        user = add_test_user()
+        self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+        self.filecontent = b"Gene\tValue\n" + b"".join(f"GENE{i}\t{i % 13}\n".encode() for i in range(50000))
+
+    def upload(self, project: Project) -> ProjectFile:
+        filecontent = self.filecontent
+        d = self.client.post('/api/files/chunked', {"file_category": "searched", "filename": "test.tsv", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest()})
+        upload_id = d.json()["upload_id"]
+        self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(filecontent).hexdigest(), "chunk": ContentFile(filecontent, name="test.tsv")})
+        f = self.client.post(f'/api/files/chunked/{upload_id}/complete', {"create_file": True, "project_id": project.id, "load_file_content": True}, content_type="application/json")
+        return ProjectFile.objects.get(id=f.json()["id"])
+
+    def test_framed_compression(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "data.tsv")
+            with open(path, "wb") as f:
+                compress_stream(BytesIO(self.filecontent), f, frame_size=4096)
+            assert get_storage_format(path) == "compressed"
+            assert os.path.getsize(path) < len(self.filecontent) // 3
+            with open_stored_file(path) as f:
+                f.seek(300000)
+                assert f.read(10000) == self.filecontent[300000:310000]
+                f.seek(0)
+                assert f.read() == self.filecontent
+            with open(path, "r+b") as f:
+                f.truncate(os.path.getsize(path) - 5)
+            with self.assertRaises(ValueError):
+                open_stored_file(path)
+
+    def test_compressed_project_file(self):
+        project = Project.objects.create(name="test", description="test", global_id="test")
+        file = self.upload(project)
+        assert get_storage_format(file.file.path) == "compressed"
+        assert os.path.getsize(file.file.path) < len(self.filecontent) // 3
+        assert file.get_data_size() == len(self.filecontent)
+        assert file.blob.content.filter(search_vector="GENE49999").exists()
+        assert {result["row"] for result in search_file(file.file.path, ["GENE1234"])} == {1236}
+        group = AnalysisGroup.objects.create(project=project, searched_file=file)
+        assert list(group.get_searched_line([1236])) == [(1236, {"Gene": "GENE1235", "Value": "0"})]
+        response = self.client.get(f"/api/files/{file.id}/download")
+        assert b"".join(response.streaming_content) == self.filecontent
+
+    def test_search_compressed_file_on_windows(self):
+        file = self.upload(Project.objects.create(name="test", description="test", global_id="test"))
+        windows = mock.Mock()
+        windows.name = "nt"
+        with mock.patch("corpusx.consumers.os", windows):
+            result = CurrentCorpusX.search.__wrapped__(CurrentCorpusX(perspective="node"), "GENE1234")
+        assert 1236 in result["found_lines"][file.id]
+
+    def test_compressed_encrypted_project_file(self):
+        project = Project.objects.create(name="test", description="test", global_id="test", encrypted=True)
+        file = self.upload(project)
+        assert get_storage_format(file.file.path) == "encrypted"
+        assert os.path.getsize(file.file.path) < len(self.filecontent) // 3
+        with file.open_data() as data:
+            assert data.read() == self.filecontent
+
+    def test_compress_files_command(self):
+        with override_settings(FILE_STORAGE_COMPRESSION=False):
+            file = self.upload(Project.objects.create(name="test", description="test", global_id="test"))
+        assert get_storage_format(file.file.path) == "plain"
+        out = StringIO()
+        call_command("compress_files", stdout=out)
+        assert "compressed 1 files" in out.getvalue()
+        assert get_storage_format(file.file.path) == "compressed"
+        with file.open_data("rt") as data:
+            assert data.readline() == "Gene\tValue\n"
+
+    def test_export_compressed_legacy_file(self):
+        project = Project.objects.create(name="test", description="test", global_id="legacy")
+        file = ProjectFile.objects.create(name="test.tsv", project=project, hash=hashlib.sha1(self.filecontent).hexdigest(),
+                                          file=ContentFile(self.filecontent, name="test.tsv"))
+        call_command("compress_files", stdout=StringIO())
+        assert get_storage_format(file.file.path) == "compressed"
+        assert file.get_data_size() == len(self.filecontent)
+        response = self.client.get(f"/api/projects/{project.id}/export")
+        archive = b"".join(response.streaming_content)
+        Project.objects.filter(id=project.id).update(global_id="original")
+        d = self.client.post("/api/projects/import", archive, content_type="application/gzip")
+        assert d.status_code == 200
+        with Project.objects.get(id=d.json()["id"]).files.get().open_data() as data:
+            assert data.read() == self.filecontent
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        user = add_test_user()
+        self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+        self.project = Project.objects.create(name="test", description="test", hash="test", global_id="test")
+        self.other_project = Project.objects.create(name="other", description="other", hash="other", global_id="other")
+        self.files = []
+        for project, data in [(self.project, "kinase kinase"), (self.project, "kinase"), (self.other_project, "phosphatase")]:
+            file = ProjectFile.objects.create(name="test.tsv", project=project, hash="test", file=ContentFile(data.encode(), name="test.tsv"))
+            ProjectFileContent.objects.create(project_file=file, data=data)
+            ProjectFileContent.objects.create(project_file=file, data=data)
+            self.files.append(file)
+        self.blob_project = Project.objects.create(name="blob", description="blob", hash="blob", global_id="blob")
+        blob = FileBlob.objects.create(hash="blob", size=6, ref_count=1, file=ContentFile(b"kinase", name="blob.tsv"))
+        ProjectFileContent.objects.create(blob=blob, data="kinase")
+        file = ProjectFile.objects.create(name="blob.tsv", project=self.blob_project, hash="blob", file=blob.file.name, blob=blob)
+        self.files.append(file)
+
+    def test_search_file_pages(self):
+        d = self.client.get("/api/search/file/kinase", {"limit": 1})
+        assert d.status_code == 200
+        assert [i["id"] for i in d.json()["items"]] == [self.files[0].id]
+        assert "<b>kinase</b>" in d.json()["items"][0]["headline"]
+        e = self.client.get("/api/search/file/kinase", {"limit": 1, "cursor": d.json()["next_cursor"]})
+        assert [i["id"] for i in e.json()["items"]] == [self.files[1].id]
+        e = self.client.get("/api/search/file/kinase", {"limit": 1, "cursor": e.json()["next_cursor"]})
+        assert [i["id"] for i in e.json()["items"]] == [self.files[3].id]
+        assert "<b>kinase</b>" in e.json()["items"][0]["headline"]
+        assert e.json()["next_cursor"] == None
+        assert self.client.get("/api/search/file/kinase", {"cursor": "not a cursor"}).status_code == 400
+        assert self.client.get("/api/search/file/kinase", {"cursor": encode_cursor({"id": 1})}).status_code == 400
+        with override_settings(PAGE_MAX_LIMIT=2):
+            d = self.client.get("/api/search/file/kinase", {"limit": 1000})
+        assert len(d.json()["items"]) == 2
+
+    def test_search_files_and_blobs(self):
+        ProjectFile.objects.update(file_category="searched")
+        result = CurrentCorpusX.search.__wrapped__(CurrentCorpusX(perspective="node"), "kinase")
+        assert sorted(file["id"] for file in result["file"]) == [self.files[0].id, self.files[1].id, self.files[3].id]
+        assert {project["id"] for project in result["project"]} == {self.project.id, self.blob_project.id}
+
+    def test_search_project(self):
+        d = self.client.get("/api/search/project/kinase")
+        assert d.status_code == 200
+        assert [i["id"] for i in d.json()["items"]] == [self.project.id, self.blob_project.id]
+        assert d.json()["next_cursor"] == None
+
+
+class StreamingChunkedUploadTestCase(TestCase):
+    def setUp(self):
+        user = add_test_user()
+        self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+
+    def initiate(self, filecontent):
+        d = self.client.post('/api/files/chunked', {"file_category": "other", "filename": "test.tsv", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest()})
+        assert d.status_code == 200
+        return d.json()["upload_id"]
+
+    def test_chunked_upload_complete_links_file(self):
+        filecontent = b"a\tb\n" * 1000
+        upload_id = self.initiate(filecontent)
+        for offset in range(0, len(filecontent), 1000):
+            e = self.client.post(f'/api/files/chunked/{upload_id}', {"offset": offset, "chunk": ContentFile(filecontent[offset:offset + 1000], name="test.tsv")})
+            assert e.status_code == 200
+        assert e.json()["status"] == "complete"
+        e = self.client.post(f'/api/files/chunked/{upload_id}', {"offset": 0, "chunk": ContentFile(b"late", name="test.tsv")})
+        assert e.status_code == 400
+        project = Project.objects.create(name="test", description="test", hash="test", global_id="test")
+        f = self.client.post(f'/api/files/chunked/{upload_id}/complete', {"create_file": True, "project_id": project.id, "delete": True}, content_type="application/json")
+        assert f.status_code == 200
+        file = ProjectFile.objects.get(id=f.json()["id"])
+        assert file.project == project
+        assert file.hash == hashlib.sha1(filecontent).hexdigest()
+        with file.file.open("rb") as data:
+            assert data.read() == filecontent
+
+    def test_chunked_upload_retry_and_hash_mismatch(self):
+        filecontent = b"0123456789"
+        upload_id = self.initiate(filecontent)
+        e = self.client.post(f'/api/files/chunked/{upload_id}', {"offset": 0, "chunk": ContentFile(b"01234", name="test.tsv")})
+        assert e.json()["offset"] == 5
+        e = self.client.post(f'/api/files/chunked/{upload_id}', {"offset": 0, "chunk": ContentFile(b"01234", name="test.tsv")})
+        assert e.json()["offset"] == 5
+        e = self.client.post(f'/api/files/chunked/{upload_id}', {"offset": 8, "chunk": ContentFile(b"89", name="test.tsv")})
+        assert e.status_code == 400
+        e = self.client.post(f'/api/files/chunked/{upload_id}', {"offset": 5, "chunk": ContentFile(b"5678X", name="test.tsv")})
+        assert e.status_code == 400
+        assert e.json()["error"] == "hash mismatch"
+        e = self.client.post(f'/api/files/chunked/{upload_id}', {"offset": 5, "chunk": ContentFile(b"56789", name="test.tsv")})
+        assert e.json()["status"] == "complete"
+
+
+class IndexedChunkedUploadTestCase(TestCase):
+    def setUp(self):
+        user = add_test_user()
+        self.client = Client(headers={"AUTHORIZATION": f"Bearer {user.auth_token.key}"})
+
+    def test_out_of_order_chunks(self):
+        filecontent = bytes(range(256)) * 10000
+        d = self.client.post('/api/files/chunked', {"file_category": "other", "filename": "test.bin", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest()})
+        upload_id = d.json()["upload_id"]
+        chunk_size = d.json()["chunk_size"]
+        chunks = [filecontent[i:i + chunk_size] for i in range(0, len(filecontent), chunk_size)]
+        assert len(chunks) == 3
+
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/2', {"checksum": hashlib.sha1(chunks[2]).hexdigest(), "chunk": ContentFile(chunks[2], name="test.bin")})
+        assert e.status_code == 200
+        assert e.json()["offset"] == 0
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(b"corrupt").hexdigest(), "chunk": ContentFile(chunks[0], name="test.bin")})
+        assert e.status_code == 400
+        assert e.json()["error"] == "checksum mismatch"
+        assert self.client.get(f'/api/files/chunked/{upload_id}').json()["missing_chunks"] == [0, 1]
+
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(chunks[0]).hexdigest(), "chunk": ContentFile(chunks[0], name="test.bin")})
+        assert e.json()["offset"] == chunk_size
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/1', {"checksum": hashlib.sha1(chunks[1]).hexdigest(), "chunk": ContentFile(chunks[1], name="test.bin")})
+        assert e.json()["status"] == "complete"
+        assert e.json()["offset"] == len(filecontent)
+        assert self.client.get(f'/api/files/chunked/{upload_id}').json()["missing_chunks"] == []
+        f = self.client.post(f'/api/files/chunked/{upload_id}/complete', {"create_file": True}, content_type="application/json")
+        # a late or corrupted chunk must not reach the staged file that is now linked into the stored file
+        late = b"X" * chunk_size
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(late).hexdigest(), "chunk": ContentFile(late, name="test.bin")})
+        assert e.json()["status"] == "complete"
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/1', {"checksum": hashlib.sha1(chunks[1]).hexdigest(), "chunk": ContentFile(late, name="test.bin")})
+        assert e.status_code == 400
+        with ProjectFile.objects.get(id=f.json()["id"]).file.open("rb") as data:
+            assert data.read() == filecontent
+
+    def test_corrupted_file_is_sent_again(self):
+        filecontent = bytes(range(256)) * 10000
+        corrupted = filecontent[:-1] + b"X"
+        d = self.client.post('/api/files/chunked', {"file_category": "other", "filename": "test.bin", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest()})
+        upload_id = d.json()["upload_id"]
+        chunk_size = d.json()["chunk_size"]
+
+        def send(content):
+            for index, start in enumerate(range(0, len(content), chunk_size)):
+                chunk = content[start:start + chunk_size]
+                e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/{index}', {"checksum": hashlib.sha1(chunk).hexdigest(), "chunk": ContentFile(chunk, name="test.bin")})
+            return e
+
+        # every chunk matches its own checksum but the assembled file does not match its hash
+        e = send(corrupted)
+        assert e.status_code == 400
+        assert e.json()["error"] == "hash mismatch"
+        status = self.client.get(f'/api/files/chunked/{upload_id}').json()
+        assert status["status"] != "complete"
+        assert status["missing_chunks"] == [0, 1, 2]
+        e = send(filecontent)
+        assert e.json()["status"] == "complete"
+        f = self.client.post(f'/api/files/chunked/{upload_id}/complete', {"create_file": True}, content_type="application/json")
+        with ProjectFile.objects.get(id=f.json()["id"]).file.open("rb") as data:
+            assert data.read() == filecontent
+
+    def test_compressed_chunks(self):
+        filecontent = b"gene\tvalue\n" * 200000
+        d = self.client.post('/api/files/chunked', {"file_category": "other", "filename": "test.tsv", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest(), "accept_encoding": "br,gzip"})
+        assert d.json()["encoding"] == "gzip"
+        upload_id = d.json()["upload_id"]
+        chunk_size = d.json()["chunk_size"]
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(filecontent[:chunk_size]).hexdigest(), "chunk": ContentFile(b"not gzip", name="test.tsv")})
+        assert e.json()["error"] == "invalid chunk encoding"
+        for index, start in enumerate(range(0, len(filecontent), chunk_size)):
+            chunk = filecontent[start:start + chunk_size]
+            e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/{index}', {"checksum": hashlib.sha1(chunk).hexdigest(), "chunk": ContentFile(compress_data(chunk, "gzip"), name="test.tsv")})
+            assert e.status_code == 200
+        assert e.json()["status"] == "complete"
+        f = self.client.post(f'/api/files/chunked/{upload_id}/complete', {"create_file": True}, content_type="application/json")
+        with ProjectFile.objects.get(id=f.json()["id"]).file.open("rb") as data:
+            assert data.read() == filecontent
+
+    def test_adaptive_chunk_size(self):
+        filecontent = bytes(range(256)) * 20000
+        d = self.client.post('/api/files/chunked', {"file_category": "other", "filename": "test.bin", "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest()})
+        upload_id = d.json()["upload_id"]
+        block_size = d.json()["block_size"]
+        assert d.json()["chunk_size"] == block_size
+
+        upload = ChunkedUpload.objects.get(upload_id=upload_id)
+        upload.adjust_chunk_size(block_size, 0.01)
+        assert upload.chunk_size == 2 * block_size
+        upload.adjust_chunk_size(block_size, 0.01)
+        assert upload.chunk_size == 4 * block_size
+        upload.save()
+
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(b"corrupt").hexdigest(), "chunk": ContentFile(filecontent[:4 * block_size], name="test.bin")})
+        assert e.json()["error"] == "checksum mismatch"
+        upload.refresh_from_db()
+        assert upload.chunk_size == 2 * block_size
+        assert upload.chunk_errors == 1
+
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(filecontent[:block_size + 1]).hexdigest(), "chunk": ContentFile(filecontent[:block_size + 1], name="test.bin")})
+        assert e.json()["error"] == "chunk size mismatch"
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/1', {"checksum": hashlib.sha1(filecontent[block_size:]).hexdigest(), "chunk": ContentFile(filecontent[block_size:], name="test.bin")})
+        assert e.status_code == 200
+        assert self.client.get(f'/api/files/chunked/{upload_id}').json()["missing_chunks"] == [0]
+        e = self.client.post(f'/api/files/chunked/{upload_id}/chunks/0', {"checksum": hashlib.sha1(filecontent[:block_size]).hexdigest(), "chunk": ContentFile(filecontent[:block_size], name="test.bin")})
+        assert e.json()["status"] == "complete"
+
+
+class ChunkedUploadSenderTestCase(TestCase):
+    def setUp(self):
+        add_public_topic()
+        self.api_key = add_test_api_key()[0]
+        self.dropped = set()
+        self.block_bytes = 0
+
+    def forward(self, request: httpx.Request):
+        path = request.url.raw_path.decode()
+        if "/blocks/" in path:
+            self.block_bytes += len(request.read())
+        if path.endswith("/chunks/1") and path not in self.dropped:
+            self.dropped.add(path)
+            raise httpx.ConnectError("connection dropped", request=request)
+        response = self.client.generic(request.method, path, request.read(),
+                                       content_type=request.headers.get("content-type", ""),
+                                       headers={"X-API-Key": request.headers["x-api-key"]})
+        return httpx.Response(response.status_code, headers={"content-type": response["Content-Type"]},
+                              content=response.content)
+
+    async def handle(self, request: httpx.Request):
+        return await sync_to_async(self.forward)(request)
+
+    def test_send_file_with_dropped_chunk(self):
+        filecontent = bytes(range(256)) * 20000
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(filecontent)
+
+        async def send():
+            async with ChunkedUploadSender("http://testserver", self.api_key, window=3, retries=2,
+                                           transport=httpx.MockTransport(self.handle)) as sender:
+                return await sender.upload(f.name, "test.bin", len(filecontent),
+                                           hashlib.sha1(filecontent).hexdigest(), "other",
+                                           complete_json={"create_file": True})
+
+        try:
+            result = async_to_sync(send)()
+        finally:
+            os.remove(f.name)
+        assert self.dropped
+        with ProjectFile.objects.get(id=result["id"]).file.open("rb") as data:
+            assert data.read() == filecontent
+
+    def test_delta_upload(self):
+        rows = [f"GENE{i}\t{i * 7919 % 10007}\t{i * 104729 % 1000003}\n".encode() for i in range(100000)]
+        file = ProjectFile.objects.create(name="test.tsv", hash=hashlib.sha1(b"".join(rows)).hexdigest(),
+                                          file=ContentFile(b"".join(rows), name="test.tsv"))
+        rows.insert(50000, b"NEW\t1\t2\n")
+        rows[90000] = b"CHANGED\t3\t4\n"
+        filecontent = b"".join(rows)
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(filecontent)
+
+        async def send():
+            async with ChunkedUploadSender("http://testserver", self.api_key,
+                                           transport=httpx.MockTransport(self.handle)) as sender:
+                return await sender.upload_delta(f.name, file.id, len(filecontent),
+                                                 hashlib.sha1(filecontent).hexdigest())
+
+        try:
+            result = async_to_sync(send)()
+        finally:
+            os.remove(f.name)
+        assert 0 < self.block_bytes < len(filecontent) // 10
+        file.refresh_from_db()
+        assert result["hash"] == file.hash == hashlib.sha1(filecontent).hexdigest()
+        assert file.block_manifest["hash"] == file.hash
+        with file.file.open("rb") as data:
+            assert data.read() == filecontent
+
+    def test_delta_block_checked_before_write(self):
+        base = b"a" * 100
+        file = ProjectFile.objects.create(name="test.tsv", hash=hashlib.sha1(base).hexdigest(),
+                                          file=ContentFile(base, name="test.tsv"))
+        blocks = [b"b" * 50, b"c" * 50]
+        filecontent = b"".join(blocks)
+        client = Client(headers={"X-API-Key": self.api_key})
+        d = client.post(f"/api/files/{file.id}/delta", {
+            "size": len(filecontent), "data_hash": hashlib.sha1(filecontent).hexdigest(),
+            "blocks": [[hashlib.sha1(block).hexdigest(), len(block)] for block in blocks]}, content_type="application/json")
+        upload_id = d.json()["upload_id"]
+        e = client.post(f"/api/files/chunked/{upload_id}/blocks/0", {"chunk": ContentFile(blocks[1], name="test.tsv")})
+        assert e.json()["error"] == "checksum mismatch"
+        for index, block in enumerate(blocks):
+            e = client.post(f"/api/files/chunked/{upload_id}/blocks/{index}", {"chunk": ContentFile(block, name="test.tsv")})
+        assert e.json()["status"] == "complete"
+        e = client.post(f"/api/files/chunked/{upload_id}/blocks/0", {"chunk": ContentFile(b"X" * 50, name="test.tsv")})
+        assert e.status_code == 400
+        with open(ChunkedUpload.objects.get(upload_id=upload_id).file.path, "rb") as data:
+            assert data.read() == filecontent
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class PeerTransferTestCase(TestCase):
+    def setUp(self):
+        add_public_topic()
+        self.api_key = add_test_api_key()[0]
+        self.session = add_test_websocket_session()
+        self.sent = {}
+
+    def create_transfer(self, content: bytes) -> ChunkedUpload:
+        requested = {"id": 1, "name": "test.bin", "hash": hashlib.sha1(content).hexdigest(), "file_category": "other"}
+        return ChunkedUpload.create_transfer(requested, self.session.session_id, "client", "public")
+
+    def get_handler(self, node: str):
+        def forward(request: httpx.Request):
+            path = request.url.raw_path.decode()
+            if "/chunks/" in path:
+                self.sent[node] = self.sent.get(node, 0) + len(request.read())
+            response = self.client.generic(request.method, path, request.read(),
+                                           content_type=request.headers.get("content-type", ""),
+                                           headers={"X-API-Key": request.headers["x-api-key"]})
+            return httpx.Response(response.status_code, headers={"content-type": response["Content-Type"]},
+                                  content=response.content)
+
+        async def handle(request: httpx.Request):
+            return await sync_to_async(forward)(request)
+        return handle
+
+    def test_claim_ranges(self):
+        transfer = self.create_transfer(b"")
+        transfer.total_size = 4 * transfer.block_size
+        transfer.chunk_size = 2 * transfer.block_size
+        assert transfer.claim_range("a") == (0, 2)
+        assert transfer.claim_range("b") == (2, 2)
+        # a is asking again so it is done with its range, every missing block is claimed and b holds the oldest
+        transfer.transfer["claims"]["2"][1] -= 1
+        assert transfer.claim_range("a") == (0, 2)
+        assert transfer.claim_range("c") == (2, 2)
+        transfer.mark_blocks_received(0, 4 * transfer.block_size)
+        assert transfer.claim_range("a") is None
+
+    def test_transfer_from_several_nodes(self):
+        content = bytes(range(256)) * 24000
+        transfer = self.create_transfer(content)
+        paths = []
+        for _ in range(2):
+            with tempfile.NamedTemporaryFile(delete=False) as f:
+                f.write(content)
+            paths.append(f.name)
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(f"{self.session.session_id}_result", channel_name)
+
+        async def send(node: str, path: str):
+            async with ChunkedUploadSender("http://testserver", self.api_key, window=2,
+                                           transport=httpx.MockTransport(self.get_handler(node))) as sender:
+                return await sender.upload_ranges(path, str(transfer.upload_id), node, len(content),
+                                                  hashlib.sha1(content).hexdigest())
+
+        async def send_all():
+            return await asyncio.gather(*[send(f"node{i}", path) for i, path in enumerate(paths)])
+
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                results = async_to_sync(send_all)()
+        finally:
+            for path in paths:
+                os.remove(path)
+        assert all(result["status"] == "complete" for result in results)
+        assert len(self.sent) == 2
+        assert all(sent < len(content) for sent in self.sent.values())
+        transfer.refresh_from_db()
+        file = ProjectFile.objects.get(id=transfer.transfer["file_id"])
+        with file.file.open("rb") as data:
+            assert data.read() == content
+        assert self.session.files.filter(id=file.id).exists()
+        message = async_to_sync(channel_layer.receive)(channel_name)["message"]
+        assert message["requestType"] == "file-upload"
+        assert message["data"][1]["id"] == file.id
+
+        response = self.client.post(f"/api/files/chunked/{transfer.upload_id}/claim",
+                                    {"node_id": "node2", "size": len(content) + 1, "data_hash": transfer.hash},
+                                    headers={"X-API-Key": self.api_key})
+        assert response.status_code == 400
+
+        async def send_mismatched():
+            # every claim is rejected, the workers stop without taking the others down and the status is returned
+            async with ChunkedUploadSender("http://testserver", self.api_key, window=2,
+                                           transport=httpx.MockTransport(self.get_handler("node2"))) as sender:
+                return await sender.upload_ranges(__file__, str(transfer.upload_id), "node2", len(content) + 1,
+                                                  transfer.hash)
+
+        assert async_to_sync(send_mismatched)()["status"] == "complete"
+
+
+    def test_node_sends_claimed_ranges(self):
+        content = bytes(range(256)) * 12000
+        transfer = self.create_transfer(content)
+        api_key = APIKey.objects.get(name="test")
+        api_key.access_all = True
+        api_key.allow_download = True
+        api_key.receive_remote_api_key(self.api_key)
+        api_key.save()
+        project = Project.objects.create(name="node", description="")
+        file = ProjectFile.objects.create(name="test.bin", file=ContentFile(content, name="test.bin"), project=project,
+                                          hash=transfer.hash, file_category="other")
+        command = Command()
+        command.api_key = api_key
+        command.decoded_api_key = self.api_key
+        current = CurrentCorpusX(api_key, perspective="node")
+        message = {"targetID": "node0", "sessionID": self.session.session_id, "clientID": "client",
+                   "pyreName": "public", "data": {"id": file.id, "hash": transfer.hash,
+                                                  "transfer": {"upload_id": str(transfer.upload_id)}}}
+        with mock.patch.object(CurrentCorpusX.send_project_file_ranges, "delay") as delay, \
+                mock.patch.object(CurrentCorpusX.upload_project_file, "delay") as upload:
+            async_to_sync(command.handle_file_request)(current, message, {"server_id": "node0"})
+        upload.assert_not_called()
+        sender = functools.partial(ChunkedUploadSender, transport=httpx.MockTransport(self.get_handler("node0")))
+        with mock.patch("cephalon.models.ChunkedUploadSender", sender), self.captureOnCommitCallbacks(execute=True):
+            result = CurrentCorpusX.send_project_file_ranges(*delay.call_args.args)
+        assert result["status"] == "complete"
+        assert self.sent["node0"] > 0
+        transfer.refresh_from_db()
+        received = ProjectFile.objects.get(id=transfer.transfer["file_id"])
+        with received.file.open("rb") as data:
+            assert data.read() == content
+
+    def test_nodes_find_transfer_file_by_hash(self):
+        content = b"shared content"
+        transfer = self.create_transfer(content)
+        api_key = APIKey.objects.get(name="test")
+        api_key.allow_download = True
+        project = Project.objects.create(name="node", description="")
+        # the file is held by two nodes under different ids, the request carries the id of the node the user picked
+        other = ProjectFile.objects.create(name="other.bin", file=ContentFile(b"other", name="other.bin"),
+                                           project=project, hash=hashlib.sha1(b"other").hexdigest(), file_category="other")
+        file = ProjectFile.objects.create(name="test.bin", file=ContentFile(content, name="test.bin"), project=project,
+                                          hash=transfer.hash, file_category="other")
+        command = Command()
+        command.api_key = api_key
+        current = CurrentCorpusX(api_key, perspective="node")
+        message = {"targetID": "node1", "sessionID": self.session.session_id, "clientID": "client",
+                   "pyreName": "public", "data": {"id": other.id, "hash": transfer.hash,
+                                                  "transfer": {"upload_id": str(transfer.upload_id)}}}
+        with mock.patch.object(CurrentCorpusX.send_project_file_ranges, "delay") as delay:
+            async_to_sync(command.handle_file_request)(current, message, {"server_id": "node1"})
+            assert delay.call_args.args[1] == file
+            delay.reset_mock()
+            # a node without the content stays out of the transfer
+            message["data"]["hash"] = hashlib.sha1(b"missing").hexdigest()
+            async_to_sync(command.handle_file_request)(current, message, {"server_id": "node1"})
+            delay.assert_not_called()
+
+
+class SyncTestCase(TestCase):
+    def setUp(self):
+        add_public_topic()
+        self.api_key = add_test_api_key()[0]
+        self.client = Client(headers={"X-API-Key": self.api_key})
+        self.manifest = None
+
+    def add_project(self, global_id: str, contents: list[bytes]) -> Project:
+        project = Project.objects.create(name=global_id, description="", global_id=global_id)
+        for i, content in enumerate(contents):
+            ProjectFile.objects.create(name=f"{i}.txt", file=ContentFile(content, name=f"{i}.txt"), project=project,
+                                       hash=hashlib.sha1(content).hexdigest(), file_category="other")
+        project.refresh_from_db()
+        return project
+
+    def forward(self, request: httpx.Request):
+        path = request.url.raw_path.decode()
+        if path == "/api/sync/manifest":
+            return httpx.Response(200, json=self.manifest)
+        response = self.client.generic(request.method, path, request.read(),
+                                       content_type=request.headers.get("content-type", ""))
+        return httpx.Response(response.status_code, headers={"content-type": response["Content-Type"]},
+                              content=response.content)
+
+    async def handle(self, request: httpx.Request):
+        return await sync_to_async(self.forward)(request)
+
+    def test_time_window(self):
+        assert in_time_window("")
+        assert in_time_window("01:00-05:00", datetime.time(3, 0))
+        assert not in_time_window("01:00-05:00", datetime.time(5, 0))
+        assert in_time_window("22:00-06:00", datetime.time(23, 30))
+        assert in_time_window("22:00-06:00", datetime.time(2, 0))
+        assert not in_time_window("22:00-06:00", datetime.time(12, 0))
+
+    def test_sync_manifest(self):
+        same = self.add_project("same", [b"a"])
+        changed = self.add_project("changed", [b"a", b"b"])
+        body = json.dumps({"projects": {"same": same.hash, "changed": "outdated", "missing": None}})
+        # projects the key has no access to are answered as if they did not exist
+        response = self.client.post("/api/sync/manifest", body, content_type="application/json")
+        assert response.status_code == 200
+        assert response.json()["changed"] == {"id": None, "hash": None, "files": None}
+
+        topic = add_public_topic()
+        topic.projects.add(same, changed)
+        APIKey.objects.get(name="test").access_topics.add(topic)
+        response = self.client.post("/api/sync/manifest", body, content_type="application/json")
+        assert response.status_code == 200
+        result = response.json()
+        assert result["same"] == {"id": same.id, "hash": same.hash, "files": None}
+        assert result["changed"]["id"] == changed.id
+        assert sorted(result["changed"]["files"]) == sorted(changed.files.values_list("hash", flat=True))
+        assert result["missing"]["id"] is None
+
+    def test_push_missing_files(self):
+        local = self.add_project("local", [b"only local", b"shared"])
+        local.files.update(description="pushed", metadata={"a": 1}, file_type="json")
+        remote = self.add_project("remote", [b"shared"])
+        self.manifest = {"local": {"id": remote.id, "hash": remote.hash,
+                                   "files": list(remote.files.values_list("hash", flat=True))}}
+        projects = list(Project.objects.filter(id=local.id).prefetch_related("files"))
+
+        stats = async_to_sync(push_projects)("http://testserver", self.api_key, projects, "",
+                                             transport=httpx.MockTransport(self.handle))
+        assert stats["files"] == 1
+        assert sorted(remote.files.values_list("hash", flat=True)) == sorted(local.files.values_list("hash", flat=True))
+        pushed = remote.files.get(hash=hashlib.sha1(b"only local").hexdigest())
+        assert (pushed.description, pushed.metadata, pushed.file_type, pushed.hash_algorithm) == ("pushed", {"a": 1}, "json", "sha1")
+        # the files were added in another order on each side and the project hashes still agree
+        remote.refresh_from_db()
+        assert remote.hash == local.hash
+
+        self.manifest["local"]["hash"] = local.hash
+        stats = async_to_sync(push_projects)("http://testserver", self.api_key, projects, "",
+                                             transport=httpx.MockTransport(self.handle))
+        assert stats["files"] == 0
+
+
 class SearchResultTestCase(TestCase):
     def setUp(self):
         pass
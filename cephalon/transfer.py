@@ -0,0 +1,266 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+import httpx
+from django.conf import settings
+
+from cephalon.utils import get_supported_encodings, compress_data, get_block_manifest, hash_data, open_stored_file
+
+
+class RateLimiter:
+    """
+    A token bucket shared by concurrent senders to keep the bytes sent per second under a limit. A burst of up to one
+    second of data is allowed.
+    """
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, size: int):
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= size
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+class ChunkedUploadSender:
+    """
+    A class to send a local file to another instance through the chunked upload api. Chunks are sent by index with
+    their own checksum over a single reused connection pool while up to window chunks are in flight. After a dropped
+    connection or a rejected chunk the sender asks the receiver which chunks are still missing and only sends those.
+    """
+
+    def __init__(self, host: str, api_key: str, window: int = None, http2: bool = None, retries: int = None,
+                 transport: httpx.AsyncBaseTransport = None, limiter: RateLimiter = None):
+        self.host = host
+        self.api_key = api_key
+        self.window = window or settings.CHUNKED_UPLOAD_WINDOW
+        self.http2 = settings.CHUNKED_UPLOAD_HTTP2 if http2 is None else http2
+        self.retries = settings.CHUNKED_UPLOAD_RETRIES if retries is None else retries
+        self.transport = transport
+        self.limiter = limiter
+        self.client = None
+        self.read_lock = threading.Lock()
+
+    async def __aenter__(self):
+        self.client = httpx.AsyncClient(
+            headers={"X-API-Key": self.api_key},
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=self.window, max_keepalive_connections=self.window),
+            timeout=httpx.Timeout(60.0),
+            transport=self.transport,
+        )
+        return self
+
+    async def __aexit__(self, *args):
+        await self.client.aclose()
+        self.client = None
+
+    async def initiate(self, filename: str, size: int, data_hash: str, file_category: str,
+                       hash_algorithm: str = "sha1") -> dict:
+        response = await self.client.post(f"{self.host}/api/files/chunked", data={
+            "filename": filename,
+            "size": size,
+            "data_hash": data_hash,
+            "file_category": file_category,
+            "accept_encoding": ",".join(get_supported_encodings()),
+            "hash_algorithm": hash_algorithm
+        })
+        response.raise_for_status()
+        return response.json()
+
+    async def get_status(self, upload_id: str) -> dict:
+        response = await self.client.get(f"{self.host}/api/files/chunked/{upload_id}")
+        response.raise_for_status()
+        return response.json()
+
+    def read_chunk(self, f, offset: int, size: int, encoding: str, hash_algorithm: str = None):
+        """
+        Read, hash and compress a chunk of the file in a worker thread. The file handle is shared between the workers
+        so the seek and read are done under a lock.
+        """
+        with self.read_lock:
+            f.seek(offset)
+            chunk = f.read(size)
+        checksum = hash_data(chunk, hash_algorithm) if hash_algorithm else None
+        if encoding != "identity":
+            chunk = compress_data(chunk, encoding)
+        return chunk, checksum
+
+    async def send_chunk(self, f, upload: dict, index: int, size: int) -> dict:
+        chunk, checksum = await asyncio.to_thread(
+            self.read_chunk, f, index * upload.get("block_size", upload["chunk_size"]), size,
+            upload.get("encoding", "identity"), upload.get("hash_algorithm", "sha1")
+        )
+        if self.limiter:
+            await self.limiter.consume(len(chunk))
+        try:
+            response = await self.client.post(
+                f"{self.host}/api/files/chunked/{upload['upload_id']}/chunks/{index}",
+                data={"checksum": checksum},
+                files={"chunk": (upload["filename"], chunk)},
+            )
+        except httpx.TransportError:
+            return None
+        return response.json() if response.status_code == 200 else None
+
+    async def send_chunks(self, f, upload: dict, indexes: list[int]):
+        """
+        Send the missing blocks at the given indexes. Each request covers as many consecutive missing blocks as fit
+        in the chunk size last reported by the receiver.
+        """
+        pending = deque(sorted(indexes))
+
+        async def worker():
+            while pending:
+                index = pending.popleft()
+                block_size = upload.get("block_size", upload["chunk_size"])
+                count = 1
+                while count < upload["chunk_size"] // block_size and pending and pending[0] == index + count:
+                    pending.popleft()
+                    count += 1
+                result = await self.send_chunk(f, upload, index, count * block_size)
+                if result:
+                    upload["chunk_size"] = result["chunk_size"]
+
+        await asyncio.gather(*[worker() for _ in range(min(self.window, len(indexes)))])
+
+    async def send_file(self, f, upload: dict) -> dict:
+        """
+        Send every chunk the receiver is still missing and return the final state of the upload
+        """
+        status = await self.get_status(upload["upload_id"])
+        for attempt in range(self.retries + 1):
+            if status["status"] == "complete":
+                return status
+            if attempt:
+                await asyncio.sleep(min(2 ** attempt * 0.5, 30))
+            await self.send_chunks(f, upload, status["missing_chunks"])
+            try:
+                status = await self.get_status(upload["upload_id"])
+            except httpx.TransportError:
+                continue
+        return status
+
+    async def upload(self, path: str, filename: str, size: int, data_hash: str, file_category: str,
+                     complete_path: str = "complete", complete_json: dict = None, upload_id: str = None,
+                     hash_algorithm: str = "sha1") -> dict:
+        """
+        Upload a file and complete the upload on the receiver. Passing the id of an earlier upload resumes it from
+        the chunks the receiver already holds.
+        """
+        if upload_id:
+            upload = await self.get_status(upload_id)
+        else:
+            upload = await self.initiate(filename, size, data_hash, file_category, hash_algorithm)
+        with open_stored_file(path) as f:
+            status = await self.send_file(f, upload)
+        if status["status"] != "complete":
+            raise IOError(f"chunked upload {upload['upload_id']} of {filename} did not complete")
+        result = await self.client.post(f"{self.host}/api/files/chunked/{upload['upload_id']}/{complete_path}",
+                                        json=complete_json)
+        return result.json()
+
+    async def claim_range(self, upload_id: str, node_id: str, size: int, data_hash: str) -> dict:
+        response = await self.client.post(f"{self.host}/api/files/chunked/{upload_id}/claim", data={
+            "node_id": node_id,
+            "size": size,
+            "data_hash": data_hash,
+        })
+        response.raise_for_status()
+        return response.json()
+
+    async def upload_ranges(self, path: str, upload_id: str, node_id: str, size: int, data_hash: str) -> dict:
+        """
+        Take part in a transfer of one file that the receiver splits between several nodes holding it. Each of
+        window workers claims a range of blocks, sends it as one indexed chunk and claims the next one until no
+        block is missing. The receiver completes the file itself once the last range arrives. A claim the receiver
+        rejects only stops the worker that made it, the other workers and nodes carry on with their ranges.
+        """
+        async def worker(claimer: str):
+            failures = 0
+            while failures <= self.retries:
+                try:
+                    claim = await self.claim_range(upload_id, claimer, size, data_hash)
+                except (httpx.HTTPStatusError, httpx.TransportError) as e:
+                    if isinstance(e, httpx.HTTPStatusError) and e.response.is_client_error:
+                        return
+                    failures += 1
+                    await asyncio.sleep(min(2 ** failures * 0.5, 30))
+                    continue
+                if claim["index"] is None:
+                    return
+                result = await self.send_chunk(f, claim, claim["index"], claim["count"] * claim["block_size"])
+                failures = 0 if result else failures + 1
+
+        with open_stored_file(path) as f:
+            await asyncio.gather(*[worker(f"{node_id}/{i}") for i in range(self.window)])
+        return await self.get_status(upload_id)
+
+    async def send_blocks(self, f, upload: dict, indexes: list[int]):
+        """
+        Send the content defined blocks at the given indexes of a delta upload
+        """
+        queue = deque(indexes)
+        offsets = [0]
+        for _, size in upload["blocks"]:
+            offsets.append(offsets[-1] + size)
+
+        async def worker():
+            while queue:
+                index = queue.popleft()
+                block, _ = await asyncio.to_thread(self.read_chunk, f, offsets[index], upload["blocks"][index][1],
+                                                   upload.get("encoding", "identity"))
+                if self.limiter:
+                    await self.limiter.consume(len(block))
+                try:
+                    await self.client.post(f"{self.host}/api/files/chunked/{upload['upload_id']}/blocks/{index}",
+                                           files={"chunk": (upload["filename"], block)})
+                except httpx.TransportError:
+                    pass
+
+        await asyncio.gather(*[worker() for _ in range(min(self.window, len(indexes)))])
+
+    async def upload_delta(self, path: str, file_id: int, size: int, data_hash: str,
+                           hash_algorithm: str = "sha1") -> dict:
+        """
+        Replace the content of an existing file on the receiver by sending the manifest of the content defined blocks
+        of the new version and then only the blocks the receiver cannot take from the current version
+        """
+        blocks = await asyncio.to_thread(get_block_manifest, path)
+        response = await self.client.post(f"{self.host}/api/files/{file_id}/delta", json={
+            "size": size,
+            "data_hash": data_hash,
+            "blocks": blocks,
+            "accept_encoding": ",".join(get_supported_encodings()),
+            "hash_algorithm": hash_algorithm
+        })
+        response.raise_for_status()
+        upload = response.json()
+        upload["blocks"] = blocks
+        with open_stored_file(path) as f:
+            for attempt in range(self.retries + 1):
+                if upload["status"] == "complete":
+                    break
+                if attempt:
+                    await asyncio.sleep(min(2 ** attempt * 0.5, 30))
+                await self.send_blocks(f, upload, upload["missing_blocks"])
+                try:
+                    response = await self.client.get(f"{self.host}/api/files/chunked/{upload['upload_id']}/blocks")
+                except httpx.TransportError:
+                    continue
+                response.raise_for_status()
+                upload.update(response.json())
+        if upload["status"] != "complete":
+            raise IOError(f"delta upload {upload['upload_id']} of file {file_id} did not complete")
+        result = await self.client.post(f"{self.host}/api/files/chunked/{upload['upload_id']}/complete",
+                                        json={"file_id": file_id})
+        return result.json()
@@ -1,23 +1,44 @@
+import base64
+import datetime
 import hashlib
+import io
+import json
 import os
+import re
 import string
+import struct
+import zlib
 from random import choice
 
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey, RSAPrivateKey
 from django.contrib.auth.hashers import make_password, BasePasswordHasher
 import jwt
 from django.utils.crypto import constant_time_compare
+from django.core.cache import cache
+from django.conf import settings
+from django.core.files import File
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import subprocess
 import shlex
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
 import cephalon
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 class Sha512ApiKeyHasher(BasePasswordHasher):
     """
@@ -46,6 +67,62 @@ class Sha512ApiKeyHasher(BasePasswordHasher):
         return constant_time_compare(encoded, encoded_2)
 
 
+class TTLCache:
+    """
+    A small bounded in-process cache where every entry expires after a time to live.
+    The least recently used entry is evicted once the cache is full.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[0] if item else None
+
+    def discard_where(self, predicate):
+        """
+        Remove every entry whose value matches the predicate
+        """
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
 def create_signed_token(payload: dict, secret_key: str):
     """
     Create a signed jwt token using pyjwt and django secret key
@@ -155,10 +232,342 @@ def decrypt_AESGCM(ciphertext: bytes, nonce: bytes, key: bytes):
     plaintext = aesgcm.decrypt(nonce, ciphertext, None)
     return plaintext
 
+# Files encrypted at rest are a header followed by segments of FILE_ENCRYPTION_SEGMENT_SIZE bytes, each sealed with
+# AES-GCM on its own. The nonce of a segment is a random prefix, the segment index and a flag set on the last segment,
+# and the header is the associated data of every segment so that it cannot be changed and segments cannot be
+# reordered, moved to another file or cut off the end.
+ENCRYPTED_FILE_MAGIC = b"\x89CXAEAD\r\n\x1a\n"
+ENCRYPTED_FILE_VERSION = 1
+ENCRYPTED_FILE_HEADER = struct.Struct(f">{len(ENCRYPTED_FILE_MAGIC)}sBI16s7s")
+ENCRYPTION_TAG_SIZE = 16
+
+
+def get_file_encryption_key(salt: bytes) -> bytes:
+    """
+    Derive the key of one encrypted file from the file encryption key of this instance and the salt in its header
+    """
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt,
+                info=b"cephalon file encryption").derive(settings.FILE_ENCRYPTION_KEY.encode())
+
+
+def get_segment_nonce(prefix: bytes, index: int, last: bool) -> bytes:
+    return prefix + struct.pack(">IB", index, last)
+
+
+def encrypt_stream(src, dst, segment_size: int = None):
+    """
+    Encrypt a binary stream into the segmented format one segment at a time
+    """
+    segment_size = segment_size or settings.FILE_ENCRYPTION_SEGMENT_SIZE
+    salt, prefix = os.urandom(16), os.urandom(7)
+    header = ENCRYPTED_FILE_HEADER.pack(ENCRYPTED_FILE_MAGIC, ENCRYPTED_FILE_VERSION, segment_size, salt, prefix)
+    aesgcm = AESGCM(get_file_encryption_key(salt))
+    dst.write(header)
+    segment = src.read(segment_size)
+    index = 0
+    while True:
+        following = src.read(segment_size)
+        dst.write(aesgcm.encrypt(get_segment_nonce(prefix, index, not following), segment, header))
+        if not following:
+            break
+        segment = following
+        index += 1
+
+
+class DecryptingFile(io.RawIOBase):
+    """
+    A seekable reader over a file written by encrypt_stream. Only the segment holding the current position is
+    decrypted and kept, so any range of a large file is read in bounded memory. A segment that fails authentication
+    raises a ValueError.
+    """
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.header = raw.read(ENCRYPTED_FILE_HEADER.size)
+        if len(self.header) != ENCRYPTED_FILE_HEADER.size:
+            raise ValueError("encrypted file header is incomplete")
+        magic, version, self.segment_size, salt, self.prefix = ENCRYPTED_FILE_HEADER.unpack(self.header)
+        if magic != ENCRYPTED_FILE_MAGIC or version != ENCRYPTED_FILE_VERSION:
+            raise ValueError("unsupported encrypted file format")
+        self.aesgcm = AESGCM(get_file_encryption_key(salt))
+        body = raw.seek(0, os.SEEK_END) - ENCRYPTED_FILE_HEADER.size
+        self.segment_count = max(-(-body // (self.segment_size + ENCRYPTION_TAG_SIZE)), 1)
+        self.size = body - self.segment_count * ENCRYPTION_TAG_SIZE
+        if self.size < 0:
+            raise ValueError("encrypted file is truncated")
+        self.position = 0
+        self.segment = (None, b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def get_segment(self, index: int) -> bytes:
+        if self.segment[0] != index:
+            stored_size = self.segment_size + ENCRYPTION_TAG_SIZE
+            self.raw.seek(ENCRYPTED_FILE_HEADER.size + index * stored_size)
+            nonce = get_segment_nonce(self.prefix, index, index == self.segment_count - 1)
+            try:
+                self.segment = (index, self.aesgcm.decrypt(nonce, self.raw.read(stored_size), self.header))
+            except InvalidTag:
+                raise ValueError(f"segment {index} of the encrypted file failed authentication")
+        return self.segment[1]
+
+    def readinto(self, b) -> int:
+        if self.position >= self.size:
+            return 0
+        index, offset = divmod(self.position, self.segment_size)
+        data = memoryview(self.get_segment(index))[offset:offset + len(b)]
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+# Compressed files are a header followed by frames of FILE_COMPRESSION_FRAME_SIZE bytes compressed on their own, an
+# index with the compressed size of every frame and a footer with the offset of the index and the size of the content,
+# so a read at any position only decompresses the frame holding it.
+COMPRESSED_FILE_MAGIC = b"\x89CXFRAME\r\n\x1a\n"
+COMPRESSED_FILE_VERSION = 1
+COMPRESSED_FILE_HEADER = struct.Struct(f">{len(COMPRESSED_FILE_MAGIC)}sBBI")
+COMPRESSED_FILE_FOOTER = struct.Struct(">QQ")
+COMPRESSION_CODECS = {1: "gzip", 2: "zstd"}
+
+
+def compress_stream(src, dst, frame_size: int = None):
+    """
+    Compress a binary stream into the framed format one frame at a time with the best codec available
+    """
+    frame_size = frame_size or settings.FILE_COMPRESSION_FRAME_SIZE
+    encoding = "zstd" if zstandard else "gzip"
+    codec = next(codec for codec, name in COMPRESSION_CODECS.items() if name == encoding)
+    dst.write(COMPRESSED_FILE_HEADER.pack(COMPRESSED_FILE_MAGIC, COMPRESSED_FILE_VERSION, codec, frame_size))
+    sizes = []
+    size = 0
+    for frame in iter(lambda: src.read(frame_size), b""):
+        data = compress_data(frame, encoding)
+        dst.write(data)
+        sizes.append(len(data))
+        size += len(frame)
+    dst.write(struct.pack(f">{len(sizes)}I", *sizes))
+    dst.write(COMPRESSED_FILE_FOOTER.pack(COMPRESSED_FILE_HEADER.size + sum(sizes), size))
+
+
+class DecompressingFile(io.RawIOBase):
+    """
+    A seekable reader over a file written by compress_stream. Only the frame holding the current position is
+    decompressed and kept.
+    """
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        header = raw.read(COMPRESSED_FILE_HEADER.size)
+        if len(header) != COMPRESSED_FILE_HEADER.size:
+            raise ValueError("compressed file header is incomplete")
+        magic, version, codec, self.frame_size = COMPRESSED_FILE_HEADER.unpack(header)
+        if magic != COMPRESSED_FILE_MAGIC or version != COMPRESSED_FILE_VERSION or codec not in COMPRESSION_CODECS:
+            raise ValueError("unsupported compressed file format")
+        self.encoding = COMPRESSION_CODECS[codec]
+        if self.encoding == "zstd" and not zstandard:
+            raise ValueError("reading this file needs the zstandard package")
+        end = raw.seek(0, os.SEEK_END)
+        if end < COMPRESSED_FILE_HEADER.size + COMPRESSED_FILE_FOOTER.size:
+            raise ValueError("compressed file is truncated")
+        raw.seek(end - COMPRESSED_FILE_FOOTER.size)
+        index_offset, self.size = COMPRESSED_FILE_FOOTER.unpack(raw.read(COMPRESSED_FILE_FOOTER.size))
+        frame_count = -(-self.size // self.frame_size)
+        if index_offset + frame_count * 4 + COMPRESSED_FILE_FOOTER.size != end:
+            raise ValueError("compressed file is truncated")
+        raw.seek(index_offset)
+        self.offsets = [COMPRESSED_FILE_HEADER.size]
+        for frame_size in struct.unpack(f">{frame_count}I", raw.read(frame_count * 4)):
+            self.offsets.append(self.offsets[-1] + frame_size)
+        self.position = 0
+        self.frame = (None, b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def get_frame(self, index: int) -> bytes:
+        if self.frame[0] != index:
+            self.raw.seek(self.offsets[index])
+            data = self.raw.read(self.offsets[index + 1] - self.offsets[index])
+            frame = decompress_data(data, self.encoding, self.frame_size)
+            if len(frame) != min(self.frame_size, self.size - index * self.frame_size):
+                raise ValueError(f"frame {index} of the compressed file has the wrong size")
+            self.frame = (index, frame)
+        return self.frame[1]
+
+    def readinto(self, b) -> int:
+        if self.position >= self.size:
+            return 0
+        index, offset = divmod(self.position, self.frame_size)
+        data = memoryview(self.get_frame(index))[offset:offset + len(b)]
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+STORED_FILE_READERS = {
+    "encrypted": (ENCRYPTED_FILE_MAGIC, DecryptingFile),
+    "compressed": (COMPRESSED_FILE_MAGIC, DecompressingFile),
+}
+
+
+def get_stream_format(f) -> str:
+    """
+    Return the format of a stored file from its first bytes, the position of the file is left at the start
+    """
+    start = f.read(max(len(magic) for magic, _ in STORED_FILE_READERS.values()))
+    f.seek(0)
+    for storage_format, (magic, _) in STORED_FILE_READERS.items():
+        if start.startswith(magic):
+            return storage_format
+    return "plain"
+
+
+def get_storage_format(filepath: str) -> str:
+    """
+    Return how a stored file is kept on disk, either plain, encrypted or compressed
+    """
+    with open(filepath, "rb") as f:
+        return get_stream_format(f)
+
+
+def open_stored_file(filepath: str):
+    """
+    Open a stored file for reading its content as a seekable binary file. Encrypted and compressed files are decrypted
+    and decompressed as they are read, a compressed file of an encrypted project is compressed first and encrypted after.
+    """
+    f = open(filepath, "rb")
+    try:
+        while (storage_format := get_stream_format(f)) != "plain":
+            f = io.BufferedReader(STORED_FILE_READERS[storage_format][1](f), settings.FILE_READ_BUFFER_SIZE)
+    except Exception:
+        f.close()
+        raise
+    return f
+
+
+def rewrite_stored_file(filepath: str, write):
+    """
+    Replace a stored file with what write puts into a new file from the current one
+    """
+    temp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(filepath, "rb") as src, open(temp_path, "wb") as dst:
+            write(src, dst)
+        os.replace(temp_path, filepath)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def encrypt_file(filepath: str):
+    """
+    Replace a stored file with its encrypted version, a file that is already encrypted is left as it is
+    """
+    if get_storage_format(filepath) != "encrypted":
+        rewrite_stored_file(filepath, encrypt_stream)
+
+
+def compress_file(filepath: str):
+    """
+    Replace a plain stored file with its compressed version, encrypted or compressed files are left as they are
+    """
+    if get_storage_format(filepath) == "plain":
+        rewrite_stored_file(filepath, compress_stream)
+
+
+def get_cache_versions(scopes: list[str]) -> dict:
+    """
+    Get the current version token of each response cache scope. A scope without a token gets a new one so responses
+    cached before the token went missing can never be served again.
+    """
+    keys = {f"cephalon:version:{scope}": scope for scope in scopes}
+    versions = dict(cache.get_many(keys.keys()))
+    for key in keys:
+        if key not in versions:
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key) or uuid.uuid4().hex
+    return {keys[k]: v for k, v in versions.items()}
+
+def invalidate_cache_scopes(*scopes: str):
+    """
+    Invalidate every cached response depending on the given scopes by giving them new version tokens
+    """
+    cache.set_many({f"cephalon:version:{scope}": uuid.uuid4().hex for scope in scopes}, None)
+
+def encode_cursor(position: dict) -> str:
+    """
+    Encode the position of the last item of a page into an opaque cursor for keyset pagination
+    """
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor: str, fields: dict[str, type]) -> dict:
+    """
+    Decode a cursor created by encode_cursor and convert each of the given fields to its type. A cursor that is not
+    one of ours raises ValueError.
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {name: field_type(position[name]) for name, field_type in fields.items()}
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError("invalid cursor") from e
+
+
+def clamp_page_limit(limit: int) -> int:
+    return max(1, min(limit, settings.PAGE_MAX_LIMIT))
+
 def search_file(filepath: str, terms: list[str]):
     """
     A function that use search.sh script from cephalon to search for terms in a file
     """
+    if get_storage_format(filepath) != "plain":
+        yield from search_stored_file(filepath, terms)
+        return
     cephalon_path = os.path.dirname(cephalon.__file__)
     search_sh_path = os.path.join(cephalon_path, "search.sh").replace("\\", "/")
     filepath = filepath.replace('\\', '/')
@@ -170,3 +579,256 @@ def search_file(filepath: str, terms: list[str]):
             break
         row = i.split(":")
         yield {"term": row[0].strip(), "row": int(row[1].strip())}
+
+
+def search_stored_file(filepath: str, terms: list[str]):
+    """
+    Search for terms the way search.sh does in a file that grep cannot read directly
+    """
+    patterns = [(term, re.compile(r"(^|[^\w-])(({0})(_|;|-)?)(\b|[^\w-])".format(term), re.IGNORECASE))
+                for term in terms]
+    for term, pattern in patterns:
+        with io.TextIOWrapper(open_stored_file(filepath), encoding="utf-8", errors="replace") as f:
+            for row, line in enumerate(f, 1):
+                for _ in pattern.finditer(line):
+                    yield {"term": term, "row": row}
+
+
+def in_time_window(window: str, now: datetime.time = None) -> bool:
+    """
+    Check if a time falls within a HH:MM-HH:MM window, a window whose end is before its start wraps past midnight and
+    an empty window is always open
+    """
+    if not window:
+        return True
+    now = now or datetime.datetime.now().time()
+    start, end = [datetime.time.fromisoformat(part.strip()) for part in window.split("-")]
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+
+def get_supported_encodings() -> list[str]:
+    """
+    Return the transfer encodings this instance can read and write in order of preference
+    """
+    if zstandard:
+        return ["zstd", "gzip", "identity"]
+    return ["gzip", "identity"]
+
+
+def negotiate_encoding(accept_encoding: str = None) -> str:
+    """
+    Pick the preferred encoding out of a comma separated list offered by the sender
+    """
+    offered = {e.strip() for e in (accept_encoding or "").split(",")}
+    for encoding in get_supported_encodings():
+        if encoding in offered:
+            return encoding
+    return "identity"
+
+
+def compress_data(data: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    return data
+
+
+def decompress_data(data: bytes, encoding: str, max_size: int) -> bytes:
+    """
+    Decompress data sent with a transfer encoding, raising ValueError if it is corrupt or would expand past max_size
+    """
+    try:
+        if encoding == "zstd":
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                decompressed = reader.read(max_size + 1)
+        elif encoding == "gzip":
+            decompressor = zlib.decompressobj(31)
+            decompressed = decompressor.decompress(data, max_size + 1)
+            if not decompressor.eof:
+                raise ValueError("truncated or oversized data")
+        else:
+            decompressed = data
+    except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+        raise ValueError(str(e))
+    if len(decompressed) > max_size:
+        raise ValueError("decompressed data is larger than expected")
+    return decompressed
+
+
+CDC_MIN_BLOCK_SIZE = 16 * 1024
+CDC_MAX_BLOCK_SIZE = 256 * 1024
+CDC_BOUNDARY_MASK = 0x1ff
+
+
+def iter_content_defined_blocks(f, min_size: int = CDC_MIN_BLOCK_SIZE, max_size: int = CDC_MAX_BLOCK_SIZE,
+                                mask: int = CDC_BOUNDARY_MASK):
+    """
+    Split a binary file into blocks whose boundaries depend on the content instead of the position. A block ends after
+    a line whose crc32 matches the boundary mask once it is at least min_size long, so inserting or removing rows in a
+    table only changes the blocks around the edit. Lines longer than max_size are cut at fixed positions.
+    """
+    block = bytearray()
+    for line in iter(lambda: f.readline(max_size), b""):
+        block += line
+        if len(block) >= max_size:
+            while len(block) >= max_size:
+                yield bytes(block[:max_size])
+                del block[:max_size]
+        elif len(block) >= min_size and zlib.crc32(line) & mask == 0:
+            yield bytes(block)
+            block.clear()
+    if block:
+        yield bytes(block)
+
+
+def iter_content_segments(f, min_size: int = None, max_size: int = None):
+    """
+    Split a binary file into the content defined segments its text is indexed in and yield the sha1 of each segment
+    with the segment itself
+    """
+    min_size = min_size or settings.CONTENT_SEGMENT_MIN_SIZE
+    max_size = max_size or settings.CONTENT_SEGMENT_MAX_SIZE
+    for block in iter_content_defined_blocks(f, min_size, max_size):
+        yield hashlib.sha1(block).hexdigest(), block
+
+
+def get_segment_text(segment: bytes) -> str:
+    """
+    Return the text of a segment with whitespace separated words joined by single spaces
+    """
+    return " ".join(re.split(r"[\s\n\t]", segment.decode("utf-8", errors="replace")))
+
+
+def get_block_manifest(filepath: str) -> list[list]:
+    """
+    Return the content defined blocks of a file as a list of [sha1, size] pairs
+    """
+    with open_stored_file(filepath) as f:
+        return [[hashlib.sha1(block).hexdigest(), len(block)] for block in iter_content_defined_blocks(f)]
+
+
+HASH_ALGORITHMS = {
+    "sha1": hashlib.sha1,
+    "blake2b": hashlib.blake2b,
+}
+
+
+def get_hasher(algorithm: str = "sha1"):
+    """
+    Return a new hash object for one of the supported file hash algorithms, sha1 is kept for compatibility with older
+    instances and blake2b is the faster option
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"unsupported hash algorithm {algorithm}")
+    return HASH_ALGORITHMS[algorithm]()
+
+
+def hash_data(data: bytes, algorithm: str = "sha1") -> str:
+    hasher = get_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def update_hasher_from_file(hasher, filepath: str, start: int = 0, length: int = None):
+    """
+    Feed the content of a file, or length bytes of it from start, into a hash object using the file read buffer size
+    """
+    with open(filepath, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = settings.FILE_READ_BUFFER_SIZE if remaining is None else min(remaining, settings.FILE_READ_BUFFER_SIZE)
+            data = f.read(size)
+            if not data:
+                break
+            hasher.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return hasher
+
+
+def hash_file(filepath: str, algorithm: str = "sha1") -> str:
+    return update_hasher_from_file(get_hasher(algorithm), filepath).hexdigest()
+
+
+class HashingFile(File):
+    """
+    A file wrapper that hashes the content as the storage reads it through chunks() to write it, so a file does not
+    have to be read a second time to get its hash
+    """
+
+    def __init__(self, file, algorithm: str = "sha1"):
+        super().__init__(file, name=file.name)
+        self.hasher = get_hasher(algorithm)
+
+    def chunks(self, chunk_size=None):
+        for chunk in self.file.chunks(chunk_size or settings.FILE_READ_BUFFER_SIZE):
+            self.hasher.update(chunk)
+            yield chunk
+
+    def hexdigest(self) -> str:
+        return self.hasher.hexdigest()
+
+
+def merkle_leaf(file_hash: str) -> str:
+    return hashlib.sha1(b"\x00" + (file_hash or "").encode()).hexdigest()
+
+
+def merkle_node(left: str, right: str) -> str:
+    return hashlib.sha1(b"\x01" + left.encode() + right.encode()).hexdigest()
+
+
+def build_merkle_levels(leaves: list[str]) -> list[list[str]]:
+    """
+    Build every level of a merkle tree from its leaves up to the root. An odd node at the end of a level is carried up
+    to the next level unchanged.
+    """
+    levels = [list(leaves)]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([merkle_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                       for i in range(0, len(level), 2)])
+    return levels
+
+
+def get_merkle_bucket(leaf: str, depth: int) -> int:
+    """
+    Return the bucket of a leaf in a tree with 2 ** depth buckets, taken from the leading bits of the leaf
+    """
+    return int(leaf, 16) >> (len(leaf) * 4 - depth)
+
+
+def merkle_parent(left: str, right: str) -> str:
+    """
+    Combine two sibling nodes of a tree of fixed shape. An empty subtree is an empty string and a node with a single
+    child carries it up unchanged.
+    """
+    return merkle_node(left, right) if left and right else left or right
+
+
+def build_bucketed_merkle_tree(leaves: list[str], depth: int) -> dict[tuple[int, int], str]:
+    """
+    Build the non empty nodes of a merkle tree whose leaves are grouped in 2 ** depth buckets by their leading bits and
+    return them by level and index. Level 1 holds the root of the sorted leaves of each bucket and level depth + 1 the
+    root of the tree, so the tree only depends on the leaves and not on the order they were added in.
+    """
+    buckets = {}
+    for leaf in leaves:
+        buckets.setdefault(get_merkle_bucket(leaf, depth), []).append(leaf)
+    nodes = {(1, bucket): get_merkle_root(build_merkle_levels(sorted(bucket_leaves)))
+             for bucket, bucket_leaves in buckets.items()}
+    for level in range(2, depth + 2):
+        for index in {index // 2 for node_level, index in list(nodes) if node_level == level - 1}:
+            nodes[(level, index)] = merkle_parent(nodes.get((level - 1, 2 * index), ""),
+                                                  nodes.get((level - 1, 2 * index + 1), ""))
+    return nodes
+
+
+def get_merkle_root(levels: list[list[str]]) -> str:
+    if not levels or not levels[0]:
+        return hashlib.sha1(b"").hexdigest()
+    return levels[-1][0]
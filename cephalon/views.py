@@ -8,23 +8,88 @@ from django import forms
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank, SearchHeadline
 from django.core.files.base import ContentFile
-from django.http import HttpResponse, StreamingHttpResponse
+from django.db import transaction
+from django.db.models import Q, F, OuterRef, Subquery, Value, FloatField
+from django.db.models.functions import Coalesce, Greatest, Cast
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from functools import wraps
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse
 from django.shortcuts import render
 from ninja import NinjaAPI, Form, Swagger, File
 from ninja.security import django_auth, django_auth_superuser, APIKeyQuery
 from ninja.files import UploadedFile
 from ninja.pagination import paginate
+from ninja.decorators import decorate_view
 import hashlib
+from cephalon.archive import iter_project_archive, import_project_archive
 from cephalon.authentications import AuthBearer, AuthApiKey, AuthApiKeyHeader
-from cephalon.models import Project, ProjectFile, ChunkedUpload, ProjectFileContent, WebsocketSession, WebsocketNode, \
+from cephalon.sync import get_project_manifest_diff
+from cephalon.models import Project, ProjectFile, FileBlob, ChunkedUpload, ProjectFileContent, WebsocketSession, WebsocketNode, \
     Pyre, SearchResult
 from cephalon.schemas import ProjectSchema, ProjectPostSchema, FileSchema, FilePostSchema, ChunkedUploadSchema, \
     HashErrorSchema, ChunkedUploadInitSchema, ChunkedUploadCompleteSchema, BadRequestSchema, SearchResultSchema, \
-    SearchResultInitSchema, NotifyFileUploadComplete, NotifyMessageSchema
+    SearchResultInitSchema, NotifyFileUploadComplete, NotifyMessageSchema, FileSearchPageSchema, \
+    ProjectSearchPageSchema, ProjectSummarySchema, ProjectPageSchema, FileSummarySchema, FilePageSchema, \
+    ChunkedUploadStatusSchema, DeltaUploadInitSchema, DeltaUploadSchema, SyncManifestSchema, SyncProjectSchema, \
+    ChunkedRangeSchema, ChunkedRangeClaimSchema
+from cephalon.utils import encode_cursor, decode_cursor, clamp_page_limit, get_cache_versions, negotiate_encoding, decompress_data, \
+    HashingFile, HASH_ALGORITHMS, get_storage_format
 
 api = NinjaAPI(docs=Swagger(), title="Cephalon API")
 
 
+def cache_response(*scopes: str):
+    """
+    Cache the serialized response of a read only api view in the default cache together with an ETag. Scopes are
+    formatted with the view arguments and name the objects the response depends on so signals can invalidate it.
+    Requests carrying a matching If-None-Match header get an empty 304 response.
+    """
+    def decorator(func):
+        @wraps(func)
+        def view(request, *args, **kwargs):
+            versions = get_cache_versions([scope.format(**kwargs) for scope in scopes])
+            key = "cephalon:response:" + hashlib.sha1(
+                json.dumps([request.get_full_path(), versions], sort_keys=True).encode()
+            ).hexdigest()
+            cached = cache.get(key)
+            if cached is not None:
+                etag, content, content_type = cached
+                if etag_matches(request, etag):
+                    response = HttpResponse(status=304)
+                else:
+                    response = HttpResponse(content, content_type=content_type)
+                response["ETag"] = etag
+                return response
+            request.response_cache_key = key
+            return func(request, *args, **kwargs)
+
+        def store(run):
+            @wraps(run)
+            def operation(request, *args, **kwargs):
+                response = run(request, *args, **kwargs)
+                key = getattr(request, "response_cache_key", None)
+                if key and response.status_code == 200:
+                    etag = quote_etag(hashlib.sha1(response.content).hexdigest())
+                    cache.set(key, (etag, response.content, response["Content-Type"]),
+                              settings.RESPONSE_CACHE_TIMEOUT)
+                    if etag_matches(request, etag):
+                        response = HttpResponse(status=304)
+                    response["ETag"] = etag
+                return response
+            return operation
+
+        return decorate_view(store)(view)
+    return decorator
+
+
+def etag_matches(request, etag: str) -> bool:
+    etags = parse_etags(request.headers.get("If-None-Match", ""))
+    return "*" in etags or etag in etags
+
+
 @api.get("/bearer", auth=AuthBearer())
 def bearer(request):
     return {"user": request.user.username}
@@ -34,8 +99,22 @@ def bearer(request):
 def apiquery(request):
     return {"api_key": request.auth.key}
 
+# registered before /projects/{project_id} so that the path parameter does not take "import"
+@api.post("/projects/import", response={200: ProjectSchema, 400: BadRequestSchema},
+          auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def import_project(request):
+    """
+    Import a project exported by /projects/{project_id}/export, the archive is the raw request body. The server spools
+    a large body to a temporary file before the view runs and the archive is read from it member by member.
+    """
+    try:
+        project = import_project_archive(request)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    return 200, project
 
 @api.get("/projects/{project_id}", response=ProjectSchema)
+@cache_response("project:{project_id}")
 def get_project(request, project_id: int):
     return Project.objects.get(id=project_id)
 
@@ -53,17 +132,59 @@ def update_project(request, project_id: int, body: ProjectPostSchema):
 def create_project(request, project: ProjectPostSchema):
     return Project.objects.create(**project.dict())
 
-
-@api.get("/projects", response=list[ProjectSchema])
-@paginate
-def list_projects(request):
-    return Project.objects.all()
+@api.get("/projects/{project_id}/export", auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def export_project(request, project_id: int):
+    project = Project.objects.get(id=project_id)
+    response = StreamingHttpResponse(iter_project_archive(project), content_type="application/gzip")
+    response["Content-Disposition"] = f"attachment; filename={project.global_id}.tar.gz"
+    # the archive is already compressed
+    response["Content-Encoding"] = "identity"
+    return response
 
 
-@api.get("/projects/{project_id}/files", response=list[FileSchema])
-def list_project_files(request, project_id: int):
+def get_keyset_page(queryset, schema, summary_schema, cursor: str = None, limit: int = 100, metadata: bool = True,
+                    count: bool = True):
+    """
+    Return one page of a queryset ordered by id together with the cursor of the next page. The metadata column is
+    left out of the query and the items when metadata is false and the total count is skipped when count is false.
+    A malformed cursor raises ValueError.
+    """
+    limit = clamp_page_limit(limit)
+    position = decode_cursor(cursor, {"id": int}) if cursor else None
+    total = queryset.count() if count else None
+    if position:
+        queryset = queryset.filter(id__gt=position["id"])
+    if not metadata:
+        queryset = queryset.defer("metadata")
+        schema = summary_schema
+    page = list(queryset.order_by("id")[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor({"id": page[-1].id})
+    return {"items": [schema.from_orm(i) for i in page], "count": total, "next_cursor": next_cursor}
+
+
+@api.get("/projects", response={200: ProjectPageSchema, 400: BadRequestSchema}, exclude_unset=True)
+@cache_response("projects")
+def list_projects(request, cursor: str = None, limit: int = 100, metadata: bool = True, count: bool = True):
+    try:
+        return 200, get_keyset_page(Project.objects.all(), ProjectSchema, ProjectSummarySchema, cursor, limit,
+                                    metadata, count)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+
+
+@api.get("/projects/{project_id}/files", response={200: FilePageSchema, 400: BadRequestSchema}, exclude_unset=True)
+@cache_response("project:{project_id}:files")
+def list_project_files(request, project_id: int, cursor: str = None, limit: int = 100, metadata: bool = True,
+                       count: bool = True):
     project = Project.objects.get(id=project_id)
-    return project.files.all()
+    try:
+        return 200, get_keyset_page(project.files.all(), FileSchema, FileSummarySchema, cursor, limit, metadata,
+                                    count)
+    except ValueError as e:
+        return 400, {"error": str(e)}
 
 
 @api.post("/projects/{project_id}/files", response=FileSchema,
@@ -71,14 +192,16 @@ def list_project_files(request, project_id: int):
 def create_project_file(request, project_id: int, body: FilePostSchema = Form(...), file: UploadedFile = File(...)):
     project = Project.objects.get(id=project_id)
     body.metadata = json.loads(body.metadata)
-    hasher = hashlib.sha1()
-    for chunk in iter(lambda: file.read(4096), b""):
-        hasher.update(chunk)
-    hash = hasher.hexdigest()
-    if hash != body.hash:
+    if body.hash_algorithm not in HASH_ALGORITHMS:
+        return {"error": "unsupported hash algorithm"}
+    hashing_file = HashingFile(file, body.hash_algorithm)
+    project_file = project.files.create(file=hashing_file, **body.dict(), name=file.name)
+    if hashing_file.hexdigest() != body.hash:
+        project_file.delete()
         return {"error": "hash mismatch"}
-    file.seek(0)
-    return project.files.create(file=file, **body.dict(), name=file.name)
+    project_file.store_in_blob()
+    project_file.save()
+    return project_file
 
 @api.patch("/files/patch/{file_id}", response=FileSchema, auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
 def update_project_file(request, file_id: int, body: FilePostSchema = Form(...)):
@@ -87,74 +210,247 @@ def update_project_file(request, file_id: int, body: FilePostSchema = Form(...))
     file.metadata = body.metadata
     file.description = body.description
     if body.load_file_content:
-        with open(file.file.path, "rt") as f:
+        with file.open_data("rt") as f:
             ProjectFileContent.objects.create(project_file=file, data=f.read())
     file.save()
     return file
 
-@api.post("/files/chunked", response=ChunkedUploadSchema, auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+@api.post("/files/chunked", response={200: ChunkedUploadSchema, 400: HashErrorSchema}, auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
 def initiate_chunked_upload(request, body: ChunkedUploadInitSchema = Form(...)):
     print(body)
-    chunk = ChunkedUpload.objects.create(total_size=body.size, filename=body.filename, hash=body.data_hash, file_category=body.file_category, file=ContentFile(b"", name=body.filename))
-    return chunk
+    if body.hash_algorithm not in HASH_ALGORITHMS:
+        return 400, {"error": "unsupported hash algorithm"}
+    chunk = ChunkedUpload.objects.create(total_size=body.size, filename=body.filename, hash=body.data_hash, file_category=body.file_category, file=ContentFile(b"", name=body.filename), encoding=negotiate_encoding(body.accept_encoding), hash_algorithm=body.hash_algorithm)
+    return 200, chunk
+
+def decode_chunk(chunked_upload: ChunkedUpload, chunk: UploadedFile, max_size: int):
+    """
+    Return the uncompressed content of a chunk sent with the encoding negotiated for the upload
+    """
+    if chunked_upload.encoding == "identity":
+        return chunk
+    return ContentFile(decompress_data(chunk.read(), chunked_upload.encoding, max_size), name=chunk.name)
 
 @api.post("/files/chunked/{upload_id}", response={200: ChunkedUploadSchema, 400: HashErrorSchema},
           auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
 def upload_chunk(request, upload_id: str, offset: int = Form(...), chunk: UploadedFile = File(...)):
     chunked_upload = ChunkedUpload.objects.get(upload_id=upload_id)
-
-    with open(chunked_upload.file.path, "ab") as f:
-        f.write(chunk.read())
-
-
-    if chunked_upload.offset + chunk.size > chunked_upload.total_size:
-        chunked_upload.offset = chunked_upload.size
-    else:
-        chunked_upload.offset = offset + chunk.size
+    if chunked_upload.status == "complete":
+        return 400, {"error": "upload already complete"}
+    try:
+        chunk = decode_chunk(chunked_upload, chunk, chunked_upload.total_size - offset)
+    except ValueError:
+        return 400, {"error": "invalid chunk encoding"}
+    if offset > chunked_upload.offset or offset + chunk.size > chunked_upload.total_size:
+        return 400, {"error": "offset mismatch"}
+
+    hasher = chunked_upload.write_chunk(chunk, offset)
     if chunked_upload.offset == chunked_upload.total_size:
-        verify_hash = hashlib.sha1()
-        chunked_upload.file.seek(0)
-        for chunk in iter(lambda: chunked_upload.file.read(4096), b""):
-            verify_hash.update(chunk)
-        if chunked_upload.hash != verify_hash.hexdigest():
+        if chunked_upload.hash != hasher.hexdigest():
+            chunked_upload.save()
             return 400, {"error": "hash mismatch"}
         chunked_upload.status = "complete"
+    else:
+        chunked_upload.status = "in_progress"
+    chunked_upload.adjust_chunk_size(chunk.size, (timezone.now() - chunked_upload.updated_at).total_seconds())
+    chunked_upload.save()
+    return 200, chunked_upload
 
-        return 200, chunked_upload
+@api.get("/files/chunked/{upload_id}", response=ChunkedUploadStatusSchema,
+         auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def get_chunked_upload(request, upload_id: str):
+    return ChunkedUpload.objects.get(upload_id=upload_id)
 
-    else:
+@api.post("/files/chunked/{upload_id}/chunks/{index}", response={200: ChunkedUploadSchema, 400: HashErrorSchema},
+          auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def upload_indexed_chunk(request, upload_id: str, index: int, checksum: str = Form(...), chunk: UploadedFile = File(...)):
+    chunked_upload = ChunkedUpload.objects.get(upload_id=upload_id)
+    if index < 0 or index >= chunked_upload.block_count:
+        return 400, {"error": "chunk index out of range"}
+    start = chunked_upload.get_block_bounds(index)[0]
+    try:
+        chunk = decode_chunk(chunked_upload, chunk,
+                             min(chunked_upload.total_size - start, settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE))
+    except ValueError:
+        return reject_chunk(upload_id, "invalid chunk encoding")
+    end = start + chunk.size
+    if chunk.size == 0 or end > chunked_upload.total_size or \
+            (end % chunked_upload.block_size and end != chunked_upload.total_size):
+        return 400, {"error": "chunk size mismatch"}
+    if chunked_upload.get_chunk_checksum(chunk) != checksum:
+        return reject_chunk(upload_id, "checksum mismatch")
+
+    with transaction.atomic():
+        chunked_upload = ChunkedUpload.objects.select_for_update().get(upload_id=upload_id)
+        if chunked_upload.status == "complete":
+            return 200, chunked_upload
+        blocks = range(index, -(-end // chunked_upload.block_size))
+        if all(chunked_upload.is_block_received(i) for i in blocks):
+            return 200, chunked_upload
+        chunked_upload.write_indexed_chunk(chunk, index)
+        chunked_upload.mark_blocks_received(index, end)
+        if chunked_upload.offset == chunked_upload.total_size:
+            if chunked_upload.hash != chunked_upload.get_hasher(chunked_upload.total_size).hexdigest():
+                chunked_upload.reset_received_blocks()
+                chunked_upload.save()
+                return 400, {"error": "hash mismatch"}
+            chunked_upload.status = "complete"
+            if chunked_upload.transfer:
+                file = chunked_upload.complete_transfer()
+                transaction.on_commit(lambda: send_transfer_complete(chunked_upload, file))
+        else:
+            chunked_upload.status = "in_progress"
+        chunked_upload.adjust_chunk_size(chunk.size, (timezone.now() - chunked_upload.updated_at).total_seconds())
+        chunked_upload.save()
+    return 200, chunked_upload
+
+@api.post("/files/chunked/{upload_id}/claim", response={200: ChunkedRangeSchema, 400: HashErrorSchema},
+          auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def claim_chunked_range(request, upload_id: str, body: ChunkedRangeClaimSchema = Form(...)):
+    """
+    Hand the next byte range of a transfer shared by several nodes to one of them. The first node to claim a range
+    sets the size of the transfer, nodes holding a file of another size or hash are turned away.
+    """
+    with transaction.atomic():
+        chunked_upload = ChunkedUpload.objects.select_for_update().get(upload_id=upload_id)
+        if not chunked_upload.transfer:
+            return 400, {"error": "upload is not a shared transfer"}
+        if body.data_hash != chunked_upload.hash or chunked_upload.total_size not in (None, body.size):
+            return 400, {"error": "file does not match the transfer"}
+        if chunked_upload.total_size is None:
+            chunked_upload.total_size = body.size
+        claim = chunked_upload.claim_range(body.node_id) if chunked_upload.status != "complete" else None
+        chunked_upload.save(update_fields=["total_size", "transfer"])
+    index, count = claim or (None, 0)
+    return 200, {"upload_id": chunked_upload.upload_id, "filename": chunked_upload.filename,
+                 "status": chunked_upload.status, "index": index, "count": count,
+                 "block_size": chunked_upload.block_size, "chunk_size": chunked_upload.chunk_size,
+                 "total_size": chunked_upload.total_size,
+                 "encoding": chunked_upload.encoding, "hash_algorithm": chunked_upload.hash_algorithm,
+                 "file_id": chunked_upload.transfer.get("file_id")}
+
+def send_transfer_complete(chunked_upload: ChunkedUpload, file: ProjectFile):
+    """
+    Tell the client that asked for a file that the nodes holding it finished sending it
+    """
+    transfer = chunked_upload.transfer
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(transfer["session_id"] + "_result", {
+        'type': 'communication_message',
+        'message': {
+            'message': "File uploaded",
+            'requestType': "file-upload",
+            'senderID': "host",
+            'targetID': transfer["client_id"],
+            'channelType': "file",
+            'data': [transfer["file"], FileSchema.from_orm(file).dict()],
+            'sessionID': transfer["session_id"],
+            'clientID': transfer["client_id"],
+            'pyreName': transfer["pyre_name"],
+        }
+    })
+
+def reject_chunk(upload_id: str, error: str):
+    """
+    Record a corrupted chunk against the upload so that the next chunks are asked smaller and return the error
+    """
+    with transaction.atomic():
+        chunked_upload = ChunkedUpload.objects.select_for_update().get(upload_id=upload_id)
+        chunked_upload.record_chunk_error()
+        chunked_upload.save(update_fields=["chunk_errors", "chunk_size"])
+    return 400, {"error": error}
+
+@api.post("/files/{file_id}/delta", response={200: DeltaUploadSchema, 400: HashErrorSchema},
+          auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def initiate_delta_upload(request, file_id: int, body: DeltaUploadInitSchema):
+    file = ProjectFile.objects.get(id=file_id)
+    if sum(size for _, size in body.blocks) != body.size:
+        return 400, {"error": "block sizes do not add up to the file size"}
+    if body.hash_algorithm not in HASH_ALGORITHMS:
+        return 400, {"error": "unsupported hash algorithm"}
+    chunked_upload = ChunkedUpload.objects.create(
+        total_size=body.size, filename=file.name, hash=body.data_hash, file_category=file.file_category,
+        file=ContentFile(b"", name=file.name), encoding=negotiate_encoding(body.accept_encoding),
+        block_manifest=[list(block) for block in body.blocks], base_file=file, hash_algorithm=body.hash_algorithm)
+    return finish_delta_upload(chunked_upload)
+
+@api.get("/files/chunked/{upload_id}/blocks", response=DeltaUploadSchema,
+         auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def get_delta_upload(request, upload_id: str):
+    return ChunkedUpload.objects.get(upload_id=upload_id, block_manifest__isnull=False)
+
+@api.post("/files/chunked/{upload_id}/blocks/{index}", response={200: DeltaUploadSchema, 400: HashErrorSchema},
+          auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def upload_delta_block(request, upload_id: str, index: int, chunk: UploadedFile = File(...)):
+    chunked_upload = ChunkedUpload.objects.get(upload_id=upload_id)
+    if not chunked_upload.block_manifest or index < 0 or index >= len(chunked_upload.block_manifest):
+        return 400, {"error": "block index out of range"}
+    start, end = chunked_upload.get_delta_block_bounds(index)
+    try:
+        chunk = decode_chunk(chunked_upload, chunk, end - start)
+    except ValueError:
+        return 400, {"error": "invalid chunk encoding"}
+    if chunk.size != end - start:
+        return 400, {"error": "chunk size mismatch"}
+    if chunked_upload.get_chunk_checksum(chunk, "sha1") != chunked_upload.block_manifest[index][0]:
+        return 400, {"error": "checksum mismatch"}
+
+    with transaction.atomic():
+        chunked_upload = ChunkedUpload.objects.select_for_update().get(upload_id=upload_id)
+        if chunked_upload.status == "complete" or chunked_upload.is_block_received(index):
+            return 200, chunked_upload
+        chunked_upload.write_chunk_at(chunk, start)
+        chunked_upload.mark_delta_block_received(index)
+        return finish_delta_upload(chunked_upload)
+
+def finish_delta_upload(chunked_upload: ChunkedUpload):
+    """
+    Rebuild the file of a delta upload once no block is missing, otherwise record the progress
+    """
+    if chunked_upload.get_missing_delta_blocks():
         chunked_upload.status = "in_progress"
+        chunked_upload.save()
+        return 200, chunked_upload
+    if chunked_upload.assemble_delta() != chunked_upload.hash:
+        chunked_upload.save()
+        return 400, {"error": "hash mismatch"}
+    chunked_upload.status = "complete"
     chunked_upload.save()
     return 200, chunked_upload
 
 @api.post("/files/chunked/{upload_id}/complete", response={200: FileSchema, 400: BadRequestSchema}, auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
 def complete_chunked_upload(request, upload_id: str, body: ChunkedUploadCompleteSchema):
     chunked_upload = ChunkedUpload.objects.get(upload_id=upload_id)
+    if chunked_upload.status != "complete":
+        return 400, {"error": "upload incomplete"}
     file = None
     project = None
     if body.project_id:
         project = Project.objects.get(id=body.project_id)
     if body.file_id:
         file = ProjectFile.objects.get(id=body.file_id)
-        file.file = chunked_upload.file
+        file.attach_blob(FileBlob.acquire(chunked_upload.hash, chunked_upload.hash_algorithm,
+                                          chunked_upload.total_size, chunked_upload.link_file_to,
+                                          file.is_encrypted_at_rest(), file.is_compressed_at_rest()))
+        if chunked_upload.block_manifest:
+            file.block_manifest = {"hash": chunked_upload.hash, "blocks": chunked_upload.block_manifest}
         file.save()
     if body.create_file:
-        file = ProjectFile.objects.create(file=ContentFile(chunked_upload.file.read(),
-                                                           name=chunked_upload.filename),
-                                          hash=chunked_upload.hash,
-                                          name=chunked_upload.filename,
-                                          file_category=chunked_upload.file_category,
-                                          path=body.path)
-        if body.project_id:
-            file.project = project
-            file.save()
-    if (body.file_id or body.create_file) and body.load_file_content:
-        file.load_file()
-        file.load_file_content = True
+        file = ProjectFile(name=chunked_upload.filename,
+                           file_category=chunked_upload.file_category,
+                           path=body.path,
+                           project=project,
+                           description=body.description,
+                           metadata=body.metadata)
+        if body.file_type:
+            file.file_type = body.file_type
+        file.attach_blob(FileBlob.acquire(chunked_upload.hash, chunked_upload.hash_algorithm,
+                                          chunked_upload.total_size, chunked_upload.link_file_to,
+                                          file.is_encrypted_at_rest(), file.is_compressed_at_rest()))
         file.save()
+    if (body.file_id or body.create_file) and body.load_file_content:
+        file.enqueue_ingest(body.session_id, body.client_id)
     if body.delete:
-        chunked_upload = ChunkedUpload.objects.get(upload_id=upload_id)
-        chunked_upload.file.delete()
         chunked_upload.delete()
     if file:
         return 200, file
@@ -172,45 +468,117 @@ def download_file(request, file_id: int):
 
     file = ProjectFile.objects.get(id=file_id)
     print(file)
-    response = HttpResponse(status=200)
-    response["Content-Disposition"] = f"attachment; filename={file.name}"
-    response["X-Accel-Redirect"] = f"/media/{file.file.name}"
-    return response
+    return get_file_download_response(file)
 
 @api.get("/files/{file_id}/session/{session_id}/download")
 def download_sessional_file(request, file_id: int, session_id: str):
-    file = ProjectFile.objects.get(id=file_id)
-    session = WebsocketSession.objects.get(session_id=session_id)
-
-    if file in session.files.all():
-        response = HttpResponse(status=200)
-        response["Content-Disposition"] = f"attachment; filename={file.name}"
-        response["X-Accel-Redirect"] = f"/media/{file.file.name}"
-        return response
+    if WebsocketSession.has_file(session_id, file_id):
+        file = ProjectFile.objects.get(id=file_id)
+        return get_file_download_response(file)
     else:
         return HttpResponse(status=403)
 
-@api.get("/search/project/{query}", response=list[ProjectSchema], auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
-def search_project(request, query: str):
-    #vector = SearchVector("name", "description", "metadata", "files__name", weight="B") + SearchVector("files__description", "files__content__data", weight="A")
-    #query = SearchQuery(query)
-    # return Project.objects.annotate(rank=SearchRank(vector, query)).order_by("-rank")
-    #vector = SearchVector("name", "description", "metadata", "files__name", weight="B") + SearchVector(
-    #    "files__description", "files__content__data", weight="A")
-    #Project.objects.filter(files__content__data__search="test")
-    q = SearchQuery(query, search_type="phrase")
-    v = SearchVector("files__content__data")
-    headline = SearchHeadline("files__content__data", q, start_sel="<b>", stop_sel="</b>")
-
-    return Project.objects.annotate(headline=headline, search=v).filter(search=q)
+def get_file_download_response(file: ProjectFile):
+    """
+    Let nginx send a file stored as it is, a file encrypted or compressed at rest is decoded and streamed by the
+    application
+    """
+    if get_storage_format(file.file.path) != "plain":
+        return FileResponse(file.open_data(), as_attachment=True, filename=file.name)
+    response = HttpResponse(status=200)
+    response["Content-Disposition"] = f"attachment; filename={file.name}"
+    response["X-Accel-Redirect"] = f"/media/{file.file.name}"
+    return response
 
-@api.get("/search/file/{query}", response=list[FileSchema], auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
-@paginate
-def search_file(request, query: str):
+def get_ranked_page(queryset, cursor: str = None, limit: int = 100):
+    """
+    Return one page of a queryset annotated with a search rank ordered by rank then id together with the cursor of
+    the next page, a malformed cursor raises ValueError
+    """
+    limit = clamp_page_limit(limit)
+    if cursor:
+        position = decode_cursor(cursor, {"rank": float, "id": int})
+        queryset = queryset.filter(Q(rank__lt=position["rank"]) | Q(rank=position["rank"], id__gt=position["id"]))
+    page = list(queryset.order_by("-rank", "id")[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor({"rank": page[-1].rank, "id": page[-1].id})
+    return page, next_cursor
+
+def get_best_content_headline(content, query: SearchQuery):
+    """
+    Build a subquery returning the headline of the best ranked stored content row matching the query
+    """
+    return Subquery(
+        content.filter(search_vector=query)
+        .annotate(rank=SearchRank(F("search_vector"), query))
+        .order_by("-rank", "id")
+        .annotate(headline=SearchHeadline("data", query, start_sel="<b>", stop_sel="</b>"))
+        .values("headline")[:1]
+    )
+
+def get_best_content_rank(content, query: SearchQuery):
+    """
+    Build a subquery returning the rank of the best ranked stored content row matching the query, 0 when none does.
+    The rank is cast to double precision so that it compares equal to the rank stored in a cursor.
+    """
+    return Coalesce(Subquery(
+        content.filter(search_vector=query)
+        .annotate(rank=Cast(SearchRank(F("search_vector"), query), FloatField()))
+        .order_by("-rank")
+        .values("rank")[:1]
+    ), Value(0.0))
+
+@api.get("/search/project/{query}", response={200: ProjectSearchPageSchema, 400: BadRequestSchema}, auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def search_project(request, query: str, cursor: str = None, limit: int = 100):
+    q = SearchQuery(query, search_type="phrase")
+    # content is stored against the file or against its blob, each is searched on its own so that both searches use
+    # the index on search_vector and the projects are ranked over the union of their matches
+    project_ids = ProjectFile.objects.filter(content__search_vector=q).values("project_id").union(
+        ProjectFile.objects.filter(blob__content__search_vector=q).values("project_id"))
+    projects = Project.objects.filter(id__in=project_ids).annotate(rank=Greatest(
+        get_best_content_rank(ProjectFileContent.objects.filter(project_file__project=OuterRef("pk")), q),
+        get_best_content_rank(ProjectFileContent.objects.filter(blob__project_files__project=OuterRef("pk")), q),
+    ))
+    try:
+        page, next_cursor = get_ranked_page(projects, cursor, limit)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    headlines = dict(Project.objects.filter(id__in=[p.id for p in page]).annotate(
+        headline=get_best_content_headline(ProjectFileContent.objects.filter(
+            Q(project_file__project=OuterRef("pk")) | Q(blob__project_files__project=OuterRef("pk"))
+        ), q)
+    ).values_list("id", "headline"))
+    for p in page:
+        p.headline = headlines.get(p.id)
+    return 200, {"items": page, "next_cursor": next_cursor}
+
+@api.get("/search/file/{query}", response={200: FileSearchPageSchema, 400: BadRequestSchema}, auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+def search_file(request, query: str, cursor: str = None, limit: int = 100):
     q = SearchQuery(query, search_type="phrase")
-    v = SearchVector("content__data")
-    headline = SearchHeadline("content__data", q, start_sel="<b>", stop_sel="</b>")
-    return ProjectFile.objects.annotate(headline=headline, search=v).filter(search=q)
+    file_ids = ProjectFileContent.objects.filter(search_vector=q, project_file__isnull=False).values(
+        "project_file_id").union(ProjectFile.objects.filter(blob__content__search_vector=q).values("id"))
+    files = ProjectFile.objects.filter(id__in=file_ids).annotate(rank=Greatest(
+        get_best_content_rank(ProjectFileContent.objects.filter(project_file=OuterRef("pk")), q),
+        get_best_content_rank(ProjectFileContent.objects.filter(blob=OuterRef("blob")), q),
+    ))
+    try:
+        page, next_cursor = get_ranked_page(files, cursor, limit)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    headlines = dict(ProjectFile.objects.filter(id__in=[f.id for f in page]).annotate(
+        headline=get_best_content_headline(ProjectFileContent.objects.filter(
+            Q(project_file=OuterRef("pk")) | Q(blob=OuterRef("blob"))
+        ), q)
+    ).values_list("id", "headline"))
+    for f in page:
+        f.headline = headlines.get(f.id)
+    return 200, {"items": page, "next_cursor": next_cursor}
+
+@api.post("/sync/manifest", response=dict[str, SyncProjectSchema], auth=[AuthApiKey(), AuthApiKeyHeader()])
+def sync_manifest(request, body: SyncManifestSchema):
+    return get_project_manifest_diff(body.projects, request.auth)
 
 @api.get("/websockets/session_id", response=str)
 def websocket_session_id(request):
@@ -244,6 +612,7 @@ def register_node(request, node_name: str = Form(...)):
         return {"id": node.id, "name": node.name}
 
 @api.get("/pyres", response=list[str], auth=[AuthApiKey(), AuthApiKeyHeader(), AuthBearer()])
+@cache_response("pyres")
 def get_pyres(request):
     return [i.name for i in Pyre.objects.all()]
 
@@ -279,10 +648,13 @@ def create_search_result(request, body: SearchResultInitSchema = Form(...)):
 def complete_chunked_upload_search_result(request, upload_id: str, search_result_id: int):
     chunked_upload = ChunkedUpload.objects.get(upload_id=upload_id)
     search_result = SearchResult.objects.get(id=search_result_id)
-    search_result.file = ContentFile(chunked_upload.file.read(), name=chunked_upload.filename)
+    if chunked_upload.status != "complete":
+        return 400, {"error": "upload incomplete"}
+    chunked_upload.link_file_to(search_result)
+    search_result.file_hash = chunked_upload.hash
+    search_result.hash_algorithm = chunked_upload.hash_algorithm
     search_result.search_status = "complete"
     search_result.save()
-    search_result.update_hash()
     channel_layer = get_channel_layer()
     data = {
         'type': 'communication_message',
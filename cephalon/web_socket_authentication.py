@@ -1,16 +1,10 @@
 from channels.db import database_sync_to_async
-from django.contrib.auth.hashers import make_password
 
 from cephalon.models import APIKey
-from cephalon.utils import Sha512ApiKeyHasher
 
 @database_sync_to_async
 def get_APIKey(key):
-    try:
-        hashed_key = make_password(key, hasher=Sha512ApiKeyHasher())
-        return APIKey.objects.get(key=hashed_key)
-    except APIKey.DoesNotExist:
-        return None
+    return APIKey.get_by_key(key)
 
 
 class WebsocketInterchangeAPIKeyAuthenticationMiddleware:
@@ -3,10 +3,10 @@ import json
 import os
 import re
 from datetime import datetime
-from io import BytesIO
 
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
 from django.core.files import File
 from django.core.files.base import ContentFile
 from django_rq import job
@@ -17,11 +17,13 @@ from channels.generic.websocket import AsyncWebsocketConsumer, AsyncJsonWebsocke
 from django.contrib.postgres.search import SearchQuery, SearchHeadline, SearchVector
 
 from cephalon.models import ProjectFile, Project, WebsocketSession, Pyre, WebsocketNode, APIKey, SearchResult, \
-    AnalysisGroup
+    AnalysisGroup, ChunkedUpload
 from cephalon.schemas import FileSchema, SearchResultSchema, ProjectSchema
 from django.db.models import Q
 
-from cephalon.utils import search_file
+from cephalon.archive import iter_project_archive
+from cephalon.transfer import ChunkedUploadSender, RateLimiter
+from cephalon.utils import search_file, hash_data
 
 
 class RemoteFileConsumer(AsyncWebsocketConsumer):
@@ -330,6 +332,13 @@ class UserSendConsumer(AsyncWebsocketConsumer):
         elif data['requestType'] == "user-file-request":
             self.current = CurrentCorpusX()
             nodes = await self.current.get_associated_nodes("public", "file_request")
+            request_data = data['data']
+            # the host cannot tell which nodes hold the file, with several connected nodes they share one transfer and
+            # each node holding a file with the same hash sends the ranges it claims
+            if len(nodes) > 1 and isinstance(request_data, dict) and request_data.get("hash"):
+                transfer = await self.current.create_transfer(request_data, self.session_id, self.client_id,
+                                                              data['pyreName'])
+                request_data = {**request_data, "transfer": {"upload_id": str(transfer.upload_id)}}
             for n in nodes:
                 await self.channel_layer.group_send(
                     "public"+n.name+"_file_request", {
@@ -340,7 +349,7 @@ class UserSendConsumer(AsyncWebsocketConsumer):
                             'senderID': "host",
                             'targetID': n.name,
                             'channelType': "file_request",
-                            'data': data['data'],
+                            'data': request_data,
                             'clientID': self.client_id,
                             'sessionID': self.session_id,
                             'pyreName': data['pyreName'],
@@ -504,16 +513,18 @@ class CurrentCorpusX:
             message = "No results found"
         else:
             message = f"Results found"
+            json_bytes = json_data.encode()
             data_file = SearchResult.objects.create(
                 pyre=pyre,
                 session=session,
                 node=node,
                 client_id=client_id,
                 search_query=json.dumps(query),
-                file=ContentFile(io.StringIO(json_data).read().encode(), name=f"{query['term']}.json"),
+                file=ContentFile(json_bytes, name=f"{query['term']}.json"),
+                file_hash=hash_data(json_bytes, settings.FILE_HASH_ALGORITHM),
+                hash_algorithm=settings.FILE_HASH_ALGORITHM,
                 search_status="complete"
             )
-            data_file.update_hash()
 
             result = SearchResultSchema.from_orm(data_file).dict()
             if self.perspective == "node":
@@ -564,11 +575,16 @@ class CurrentCorpusX:
             files = ProjectFile.objects.all()
         files = files.filter(file_category__in=["searched", "differential_analysis"])
 
-        files = files.filter(content__search_vector=query).annotate(headline=SearchHeadline('content__data', query, start_sel="<b>", stop_sel="</b>", highlight_all=True)).distinct()
-        analysis = AnalysisGroup.objects.filter(Q(searched_file__in=files)|Q(differential_analysis_file__in=files)).distinct()
+        # content stored against the file and against its blob is searched separately so that both searches use the
+        # index on search_vector, every matching content row gives the file a headline
+        file_ids = files.filter(content__search_vector=query).values("id").union(
+            files.filter(blob__content__search_vector=query).values("id"))
+        analysis = AnalysisGroup.objects.filter(Q(searched_file__in=file_ids)|Q(differential_analysis_file__in=file_ids)).distinct()
 
         if description != '':
             files = files.filter(description__icontains=description)
+        files = files.filter(content__search_vector=query).annotate(headline=SearchHeadline('content__data', query, start_sel="<b>", stop_sel="</b>", highlight_all=True)).union(
+            files.filter(blob__content__search_vector=query).annotate(headline=SearchHeadline('blob__content__data', query, start_sel="<b>", stop_sel="</b>", highlight_all=True)))
         if self.perspective == "host":
             if session_id != '':
                 ws = WebsocketSession.objects.get(session_id=session_id)
@@ -600,7 +616,8 @@ class CurrentCorpusX:
                 analys = analysis.filter(Q(searched_file=i) | Q(differential_analysis_file=i))
                 # if os is windows process using python re, if not process using grep and awk
                 if os.name == "nt":
-                    with i.file.open("rt") as f:
+                    # the stored file may be compressed or encrypted, the content is decoded as it is read
+                    with io.TextIOWrapper(i.open_data(), encoding="utf-8", errors="replace") as f:
 
                         for rid, line in enumerate(f, 1):
                             line = line.rstrip()
@@ -672,6 +689,10 @@ class CurrentCorpusX:
         ws.save()
         return file
 
+    @database_sync_to_async
+    def create_transfer(self, file: dict, session_id: str, client_id: str, pyre_name: str) -> ChunkedUpload:
+        return ChunkedUpload.create_transfer(file, session_id, client_id, pyre_name)
+
     @database_sync_to_async
     def add_node_to_pyre(self, pyre_name: str, node_name: str, channel_name: str):
         pyre = Pyre.objects.get(name=pyre_name)
@@ -739,6 +760,10 @@ class CurrentCorpusX:
         print(a.content)
         return file
 
+    @job
+    def send_project_file_ranges(self, file: ProjectFile, upload_id: str, server_id: str):
+        return async_to_sync(file.send_ranges_to_remote)(self.api_key, upload_id, server_id)
+
 
 
 class RemoteCorpusX:
@@ -764,25 +789,34 @@ class RemoteCorpusX:
         return projects
 
     async def upload_chunked_file(self, file: ProjectFile, project: Project = None):
-        d = await self.client.post(f"{self.url}/api/files/chunked", data={
-                        "filename": file.name,
-                        "size": file.file.size,
-                        "data_hash": file.hash,
-                        "file_category": file.file_category
-                    })
-        upload_id = d.json()["upload_id"]
-        with open(file.file.path, "rb") as f:
-            offset = 0
+        size = await database_sync_to_async(file.get_data_size)()
+        async with ChunkedUploadSender(self.url, self.api_key) as sender:
+            return await sender.upload(file.file.path, file.name, size, file.hash, file.file_category,
+                                       complete_json={"create_file": True}, hash_algorithm=file.hash_algorithm)
+
+    async def upload_project_archive(self, project: Project, limiter: RateLimiter = None):
+        """
+        Send a whole project with its files and analysis groups as one streamed archive
+        """
+        archive = iter_project_archive(project)
+
+        async def stream():
             while True:
-                chunk = f.read(d.json()["chunk_size"])
-                if not chunk:
+                chunk = await database_sync_to_async(next)(archive, None)
+                if chunk is None:
                     break
-                chunk_file = BytesIO(chunk)
-                progress = await self.client.post(f"{self.url}/api/files/chunked/{upload_id}",
-                                             data={"offset": offset}, files={"chunk": chunk_file})
-                if progress.json()["status"] == "complete":
-                    break
-                else:
-                    offset = progress.json()["offset"]
-            result = await self.client.post(f"{self.url}/api/files/chunked/{upload_id}/complete", json={"create_file": True})
-            return result.json()
\ No newline at end of file
+                if limiter:
+                    await limiter.consume(len(chunk))
+                yield chunk
+
+        async with httpx.AsyncClient(headers={"X-API-Key": self.api_key, "Content-Type": "application/gzip"},
+                                     timeout=httpx.Timeout(60.0)) as client:
+            response = await client.post(f"{self.url}/api/projects/import", content=stream())
+            response.raise_for_status()
+            return response.json()
+
+    async def upload_file_delta(self, file: ProjectFile, remote_file_id: int):
+        size = await database_sync_to_async(file.get_data_size)()
+        async with ChunkedUploadSender(self.url, self.api_key) as sender:
+            return await sender.upload_delta(file.file.path, remote_file_id, size, file.hash,
+                                             file.hash_algorithm)
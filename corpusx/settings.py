@@ -215,9 +215,13 @@ CACHES = {
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
             "PASSWORD": REDIS_PASSWORD,
+            "IGNORE_EXCEPTIONS": True,
         }
     }
 }
+RESPONSE_CACHE_TIMEOUT = int(os.environ.get("RESPONSE_CACHE_TIMEOUT", "3600"))
+# Largest number of items a listing or search page returns, larger limits asked by clients are lowered to it
+PAGE_MAX_LIMIT = int(os.environ.get("PAGE_MAX_LIMIT", "1000"))
 
 PRIVATE_KEY = os.environ.get("PRIVATE_KEY", None)
 
@@ -253,7 +257,18 @@ RQ_QUEUES = {
         "PASSWORD": REDIS_PASSWORD,
         "DEFAULT_TIMEOUT": 360,
     },
+    "ingest": {
+        "HOST": REDIS_HOST,
+        "PORT": REDIS_PORT,
+        "DB": REDIS_DB,
+        "PASSWORD": REDIS_PASSWORD,
+        "DEFAULT_TIMEOUT": int(os.environ.get("INGEST_TIMEOUT", "600")),
+    },
 }
+# Load file content on the ingest queue, with False the content is loaded during the request
+INGEST_IN_BACKGROUND = os.environ.get("INGEST_IN_BACKGROUND", "True") == "True"
+# Seconds an ingest job works on a file before it checkpoints and queues the rest, keep it below INGEST_TIMEOUT
+INGEST_JOB_SECONDS = int(os.environ.get("INGEST_JOB_SECONDS", "300"))
 
 # Tasks scheduler
 SCHEDULER_QUEUES = {
@@ -275,6 +290,43 @@ SCHEDULER_CONFIG = {
 
 ADMIN_CONTACT_EMAIL = os.environ.get("ADMIN_CONTACT_EMAIL", "test@cinder.proteo.info")
 
+# Size of the buffer used when reading stored files
+FILE_READ_BUFFER_SIZE = int(os.environ.get("FILE_READ_BUFFER_SIZE", str(1024 * 1024)))
+# Hash algorithm for files created on this instance, sha1 or blake2b
+FILE_HASH_ALGORITHM = os.environ.get("FILE_HASH_ALGORITHM", "sha1")
+# Files of encrypted projects are kept encrypted at rest with keys derived from this key, changing it makes the
+# files already stored unreadable. The segment size is the amount of plaintext authenticated and decrypted at a time.
+FILE_ENCRYPTION_KEY = os.environ.get("FILE_ENCRYPTION_KEY", SECRET_KEY)
+FILE_ENCRYPTION_SEGMENT_SIZE = int(os.environ.get("FILE_ENCRYPTION_SEGMENT_SIZE", str(64 * 1024)))
+# Keep new csv, tsv, txt and json files compressed at rest in independently compressed frames, smaller frames make
+# reads at a position cheaper and compress less well. Existing files are compressed with the compress_files command.
+FILE_STORAGE_COMPRESSION = os.environ.get("FILE_STORAGE_COMPRESSION", "False") == "True"
+FILE_COMPRESSION_FRAME_SIZE = int(os.environ.get("FILE_COMPRESSION_FRAME_SIZE", str(128 * 1024)))
+
+# Size limits of the content defined segments file content is indexed in, changing them needs a shadow_reindex
+CONTENT_SEGMENT_MIN_SIZE = int(os.environ.get("CONTENT_SEGMENT_MIN_SIZE", str(16 * 1024)))
+CONTENT_SEGMENT_MAX_SIZE = int(os.environ.get("CONTENT_SEGMENT_MAX_SIZE", str(256 * 1024)))
+
+# API key lookup cache
+API_KEY_CACHE_SIZE = int(os.environ.get("API_KEY_CACHE_SIZE", "1024"))
+API_KEY_CACHE_TTL = int(os.environ.get("API_KEY_CACHE_TTL", "60"))
+
+# Chunked uploads to remote hosts, HTTP/2 requires the h2 package (httpx[http2])
+CHUNKED_UPLOAD_WINDOW = int(os.environ.get("CHUNKED_UPLOAD_WINDOW", "4"))
+CHUNKED_UPLOAD_HTTP2 = os.environ.get("CHUNKED_UPLOAD_HTTP2", "False") == "True"
+CHUNKED_UPLOAD_RETRIES = int(os.environ.get("CHUNKED_UPLOAD_RETRIES", "5"))
+# Limits for the chunk size the receiver asks senders to use, keep the maximum below client_max_body_size in nginx
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = int(os.environ.get("CHUNKED_UPLOAD_MAX_CHUNK_SIZE", str(64 * 1024 * 1024)))
+CHUNKED_UPLOAD_TARGET_SECONDS = float(os.environ.get("CHUNKED_UPLOAD_TARGET_SECONDS", "2"))
+# Seconds after which a byte range claimed by a node in a transfer shared by several nodes is handed out again
+CHUNKED_UPLOAD_CLAIM_TIMEOUT = int(os.environ.get("CHUNKED_UPLOAD_CLAIM_TIMEOUT", "60"))
+
+# Scheduled sync with paired instances, the window is local server time as HH:MM-HH:MM and may wrap past midnight,
+# an empty window allows syncing at any time. The rate is in bytes per second for each remote, 0 is unlimited.
+SYNC_WINDOW = os.environ.get("SYNC_WINDOW", "")
+SYNC_MAX_RATE = int(os.environ.get("SYNC_MAX_RATE", "0"))
+SYNC_JOB_TIMEOUT = int(os.environ.get("SYNC_JOB_TIMEOUT", str(12 * 3600)))
+
 # Admin tools
 ADMIN_TOOLS_THEMING_CSS = 'admin/css/admin_color.css'
 ADMIN_TOOLS_INDEX_DASHBOARD = 'corpusx.customdashboard.CustomIndexDashboard'
\ No newline at end of file